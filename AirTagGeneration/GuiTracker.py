@@ -1,8 +1,8 @@
 import sys
 import os
 import json
+import threading
 from types import SimpleNamespace
-import datetime
 import requests
 from getpass import getpass
 import plistlib as plist
@@ -10,21 +10,139 @@ import base64
 
 import cores.pypush_gsa_icloud
 import RequestReportMap as RRM
+from cores.account_pool import AccountPool
+from cores.fusion import BUCKET_SECONDS, fuse_reports
+from cores.geocoder import load_geocoder
+from cores.sync import UpstreamError
 from cores.pypush_gsa_icloud import (
     generate_anisette_headers,
     srp,
     gsa_authenticated_request,
     encrypt_password,
+    derive_password_key,
     decrypt_cbc,
     trusted_second_factor,
 )
 
-from PySide6 import QtWidgets, QtWebEngineWidgets, QtGui
+from PySide6 import QtWidgets, QtWebEngineWidgets, QtGui, QtCore
 from ui.MainWindow import Ui_MainWindow
 
 
 cores.pypush_gsa_icloud.ANISETTE_URL = "https://ani.sidestore.io"
 
+AUTO_REFRESH_INTERVAL_MS = 5 * 60 * 1000
+
+
+class WorkerSignals(QtCore.QObject):
+    fetched = QtCore.Signal(int)
+    decrypted = QtCore.Signal(list, set)
+    rendered = QtCore.Signal(str)
+    failed = QtCore.Signal(str)
+    finished = QtCore.Signal()
+
+
+class LoginBridge(QtCore.QObject):
+    """Runs the dialog based login on the GUI thread when AuthManager re-logs in from a worker."""
+
+    requested = QtCore.Signal(str)
+
+    def __init__(self, login):
+        super().__init__()
+        self.login = login
+        self.requested.connect(self._run)
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def _run(self, second_factor):
+        try:
+            self._result, self._error = self.login(second_factor=second_factor), None
+        except Exception as e:
+            self._result, self._error = None, e
+        finally:
+            self._done.set()
+
+    def __call__(self, second_factor="sms"):
+        if QtCore.QThread.currentThread() == self.thread():
+            return self.login(second_factor=second_factor)
+        self._done.clear()
+        self.requested.emit(second_factor)
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class ReportWorker(QtCore.QRunnable):
+    """Runs the fetch -> decrypt -> store pipeline and the map render off the GUI thread.
+
+    Cancelling stops the pipeline between reports; a request already sent to Apple
+    is allowed to finish.
+    """
+
+    def __init__(self, args, auth_manager, privkeys, names, geocoder=None):
+        super().__init__()
+        self.args = args
+        self.auth_manager = auth_manager
+        self.privkeys = privkeys
+        self.names = names
+        self.geocoder = geocoder
+        self.signals = WorkerSignals()
+        # Built in run(), creating the tables can backfill the heatmap over the whole history
+        self.pipeline = None
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+        pipeline = self.pipeline
+        if pipeline is not None:
+            pipeline.cancel()
+
+    def is_cancelled(self):
+        return self._cancelled.is_set()
+
+    @QtCore.Slot()
+    def run(self):
+        try:
+            self.pipeline = RRM.build_pipeline(
+                self.names,
+                self.privkeys,
+                self.args.hours,
+                pool=self.auth_manager,
+                geocoder=self.geocoder,
+                on_fetch=self.signals.fetched.emit,
+            )
+            if self.is_cancelled():
+                return
+            try:
+                ordered, found = RRM.process_reports(self.pipeline, self.names)
+            except UpstreamError as e:
+                self.signals.failed.emit(str(e))
+                return
+            finally:
+                RRM.record_heat(self.pipeline.fresh)
+            if self.is_cancelled():
+                return
+
+            ordered.sort(key=lambda item: item.get("timestamp"))
+            self.signals.decrypted.emit(ordered, found)
+            if self.is_cancelled():
+                return
+
+            if self.args.fuse > 0:
+                ordered = fuse_reports(ordered, self.args.fuse, self.args.smooth)
+            RRM.export_data(ordered)
+            maphtml = RRM.generate_map(
+                heat=RRM.load_heat(self.names) if self.args.heatmap else None
+            )
+            if self.is_cancelled():
+                return
+            self.signals.rendered.emit(maphtml)
+        except Exception as e:
+            self.signals.failed.emit(str(e))
+        finally:
+            self.signals.finished.emit()
+
 
 class AniDialog(QtWidgets.QDialog):
     def __init__(self):
@@ -57,7 +175,6 @@ class AniDialog(QtWidgets.QDialog):
 
 
 # TODO Show parameters on sidepanel
-# TODO Disable Update Repurts button when active
 class FindMyFlipperUi(QtWidgets.QMainWindow):
     def __init__(self):
         super(FindMyFlipperUi, self).__init__()
@@ -69,46 +186,110 @@ class FindMyFlipperUi(QtWidgets.QMainWindow):
         self.args.prefix = ""
         self.args.regen = False
         self.args.trusteddevice = False  # TODO add ui for changing these
+        self.args.fuse = BUCKET_SECONDS
+        self.args.smooth = False
+        self.args.heatmap = False
+        self.geocoder = load_geocoder()
 
         self.ui.actionSelect_Anisette_server.triggered.connect(self.openAniDialog)
+        self.ui.actionAuto_refresh.toggled.connect(self.toggleAutoRefresh)
         self.ui.updateReports_pushButton.clicked.connect(self.main)
+        self.ui.cancel_pushButton.clicked.connect(self.cancel)
+
+        self.auth_manager = AccountPool.load(login=LoginBridge(self.icloud_login_mobileme))
+        self.names = {}
+        self.found_missing = ""
+        self.worker = None
+        self.threadpool = QtCore.QThreadPool.globalInstance()
+        self.refresh_timer = QtCore.QTimer(self)
+        self.refresh_timer.setInterval(AUTO_REFRESH_INTERVAL_MS)
+        self.refresh_timer.timeout.connect(self.main)
+
+        self.web_view = QtWebEngineWidgets.QWebEngineView()
+        frame_layout = QtWidgets.QVBoxLayout()
+        self.ui.map_frame.setLayout(frame_layout)
+        frame_layout.addWidget(self.web_view)
         self.showMaximized()
 
     def main(self):
-        privkeys, names = RRM.load_key_files(self.args.prefix)
-        response, startdate = self.fetch_reports(self.args, names)
-        if response.status_code == 200:
-            ordered, found = RRM.process_reports(response, startdate, privkeys, names)
-            print(f"{len(ordered)} reports used.")
-            self.setStatusTip(f"{len(ordered)} reports used.")
-            ordered.sort(key=lambda item: item.get("timestamp"))
-            for rep in ordered:
-                print(rep)
-                self.setStatusTip(str(rep))
-
-            RRM.export_data(ordered)
-            self.setStatusTip("Generating map...")
-            maphtml = RRM.generate_map()
-
-            web_view = QtWebEngineWidgets.QWebEngineView()
-            web_view.setHtml(maphtml)
-
-            frame_layout = QtWidgets.QVBoxLayout()
-            self.ui.map_frame.setLayout(frame_layout)
-            frame_layout.addWidget(web_view)
-            web_view.resize(self.ui.map_frame.size())
-            self.setStatusTip("Done!")
-
-            missing = [key for key in names.values() if key not in found]
-            print(f"found: {list(found)}")
-            print(f"missing: {missing}")
-            self.setStatusTip(f"Found: {str(found)} missing: {str(missing)}")
+        if self.worker is not None:
+            # A refresh is already in flight, auto-refresh ticks are skipped
+            return
 
+        privkeys, self.names = RRM.load_key_files(self.args.prefix)
+        # The first login prompts for credentials, do it here rather than from the worker
+        self.auth_manager.second_factor = (
+            "trusted_device" if self.args.trusteddevice else "sms"
+        )
+        if self.args.regen:
+            self.auth_manager.refresh()
         else:
-            print("Failed to fetch reports. Status code:", response.status_code)
+            self.auth_manager.get()
+
+        self.worker = ReportWorker(
+            self.args, self.auth_manager, privkeys, self.names, self.geocoder
+        )
+        self.worker.setAutoDelete(False)
+        self.worker.signals.fetched.connect(self.onFetched)
+        self.worker.signals.decrypted.connect(self.onDecrypted)
+        self.worker.signals.rendered.connect(self.onRendered)
+        self.worker.signals.failed.connect(self.onFailed)
+        self.worker.signals.finished.connect(self.onFinished)
+
+        self.ui.updateReports_pushButton.setEnabled(False)
+        self.ui.cancel_pushButton.setEnabled(True)
+        self.ui.progressBar.setValue(0)
+        self.setStatusTip("Fetching reports...")
+        self.threadpool.start(self.worker)
+
+    def cancel(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.ui.cancel_pushButton.setEnabled(False)
+            self.setStatusTip("Cancelling...")
+
+    def toggleAutoRefresh(self, checked):
+        if checked:
+            self.refresh_timer.start()
             self.setStatusTip(
-                "Failed to fetch reports. Status code: " + str(response.status_code)
+                f"Auto refresh every {AUTO_REFRESH_INTERVAL_MS // 60000} minutes"
             )
+        else:
+            self.refresh_timer.stop()
+            self.setStatusTip("Auto refresh disabled")
+
+    def onFetched(self, count):
+        print(f"{count} reports received.")
+        self.ui.progressBar.setValue(1)
+        self.setStatusTip(f"{count} reports received, decrypting...")
+
+    def onDecrypted(self, ordered, found):
+        print(f"{len(ordered)} reports used.")
+        for rep in ordered:
+            print(rep)
+        self.ui.progressBar.setValue(2)
+        self.setStatusTip(f"{len(ordered)} reports used. Generating map...")
+
+        missing = [key for key in self.names.values() if key not in found]
+        print(f"found: {list(found)}")
+        print(f"missing: {missing}")
+        self.found_missing = f"Found: {str(found)} missing: {str(missing)}"
+
+    def onRendered(self, maphtml):
+        self.web_view.setHtml(maphtml)
+        self.ui.progressBar.setValue(3)
+        self.setStatusTip(self.found_missing)
+
+    def onFailed(self, message):
+        print(message)
+        self.setStatusTip(message)
+
+    def onFinished(self):
+        if self.worker is not None and self.worker.is_cancelled():
+            self.setStatusTip("Cancelled")
+        self.worker = None
+        self.ui.updateReports_pushButton.setEnabled(True)
+        self.ui.cancel_pushButton.setEnabled(False)
 
     def openAniDialog(self):
         dlg = AniDialog()
@@ -129,47 +310,6 @@ class FindMyFlipperUi(QtWidgets.QMainWindow):
     ######### Modified functions #########
     # Methods below are modified to work with PySide6
 
-    def fetch_reports(self, args, names):
-        unixEpoch = int(datetime.datetime.now().timestamp())
-        startdate = unixEpoch - (60 * 60 * args.hours)
-        data = {
-            "search": [
-                {
-                    "startDate": startdate * 1000,
-                    "endDate": unixEpoch * 1000,
-                    "ids": list(names.keys()),
-                }
-            ]
-        }
-
-        response = requests.post(
-            "https://gateway.icloud.com/acsnservice/fetch",
-            auth=self.getAuth(
-                regenerate=args.regen,
-                second_factor="trusted_device" if args.trusteddevice else "sms",
-            ),
-            headers=generate_anisette_headers(),
-            json=data,
-        )
-        return response, startdate
-
-    def getAuth(self, regenerate=False, second_factor="sms"):
-        CONFIG_PATH = os.path.dirname(os.path.realpath(__file__)) + "/keys/auth.json"
-        if os.path.exists(CONFIG_PATH) and not regenerate:
-            with open(CONFIG_PATH, "r") as f:
-                j = json.load(f)
-        else:
-            mobileme = self.icloud_login_mobileme(second_factor=second_factor)
-            j = {
-                "dsid": mobileme["dsid"],
-                "searchPartyToken": mobileme["delegates"]["com.apple.mobileme"][
-                    "service-data"
-                ]["tokens"]["searchPartyToken"],
-            }
-            with open(CONFIG_PATH, "w") as f:
-                json.dump(j, f)
-        return (j["dsid"], j["searchPartyToken"])
-
     def icloud_login_mobileme(self, username="", password="", second_factor="sms"):
         if not username:
             user_input, ok = QtWidgets.QInputDialog.getText(self, "Login", "Apple ID")
@@ -185,7 +325,10 @@ class FindMyFlipperUi(QtWidgets.QMainWindow):
                 password = user_input
                 print(f"Password submitted: {password!=""}")
 
-        g = self.gsa_authenticate(username, password, second_factor)
+        try:
+            g = self.gsa_authenticate(username, password, second_factor)
+        finally:
+            derive_password_key.cache_clear()
         pet = g["t"]["com.apple.gs.idms.pet"]["token"]
         adsid = g["adsid"]
 
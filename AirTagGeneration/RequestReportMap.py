@@ -1,60 +1,36 @@
 #!/usr/bin/env python3
 import argparse
-import base64
 import datetime
 import glob
-import hashlib
 import json
 import os
 import sqlite3
-import struct
-import requests
 import subprocess
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cores.pypush_gsa_icloud import icloud_login_mobileme, generate_anisette_headers
+from concurrent.futures import ProcessPoolExecutor
+from cores.account_pool import account_pool, getAuth
+from cores.report_db import (
+    DB_PATH,
+    assign_fleets,
+    create_tables,
+    insert_report,
+    latest_positions,
+    tag_id_of,
+)
+from cores.db_pool import ConnectionPool
+from cores.fusion import BUCKET_SECONDS, fuse_reports
+from cores.geocoder import GAZETTEER_PATH, load_geocoder
+from cores.heatmap import cell_rows, create_heat_tables, heat_points
+from cores.heatmap import update as update_heat_cells
+from cores.pipeline import chunked
+from cores.profiling import StageProfiler
+from cores.scheduler import create_schedule_table, due_tags, lookback_hours, record_poll
+from cores.sync import FETCH_CHUNK, UpstreamError, report_pipeline
+from cores.trajectory import analyze_many
 import cores.pypush_gsa_icloud
 import advanced_map_loc
 
 cores.pypush_gsa_icloud.ANISETTE_URL = "https://ani.sidestore.io"
-
-
-def sha256(data):
-    digest = hashlib.new("sha256")
-    digest.update(data)
-    return digest.digest()
-
-
-def decrypt(enc_data, algorithm_dkey, mode):
-    decryptor = Cipher(algorithm_dkey, mode, default_backend()).decryptor()
-    return decryptor.update(enc_data) + decryptor.finalize()
-
-
-def decode_tag(data):
-    latitude = struct.unpack(">i", data[0:4])[0] / 10000000.0
-    longitude = struct.unpack(">i", data[4:8])[0] / 10000000.0
-    confidence = int.from_bytes(data[8:9], "big")
-    status = int.from_bytes(data[9:10], "big")
-    return {"lat": latitude, "lon": longitude, "conf": confidence, "status": status}
-
-
-def getAuth(regenerate=False, second_factor="sms"):
-    CONFIG_PATH = os.path.dirname(os.path.realpath(__file__)) + "/keys/auth.json"
-    if os.path.exists(CONFIG_PATH) and not regenerate:
-        with open(CONFIG_PATH, "r") as f:
-            j = json.load(f)
-    else:
-        mobileme = icloud_login_mobileme(second_factor=second_factor)
-        j = {
-            "dsid": mobileme["dsid"],
-            "searchPartyToken": mobileme["delegates"]["com.apple.mobileme"][
-                "service-data"
-            ]["tokens"]["searchPartyToken"],
-        }
-        with open(CONFIG_PATH, "w") as f:
-            json.dump(j, f)
-    return (j["dsid"], j["searchPartyToken"])
+KEYS_DIR = os.path.dirname(os.path.realpath(__file__)) + "/keys/"
 
 
 def parse_arguments():
@@ -69,8 +45,14 @@ def parse_arguments():
     parser.add_argument(
         "-p",
         "--prefix",
-        help="only use keyfiles starting with this prefix",
-        default="",
+        help="only use keyfiles starting with this prefix, repeat to handle several fleets in one run",
+        action="append",
+    )
+    parser.add_argument(
+        "-f",
+        "--fleet",
+        help="group prefixes into one fleet with its own JSON and map, as NAME=PREFIX[,PREFIX...]",
+        action="append",
     )
     parser.add_argument(
         "-r", "--regen", help="regenerate search-party-token", action="store_true"
@@ -81,15 +63,62 @@ def parse_arguments():
         help="use trusted device for 2FA instead of SMS",
         action="store_true",
     )
+    parser.add_argument(
+        "-s",
+        "--scheduled",
+        help="only fetch tags whose adaptive poll interval has elapsed, looking back to their last poll",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--fuse",
+        help="fuse the reports of a tag within this many seconds into one confidence-weighted position, 0 keeps "
+        "every report",
+        type=int,
+        default=BUCKET_SECONDS,
+        metavar="SECONDS",
+    )
+    parser.add_argument(
+        "--smooth",
+        help="also Kalman-smooth the fused positions of each tag",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--gazetteer",
+        help="GeoNames dump or CSV of name,lat,lon used to label positions with the nearest place, used when "
+        "the file exists",
+        default=GAZETTEER_PATH,
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--heatmap",
+        help="draw every stored report of the tags as a dwell time heatmap instead of one marker per report",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-a",
+        "--analytics",
+        help="print distance, speeds, stops and trips per tag",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--profile",
+        help="print wall/CPU time, memory and item counts per stage as JSON, or write them to FILE",
+        nargs="?",
+        const="-",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--profile-stats",
+        help="also run the stages under cProfile and dump pstats to this file",
+        metavar="FILE",
+    )
     return parser.parse_args()
 
 
-def load_key_files(prefix):
+def load_key_files(prefix, keys_dir=KEYS_DIR):
     privkeys = {}
     names = {}
-    for keyfile in glob.glob(
-        os.path.dirname(os.path.realpath(__file__)) + "/keys/" + prefix + "*.keys"
-    ):
+    for keyfile in glob.glob(os.path.join(keys_dir, prefix + "*.keys")):
         with open(keyfile) as f:
             hashed_adv = priv = ""
             name = os.path.basename(keyfile)[len(prefix) : -5]
@@ -107,111 +136,250 @@ def load_key_files(prefix):
     return privkeys, names
 
 
-def fetch_reports(args, names):
-    unixEpoch = int(datetime.datetime.now().timestamp())
-    startdate = unixEpoch - (60 * 60 * args.hours)
-    data = {
-        "search": [
-            {
-                "startDate": startdate * 1000,
-                "endDate": unixEpoch * 1000,
-                "ids": list(names.keys()),
-            }
-        ]
-    }
-
-    response = requests.post(
-        "https://gateway.icloud.com/acsnservice/fetch",
-        auth=getAuth(
-            regenerate=args.regen,
-            second_factor="trusted_device" if args.trusteddevice else "sms",
-        ),
-        headers=generate_anisette_headers(),
-        json=data,
-    )
-    return response, startdate
-
-
-def process_reports(response, startdate, privkeys, names):
-    res = json.loads(response.content.decode())["results"]
-    ordered = []
-    found = set()
-    sq3db = sqlite3.connect(
-        os.path.dirname(os.path.realpath(__file__)) + "/keys/reports.db"
+def plan_fleets(prefixes, fleets):
+    # Fleet name -> prefixes, a prefix given on its own is a fleet named after itself
+    plan = {prefix.rstrip("_-.") or prefix: [prefix] for prefix in prefixes or []}
+    for fleet in fleets or []:
+        name, _, fleet_prefixes = fleet.partition("=")
+        plan[name] = fleet_prefixes.split(",") if fleet_prefixes else [name]
+    return plan or {"": [""]}
+
+
+def load_fleets(plan, keys_dir=KEYS_DIR):
+    """Load the keys of every fleet once, a tag in several fleets is fetched only once.
+
+    With more than one prefix tags are named after their whole key file, so tag1.keys of
+    two customers' prefixes stay apart. Returns privkeys, names and, per fleet, the set
+    of hashed keys that belong to it.
+    """
+    privkeys, names, members = {}, {}, {}
+    qualify = sum(len(prefixes) for prefixes in plan.values()) > 1
+    for fleet, prefixes in plan.items():
+        members[fleet] = set()
+        for prefix in prefixes:
+            fleet_privkeys, fleet_names = load_key_files(prefix, keys_dir)
+            privkeys.update(fleet_privkeys)
+            for hashed_adv, name in fleet_names.items():
+                names[hashed_adv] = prefix + name if qualify else name
+            members[fleet].update(fleet_names)
+    return privkeys, names, members
+
+
+def write_fleet_outputs(fleet, ordered, heat=None):
+    # Runs in a worker process per fleet, the map render is CPU bound
+    export_data(ordered, f"data_{fleet}.json")
+    generate_map(f"data_{fleet}.json", map_prefix=f"{fleet}_", heat=heat)
+    return fleet, len(ordered)
+
+
+def route_to_fleets(members, names, ordered, heatmap=False):
+    with ProcessPoolExecutor(max_workers=min(len(members), os.cpu_count() or 1)) as executor:
+        futures = []
+        for fleet, hashed in members.items():
+            fleet_names = {names[hashed_adv] for hashed_adv in hashed}
+            fleet_ordered = [tag for tag in ordered if tag["key"] in fleet_names]
+            heat = load_heat(hashed) if heatmap else None
+            futures.append(
+                executor.submit(write_fleet_outputs, fleet, fleet_ordered, heat)
+            )
+        for future in futures:
+            fleet, count = future.result()
+            print(f"fleet {fleet}: {count} reports written to data_{fleet}.json")
+
+
+def label_tag(tag, name):
+    tag["key"] = name
+    tag["goog"] = (
+        "https://maps.google.com/maps?q=" + str(tag["lat"]) + "," + str(tag["lon"])
     )
+    return tag
+
+
+def build_pipeline(
+    names,
+    privkeys,
+    hours,
+    pool=account_pool,
+    db_path=DB_PATH,
+    geocoder=None,
+    on_fetch=None,
+):
+    # Fetch chunks flow through decrypt and batched writes while later chunks are still in flight,
+    # on_fetch(count) is told the running number of fetched reports
+    db = ConnectionPool(db_path)
+    with db.writer() as sq3:
+        create_tables(sq3, commit=False)
+        create_heat_tables(sq3)
+    # New reports per id, added to the heatmap cells by record_heat() once the run is complete
+    fresh = {}
+
+    def store(sq3, report, tag):
+        insert_report(
+            sq3,
+            names[report["id"]],
+            tag["timestamp"],
+            report["datePublished"],
+            report["payload"],
+            report["id"],
+            report["statusCode"],
+            tag["lat"],
+            tag["lon"],
+            tag["conf"],
+            tag.get("place"),
+        )
+
+    def label(item):
+        report, tag, stored = item
+        if not stored:
+            fresh.setdefault(report["id"], []).append(tag)
+        return [label_tag(tag, names[report["id"]])]
+
+    pipeline = report_pipeline(
+        db,
+        privkeys,
+        hours,
+        pool,
+        store=store,
+        drop_older=True,
+        geocoder=geocoder,
+        on_fetch=on_fetch,
+    ).stage("label", label)
+    pipeline.fresh = fresh
+    return pipeline
+
+
+def process_reports(pipeline, names, profiler=None):
+    profiler = profiler or StageProfiler()
+    with profiler.stage("pipeline") as stage:
+        ordered = pipeline.run(chunked(names, FETCH_CHUNK))
+        stage["items"] = pipeline.counts["fetched"]
+        stage["skipped_duplicate"] = pipeline.counts["duplicate"]
+        stage["skipped_stored"] = pipeline.counts["stored"]
+        stage.update(pipeline.stats())
+    if pipeline.counts["duplicate"] or pipeline.counts["stored"]:
+        print(
+            f"Skipped decrypting {pipeline.counts['duplicate']} duplicate and "
+            f"{pipeline.counts['stored']} already stored report(s)."
+        )
+    found = set(tag["key"] for tag in ordered)
+    return ordered, found
+
+
+def select_due(names, hours, db_path=DB_PATH):
+    sq3db = sqlite3.connect(db_path)
     sq3 = sq3db.cursor()
+    create_tables(sq3)
+    create_schedule_table(sq3)
+    due, lookback = due_tags(sq3, names)
+    sq3db.close()
+    return {hashed_adv: names[hashed_adv] for hashed_adv in due}, lookback_hours(
+        lookback, hours
+    )
+
 
-    sq3.execute(
-        """CREATE TABLE IF NOT EXISTS reports (
-        id_short TEXT, timestamp INTEGER, datePublished INTEGER, payload TEXT, 
-        id TEXT, statusCode INTEGER, lat TEXT, lon TEXT, conf INTEGER, 
-        PRIMARY KEY(id_short,timestamp));"""
+def record_fleets(members, names, db_path=DB_PATH):
+    sq3db = sqlite3.connect(db_path)
+    sq3 = sq3db.cursor()
+    create_tables(sq3)
+    assign_fleets(
+        sq3,
+        {
+            fleet: {hashed_adv: names[hashed_adv] for hashed_adv in hashed}
+            for fleet, hashed in members.items()
+        },
     )
+    sq3db.commit()
+    sq3db.close()
 
-    for report in res:
-        priv = int.from_bytes(base64.b64decode(privkeys[report["id"]]), byteorder="big")
-        data = base64.b64decode(report["payload"])
-        timestamp = int.from_bytes(data[0:4], "big") + 978307200
 
-        if timestamp >= startdate:
-            adj = len(data) - 88
-            eph_key = ec.EllipticCurvePublicKey.from_encoded_point(
-                ec.SECP224R1(), data[5 + adj : 62 + adj]
-            )
-            shared_key = ec.derive_private_key(
-                priv, ec.SECP224R1(), default_backend()
-            ).exchange(ec.ECDH(), eph_key)
-            symmetric_key = sha256(
-                shared_key + b"\x00\x00\x00\x01" + data[5 + adj : 62 + adj]
-            )
-            decryption_key = symmetric_key[:16]
-            iv = symmetric_key[16:]
-            enc_data = data[62 + adj : 72 + adj]
-            auth_tag = data[72 + adj :]
+def record_polls(names, ordered, db_path=DB_PATH):
+    hashed_of = {name: hashed_adv for hashed_adv, name in names.items()}
+    positions = {}
+    for tag in ordered:
+        positions.setdefault(hashed_of[tag["key"]], []).append(tag)
+    sq3db = sqlite3.connect(db_path)
+    sq3 = sq3db.cursor()
+    create_schedule_table(sq3)
+    record_poll(sq3, names, positions)
+    sq3db.commit()
+    sq3db.close()
 
-            decrypted = decrypt(
-                enc_data, algorithms.AES(decryption_key), modes.GCM(iv, auth_tag)
-            )
-            tag = decode_tag(decrypted)
-            tag["timestamp"] = timestamp
-            tag["isodatetime"] = datetime.datetime.fromtimestamp(timestamp).isoformat()
-            tag["key"] = names[report["id"]]
-            tag["goog"] = (
-                "https://maps.google.com/maps?q="
-                + str(tag["lat"])
-                + ","
-                + str(tag["lon"])
-            )
-            found.add(tag["key"])
-            ordered.append(tag)
-
-            query = "INSERT OR REPLACE INTO reports VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
-            parameters = (
-                names[report["id"]],
-                timestamp,
-                report["datePublished"],
-                report["payload"],
-                report["id"],
-                report["statusCode"],
-                str(tag["lat"]),
-                str(tag["lon"]),
-                tag["conf"],
-            )
-            sq3.execute(query, parameters)
 
+def record_heat(fresh, db_path=DB_PATH):
+    sq3db = sqlite3.connect(db_path)
+    sq3 = sq3db.cursor()
+    create_heat_tables(sq3)
+    update_heat_cells(sq3, fresh)
     sq3db.commit()
     sq3db.close()
-    return ordered, found
 
 
-def export_data(ordered):
-    with open("data.json", "w") as json_file:
+def load_heat(hashed, db_path=DB_PATH):
+    # Every stored report of these tags, not only the ones of this run
+    sq3db = sqlite3.connect(db_path)
+    sq3 = sq3db.cursor()
+    create_heat_tables(sq3)
+    tag_ids = [tag_id_of(sq3, hashed_adv) for hashed_adv in hashed]
+    cells = cell_rows(sq3, [tag_id for tag_id in tag_ids if tag_id is not None])
+    sq3db.close()
+    return heat_points(cells)
+
+
+def print_last_known(names, missing):
+    sq3db = sqlite3.connect(DB_PATH)
+    sq3 = sq3db.cursor()
+    create_tables(sq3)
+    hashed = [hashed_adv for hashed_adv, name in names.items() if name in missing]
+    for hashed_adv, last in latest_positions(sq3, hashed).items():
+        place = f" ({last['place']})" if last["place"] else ""
+        print(
+            f"last known position of {names[hashed_adv]}: {last['lat']},{last['lon']}{place} at "
+            f"{datetime.datetime.fromtimestamp(last['timestamp']).isoformat()}"
+        )
+    sq3db.close()
+
+
+def print_analytics(ordered):
+    analytics = analyze_many(
+        [tag["key"] for tag in ordered],
+        [tag["timestamp"] for tag in ordered],
+        [tag["lat"] for tag in ordered],
+        [tag["lon"] for tag in ordered],
+        [tag["conf"] for tag in ordered],
+    )
+    for name, summary in analytics.items():
+        print(
+            f"{name}: {summary['distance_meters'] / 1000:.2f} km, "
+            f"max {summary['max_speed'] * 3.6:.1f} km/h, "
+            f"moving {advanced_map_loc.format_time(summary['moving_seconds'])}, "
+            f"{len(summary['stops'])} stop(s), {len(summary['trips'])} trip(s), "
+            f"{summary['rejected']} report(s) rejected"
+        )
+        for stop in summary["stops"]:
+            print(
+                f"  stop at {stop['lat']},{stop['lon']} from "
+                f"{datetime.datetime.fromtimestamp(stop['start']).isoformat()} for "
+                f"{advanced_map_loc.format_time(stop['dwell_seconds'])}"
+            )
+        for trip in summary["trips"]:
+            print(
+                f"  trip of {trip['distance_meters'] / 1000:.2f} km from "
+                f"{datetime.datetime.fromtimestamp(trip['start']).isoformat()} to "
+                f"{datetime.datetime.fromtimestamp(trip['end']).isoformat()}"
+            )
+    return analytics
+
+
+def export_data(ordered, file_path="data.json"):
+    with open(file_path, "w") as json_file:
         json.dump(ordered, json_file, indent=4)
-    print("Data has been successfully exported to 'data.json'.")
+    print(f"Data has been successfully exported to '{file_path}'.")
 
 
-def generate_map():
-    result = advanced_map_loc.main("data.json")
+def generate_map(file_path="data.json", save=True, map_prefix="", heat=None):
+    result = advanced_map_loc.main(
+        file_path, save=save, map_prefix=map_prefix, heat=heat
+    )
     if result:
         print("The map script ran successfully!")
         return result
@@ -222,24 +390,77 @@ def generate_map():
 
 def main():
     args = parse_arguments()
-    privkeys, names = load_key_files(args.prefix)
-    response, startdate = fetch_reports(args, names)
-
-    if response.status_code == 200:
-        ordered, found = process_reports(response, startdate, privkeys, names)
-        print(f"{len(ordered)} reports used.")
-        ordered.sort(key=lambda item: item.get("timestamp"))
-        for rep in ordered:
-            print(rep)
-
-        export_data(ordered)
-        generate_map()
-
-        missing = [key for key in names.values() if key not in found]
-        print(f"found: {list(found)}")
-        print(f"missing: {missing}")
+    profiler = StageProfiler(args.profile is not None, args.profile_stats)
+
+    plan = plan_fleets(args.prefix, args.fleet)
+    fleet_mode = len(plan) > 1 or bool(args.fleet)
+    with profiler.stage("load_key_files") as stage:
+        privkeys, names, members = load_fleets(plan)
+        stage["items"] = len(names)
+    if fleet_mode:
+        print(f"{len(plan)} fleet(s), {len(names)} distinct tag(s).")
+    if args.scheduled:
+        names, args.hours = select_due(names, args.hours)
+        members = {fleet: hashed & names.keys() for fleet, hashed in members.items()}
+        if not names:
+            print("No tag is due for polling yet.")
+            profiler.dump(args.profile or "-")
+            return
+        print(f"{len(names)} tag(s) due, looking back {args.hours} hour(s).")
+    getAuth(
+        regenerate=args.regen,
+        second_factor="trusted_device" if args.trusteddevice else "sms",
+    )
+    geocoder = load_geocoder(args.gazetteer)
+    pipeline = build_pipeline(
+        names, privkeys, args.hours, account_pool, DB_PATH, geocoder
+    )
+    try:
+        ordered, found = process_reports(pipeline, names, profiler=profiler)
+    except UpstreamError as e:
+        print(e)
+        profiler.dump(args.profile or "-")
+        return
+    finally:
+        # Batches stored before a failure count too
+        record_heat(pipeline.fresh)
+
+    print(f"{len(ordered)} reports used.")
+    ordered.sort(key=lambda item: item.get("timestamp"))
+    for rep in ordered:
+        print(rep)
+    if args.scheduled:
+        record_polls(names, ordered)
+    if args.fuse > 0:
+        with profiler.stage("fuse") as stage:
+            fused = fuse_reports(ordered, args.fuse, args.smooth)
+            stage["items"] = len(ordered)
+        print(f"{len(ordered)} reports fused into {len(fused)} position(s).")
+        ordered = fused
+    if args.analytics:
+        with profiler.stage("analytics") as stage:
+            print_analytics(ordered)
+            stage["items"] = len(ordered)
+
+    if fleet_mode:
+        record_fleets(members, names)
+        with profiler.stage("fleet_outputs") as stage:
+            route_to_fleets(members, names, ordered, args.heatmap)
+            stage["items"] = len(ordered)
     else:
-        print("Failed to fetch reports. Status code:", response.status_code)
+        with profiler.stage("export_data") as stage:
+            export_data(ordered)
+            stage["items"] = len(ordered)
+        with profiler.stage("generate_map") as stage:
+            generate_map(heat=load_heat(names) if args.heatmap else None)
+            stage["items"] = len(ordered)
+
+    missing = [key for key in names.values() if key not in found]
+    print(f"found: {list(found)}")
+    print(f"missing: {missing}")
+    print_last_known(names, missing)
+
+    profiler.dump(args.profile or "-")
 
 
 if __name__ == "__main__":
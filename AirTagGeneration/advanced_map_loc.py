@@ -1,10 +1,12 @@
 import json
 import pandas as pd
 import folium
-from folium.plugins import AntPath
+from folium.plugins import AntPath, HeatMap
 from datetime import datetime
 import os
 
+from cores.trajectory import analyze_many
+
 
 def format_time(seconds):
     hours = seconds // 3600
@@ -13,6 +15,21 @@ def format_time(seconds):
     return f"{int(hours)}h {int(minutes)}m {int(seconds)}s"
 
 
+def summarize_analytics(analytics):
+    # Totals over every tag in the file for the summary box
+    return {
+        "distance_km": round(sum(a["distance_meters"] for a in analytics.values()) / 1000, 2),
+        "max_speed_kmh": round(max((a["max_speed"] for a in analytics.values()), default=0) * 3.6, 1),
+        "moving_time": format_time(sum(a["moving_seconds"] for a in analytics.values())),
+        "stops": sum(len(a["stops"]) for a in analytics.values()),
+        "longest_stop": format_time(
+            max((stop["dwell_seconds"] for a in analytics.values() for stop in a["stops"]), default=0)
+        ),
+        "trips": sum(len(a["trips"]) for a in analytics.values()),
+        "rejected": sum(a["rejected"] for a in analytics.values()),
+    }
+
+
 def process_location_data(file_path):
     with open(file_path, "r") as file:
         data = json.load(file)
@@ -38,6 +55,15 @@ def process_location_data(file_path):
 
     ping_count = df.shape[0]
 
+    # Per tag, a file may hold the reports of several tags labelled by key
+    analytics = analyze_many(
+        df["key"] if "key" in df else [""] * ping_count,
+        df["timestamp"],
+        df["lat"],
+        df["lon"],
+        df["conf"] if "conf" in df else None,
+    )
+
     return {
         "df": df,
         "start_timestamp": start_timestamp,
@@ -46,6 +72,7 @@ def process_location_data(file_path):
         "ping_count": ping_count,
         "formatted_total_time": formatted_total_time,
         "formatted_avg_time": formatted_avg_time,
+        "analytics": analytics,
     }
 
 
@@ -58,6 +85,9 @@ def generate_map(
     formatted_avg_time,
     simple_start_timestamp,
     save,
+    map_prefix="",
+    analytics=None,
+    heat=None,
 ):
     map_center = [df.iloc[0]["lat"], df.iloc[0]["lon"]]
     m = folium.Map(
@@ -67,52 +97,71 @@ def generate_map(
         attr="&copy; <a href='https://www.openstreetmap.org/copyright'>OpenStreetMap</a> contributors &copy; <a href='https://carto.com/'>CARTO</a>",
     )
 
-    latlon_pairs = list(zip(df["lat"], df["lon"]))
-    ant_path = AntPath(
-        locations=latlon_pairs,
-        dash_array=[10, 20],
-        delay=1000,
-        color="red",
-        weight=5,
-        pulse_color="black",
-    )
-    m.add_child(ant_path)
+    if not heat:
+        latlon_pairs = list(zip(df["lat"], df["lon"]))
+        ant_path = AntPath(
+            locations=latlon_pairs,
+            dash_array=[10, 20],
+            delay=1000,
+            color="red",
+            weight=5,
+            pulse_color="black",
+        )
+        m.add_child(ant_path)
+        rows = df.iterrows()
+    else:
+        # Weeks of pings as [lat, lon, weight] cells, only the start and end keep a marker
+        HeatMap(heat, name="Heatmap", radius=15, blur=10, min_opacity=0.3).add_to(m)
+        rows = df.iloc[[0, -1]].iterrows() if len(df) > 1 else df.iterrows()
 
     # Location markers look good, click to see timestamp
-    for index, row in df.iterrows():
+    for index, row in rows:
+        # Reverse geocoded when a gazetteer was installed, NaN for reports stored before
+        place = row.get("place")
+        place = f"<br>{place}" if isinstance(place, str) else ""
         if index == 0:  # First marker
             folium.Marker(
                 [row["lat"], row["lon"]],
-                popup=f"Timestamp: {row['isodatetime']} Start Point",
+                popup=f"Timestamp: {row['isodatetime']} Start Point{place}",
                 tooltip=f"Start Point",
                 icon=folium.Icon(color="green"),
             ).add_to(m)
         elif index == len(df) - 1:  # Last marker
             folium.Marker(
                 [row["lat"], row["lon"]],
-                popup=f"Timestamp: {row['isodatetime']} End Point",
+                popup=f"Timestamp: {row['isodatetime']} End Point{place}",
                 tooltip=f"End Point",
                 icon=folium.Icon(color="red"),
             ).add_to(m)
         else:  # Other markers
             folium.Marker(
                 [row["lat"], row["lon"]],
-                popup=f"Timestamp: {row['isodatetime']}",
+                popup=f"Timestamp: {row['isodatetime']}{place}",
                 tooltip=f"Point {index+1}",
             ).add_to(m)
 
+    analytics_html = ""
+    if analytics:
+        totals = summarize_analytics(analytics)
+        analytics_html = (
+            f"Distance: {totals['distance_km']} km, Max Speed: {totals['max_speed_kmh']} km/h<br>"
+            f"Moving Time: {totals['moving_time']}<br>"
+            f"Stops: {totals['stops']} (longest {totals['longest_stop']}), Trips: {totals['trips']}<br>"
+            f"Rejected Pings: {totals['rejected']}<br>"
+        )
+
     title_and_info_html = f"""
 <body style="background-color: #121212; color: white;">
 
     <h3 align="center" style="font-size:20px; margin-top:10px; color: white;"><b>FindMy Flipper Location Mapper</b></h3>
-    <div style="position: fixed; bottom: 50px; left: 50px; width: 300px; height: 160px; z-index:9999; font-size:14px; background-color: #2e2e2e; padding: 10px; border-radius: 10px; box-shadow: 0 0 5px rgba(0,0,0,0.5); color: white;">
+    <div style="position: fixed; bottom: 50px; left: 50px; width: 300px; height: {240 if analytics_html else 160}px; z-index:9999; font-size:14px; background-color: #2e2e2e; padding: 10px; border-radius: 10px; box-shadow: 0 0 5px rgba(0,0,0,0.5); color: white;">
         <b>Location Summary</b><br>
         Start: {start_timestamp}<br>
         End: {end_timestamp}<br>
         Number of Location Pings: {ping_count}<br>
         Total Time: {formatted_total_time}<br>
         Average Time Between Pings: {formatted_avg_time}<br>
-        Created by Matthew KuKanich and luu176<br>
+        {analytics_html}        Created by Matthew KuKanich and luu176<br>
     </div>
 
 </body>
@@ -120,7 +169,7 @@ def generate_map(
      """
     m.get_root().html.add_child(folium.Element(title_and_info_html))
     if save:
-        base_filename = f"LocationMap_{simple_start_timestamp}"
+        base_filename = f"{map_prefix}LocationMap_{simple_start_timestamp}"
         extension = "html"
         counter = 1
         filename = f"{base_filename}.{extension}"
@@ -132,7 +181,7 @@ def generate_map(
     return m.get_root().render()  # Return HTML
 
 
-def main(file_path, save=True):
+def main(file_path, save=True, map_prefix="", heat=None):
     location_data = process_location_data(file_path)
 
     if "error" in location_data:
@@ -148,6 +197,9 @@ def main(file_path, save=True):
         location_data["formatted_avg_time"],
         location_data["simple_start_timestamp"],
         save=save,
+        map_prefix=map_prefix,
+        analytics=location_data["analytics"],
+        heat=heat,
     )
 
     return html
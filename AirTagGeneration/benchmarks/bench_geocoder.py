@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# Reverse geocoding lookups per second against a synthetic gazetteer, for tracks that revisit the same cells and
+# for scattered points that mostly miss the cache, run from AirTagGeneration with:
+#   python -m benchmarks.bench_geocoder --places 100000 --points 1000000
+import argparse
+import json
+import time
+
+import numpy as np
+
+import cores.geocoder
+from cores.geocoder import Geocoder
+
+
+def timed(func, count):
+    start = time.perf_counter()
+    value = func()
+    elapsed = time.perf_counter() - start
+    return value, {
+        "seconds": round(elapsed, 6),
+        "lookups_per_second": round(count / elapsed, 2) if elapsed else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--places", help="gazetteer entries", type=int, default=100000)
+    parser.add_argument("-p", "--points", help="positions looked up per run", type=int, default=1000000)
+    parser.add_argument("-t", "--tags", help="tracks the positions are spread over", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--out", help="also write the JSON results to this file")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    # Places clustered around a few hundred towns, like a real gazetteer
+    towns = np.column_stack((rng.uniform(35, 60, 300), rng.uniform(-10, 30, 300)))
+    picks = towns[rng.integers(0, len(towns), args.places)]
+    lats, lons = picks[:, 0] + rng.normal(0, 0.1, args.places), picks[:, 1] + rng.normal(0, 0.1, args.places)
+    places = [f"place-{i}" for i in range(args.places)]
+
+    results = {"places": args.places, "points": args.points, "index": "kdtree" if cores.geocoder.cKDTree else "grid"}
+    start = time.perf_counter()
+    geocoder = Geocoder(lats, lons, places)
+    results["build_seconds"] = round(time.perf_counter() - start, 6)
+
+    # Tags wandering slowly around towns, most positions fall into cells seen before
+    per_tag = args.points // args.tags
+    origins = np.repeat(towns[rng.integers(0, len(towns), args.tags)], per_tag, axis=0)
+    walk = np.cumsum(rng.normal(0, 0.0003, (args.tags, per_tag, 2)), axis=1).reshape(-1, 2)
+    track_lats, track_lons = origins[:, 0] + walk[:, 0], origins[:, 1] + walk[:, 1]
+    _, results["tracks_cold"] = timed(lambda: geocoder.lookup_many(track_lats, track_lons), len(track_lats))
+    results["tracks_cold"]["cells"] = len(geocoder.cache)
+    _, results["tracks_warm"] = timed(lambda: geocoder.lookup_many(track_lats, track_lons), len(track_lats))
+    single = min(len(track_lats), 100000)
+    _, results["tracks_warm_single"] = timed(
+        lambda: [geocoder.lookup(lat, lon) for lat, lon in zip(track_lats[:single].tolist(), track_lons[:single].tolist())],
+        single,
+    )
+
+    # Scattered positions, nearly every one a new cell and an index query
+    scattered = min(args.points, 100000)
+    geocoder.cache.clear()
+    _, results["scattered_cold"] = timed(
+        lambda: geocoder.lookup_many(rng.uniform(35, 60, scattered), rng.uniform(-10, 30, scattered)), scattered
+    )
+
+    print(json.dumps(results, indent=4))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
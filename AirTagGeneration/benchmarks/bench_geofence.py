@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# Point-in-fence checks per second with the grid index against testing every fence, and the cost of evaluating
+# a sync's positions into enter and exit events, run from AirTagGeneration with:
+#   python -m benchmarks.bench_geofence --fences 1000 --points 100000
+import argparse
+import base64
+import json
+import math
+import random
+import sqlite3
+import time
+
+from cores.geofence import Fence, GeofenceIndex, add_fence, create_geofence_tables, evaluate
+from cores.report_db import create_tables, tag_id_for
+
+# Fences and points are spread over a box of this many degrees, about a metropolitan area
+REGION = (52.3, 13.0, 52.7, 13.8)
+
+
+def random_fence(rng, fence_id, polygon_ratio):
+    lat, lon = rng.uniform(REGION[0], REGION[2]), rng.uniform(REGION[1], REGION[3])
+    radius = rng.uniform(50, 2000)
+    if rng.random() >= polygon_ratio:
+        return Fence(fence_id, f"circle-{fence_id}", "circle", {"lat": lat, "lon": lon, "radius": radius})
+    # Star shaped, so the polygon is simple whatever the corner count
+    corners = rng.randint(4, 16)
+    points = []
+    for i in range(corners):
+        angle = 2 * math.pi * i / corners
+        r = radius * rng.uniform(0.4, 1) / 111320
+        points.append([lat + r * math.sin(angle), lon + r * math.cos(angle) / math.cos(math.radians(lat))])
+    return Fence(fence_id, f"polygon-{fence_id}", "polygon", {"points": points})
+
+
+def timed(func, points):
+    start = time.perf_counter()
+    results = [func(lat, lon) for lat, lon in points]
+    elapsed = time.perf_counter() - start
+    return results, {
+        "seconds": round(elapsed, 6),
+        "points_per_second": round(len(points) / elapsed, 2) if elapsed else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--fences", help="number of synthetic fences", type=int, default=1000)
+    parser.add_argument("-p", "--points", help="number of points checked", type=int, default=100000)
+    parser.add_argument("--polygon-ratio", help="share of polygon fences", type=float, default=0.5)
+    parser.add_argument("-t", "--tags", help="tags of the evaluate() run", type=int, default=50)
+    parser.add_argument("-n", "--reports", help="reports per tag of the evaluate() run", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--out", help="also write the JSON results to this file")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    fences = [random_fence(rng, i + 1, args.polygon_ratio) for i in range(args.fences)]
+    points = [(rng.uniform(REGION[0], REGION[2]), rng.uniform(REGION[1], REGION[3])) for _ in range(args.points)]
+    results = {"fences": args.fences, "points": args.points}
+
+    start = time.perf_counter()
+    index = GeofenceIndex(fences)
+    results["index_build_seconds"] = round(time.perf_counter() - start, 6)
+    results["index_cells"] = len(index.grid)
+
+    indexed, results["indexed"] = timed(index.containing, points)
+    brute, results["brute_force"] = timed(
+        lambda lat, lon: {fence.fence_id for fence in fences if fence.contains(lat, lon)}, points
+    )
+    results["speedup"] = round(results["brute_force"]["seconds"] / results["indexed"]["seconds"], 2)
+    results["matches_brute_force"] = indexed == brute
+    results["mean_candidates"] = round(sum(len(index.candidates(lat, lon)) for lat, lon in points) / len(points), 2)
+
+    # A sync's worth of new positions through evaluate(), state and events included
+    sq3 = sqlite3.connect(":memory:").cursor()
+    create_tables(sq3)
+    create_geofence_tables(sq3)
+    for fence in fences:
+        add_fence(sq3, fence.name, fence.kind, fence.geometry)
+    positions = {}
+    for i in range(args.tags):
+        report_id = base64.b64encode(rng.randbytes(32)).decode("ascii")
+        tag_id_for(sq3, report_id)
+        lat, lon = rng.uniform(REGION[0], REGION[2]), rng.uniform(REGION[1], REGION[3])
+        positions[report_id] = []
+        for timestamp in range(args.reports):
+            # A random walk, so tags wander in and out of fences
+            lat += rng.gauss(0, 0.002)
+            lon += rng.gauss(0, 0.003)
+            positions[report_id].append({"timestamp": timestamp, "lat": lat, "lon": lon})
+    start = time.perf_counter()
+    events = evaluate(sq3, positions)
+    elapsed = time.perf_counter() - start
+    results["evaluate"] = {
+        "positions": args.tags * args.reports,
+        "events": events,
+        "seconds": round(elapsed, 6),
+        "positions_per_second": round(args.tags * args.reports / elapsed, 2) if elapsed else None,
+    }
+
+    print(json.dumps(results, indent=4))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# Heatmap cells of a long synthetic history: one-shot aggregation, the SQLite cache kept up to date day by day,
+# reading it back and rendering the map with markers versus the heat layer, run from AirTagGeneration with:
+#   python -m benchmarks.bench_heatmap --tags 50 --days 28
+import argparse
+import base64
+import json
+import os
+import sqlite3
+import tempfile
+import time
+
+import numpy as np
+
+import advanced_map_loc
+from benchmarks.bench_trajectory import synthesize_history
+from cores.heatmap import aggregate, cell_rows, create_heat_tables, heat_points, update
+from cores.report_db import create_tables, tag_id_for
+
+
+def timed(func, count):
+    start = time.perf_counter()
+    value = func()
+    elapsed = time.perf_counter() - start
+    return value, {
+        "seconds": round(elapsed, 6),
+        "reports_per_second": round(count / elapsed, 2) if elapsed else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--tags", help="number of synthetic tags", type=int, default=50)
+    parser.add_argument("-d", "--days", help="days of history per tag", type=int, default=28)
+    parser.add_argument("-i", "--interval", help="seconds between reports", type=int, default=5 * 60)
+    parser.add_argument("--map-points", help="reports drawn in the map comparison", type=int, default=3000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--out", help="also write the JSON results to this file")
+    args = parser.parse_args()
+
+    tags, timestamps, lats, lons, _ = synthesize_history(args.tags, args.days, args.interval, args.seed)
+    results = {"tags": args.tags, "reports": len(tags)}
+
+    cells, results["aggregate"] = timed(lambda: aggregate(tags, timestamps, lats, lons), len(tags))
+    results["aggregate"]["cells"] = len(cells["tags"])
+
+    with tempfile.TemporaryDirectory() as directory:
+        sq3db = sqlite3.connect(os.path.join(directory, "reports.db"))
+        sq3 = sq3db.cursor()
+        create_tables(sq3)
+        create_heat_tables(sq3)
+        ids = [base64.b64encode(i.to_bytes(32, "big")).decode("ascii") for i in range(args.tags)]
+        for report_id in ids:
+            tag_id_for(sq3, report_id)
+
+        # One sync per tag and day, as the service would run them
+        day = (timestamps // (24 * 60 * 60)).astype(np.int64)
+        order = np.lexsort((timestamps, day))
+        starts = np.flatnonzero(np.concatenate(([True], day[order][1:] != day[order][:-1])))
+
+        def incremental():
+            for batch in np.split(order, starts[1:]):
+                positions = {}
+                for tag, timestamp, lat, lon in zip(
+                    tags[batch].tolist(), timestamps[batch].tolist(), lats[batch].tolist(), lons[batch].tolist()
+                ):
+                    positions.setdefault(ids[tag], []).append({"timestamp": timestamp, "lat": lat, "lon": lon})
+                update(sq3, positions)
+            sq3db.commit()
+
+        _, results["incremental"] = timed(incremental, len(tags))
+        results["incremental"]["syncs"] = len(starts)
+        rows, results["read_cells"] = timed(lambda: cell_rows(sq3), len(tags))
+        results["read_cells"]["cells"] = len(rows["tags"])
+        results["cache_matches_aggregate"] = len(rows["tags"]) == len(cells["tags"]) and bool(
+            (np.sort(rows["counts"]) == np.sort(cells["counts"])).all()
+        )
+        sq3db.close()
+
+    # Markers for the latest reports against one heat layer over every cell
+    points = min(args.map_points, len(tags))
+    recent = np.argsort(timestamps)[-points:]
+    data = [
+        {"timestamp": timestamp, "isodatetime": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(timestamp)),
+         "lat": lat, "lon": lon, "key": str(tag)}
+        for tag, timestamp, lat, lon in zip(
+            tags[recent].tolist(), timestamps[recent].tolist(), lats[recent].tolist(), lons[recent].tolist()
+        )
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        json_path = os.path.join(directory, "data.json")
+        with open(json_path, "w") as f:
+            json.dump(data, f)
+        _, results["map_markers"] = timed(lambda: advanced_map_loc.main(json_path, save=False), points)
+        heat = heat_points(rows)
+        _, results["map_heat"] = timed(lambda: advanced_map_loc.main(json_path, save=False, heat=heat), points)
+        results["map_heat"]["cells"] = len(heat)
+
+    print(json.dumps(results, indent=4))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
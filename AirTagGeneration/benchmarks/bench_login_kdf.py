@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# Password derivation cost of a GSA login, run from AirTagGeneration with:
+#   python -m benchmarks.bench_login_kdf
+import argparse
+import hashlib
+import json
+import os
+import time
+
+from cores.pypush_gsa_icloud import derive_password_key, encrypt_password
+
+
+def legacy_encrypt_password(password, salt, iterations, hex=False):
+    # The pure-Python implementation used before, only available if pbkdf2 and pycryptodome are installed
+    import pbkdf2
+    from Crypto.Hash import SHA256
+
+    hash = hashlib.sha256(password.encode("utf-8"))
+    p = hash.hexdigest() if hex else hash.digest()
+    return pbkdf2.PBKDF2(p, salt, iterations, SHA256).read(32)
+
+
+def timed(func, rounds):
+    best = None
+    for _ in range(rounds):
+        derive_password_key.cache_clear()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--iterations", help="PBKDF2 iteration count sent by Apple", type=int, default=20000)
+    parser.add_argument("-r", "--rounds", help="best of this many runs", type=int, default=3)
+    args = parser.parse_args()
+
+    password, salt = "correct horse battery staple", os.urandom(16)
+    results = {"iterations": args.iterations}
+
+    # A login derives the key once, and once more after 2FA when the SRP flow is restarted
+    def login():
+        encrypt_password(password, salt, args.iterations, True)
+        encrypt_password(password, salt, args.iterations, True)
+
+    results["native_seconds"] = timed(lambda: encrypt_password(password, salt, args.iterations, True), args.rounds)
+    results["native_login_seconds"] = timed(login, args.rounds)
+
+    try:
+        expected = legacy_encrypt_password(password, salt, args.iterations, True)
+        results["legacy_seconds"] = timed(
+            lambda: legacy_encrypt_password(password, salt, args.iterations, True), args.rounds
+        )
+        results["legacy_login_seconds"] = 2 * results["legacy_seconds"]
+        results["speedup"] = results["legacy_login_seconds"] / results["native_login_seconds"]
+        derive_password_key.cache_clear()
+        results["matches_legacy"] = encrypt_password(password, salt, args.iterations, True) == expected
+    except ImportError:
+        results["legacy_seconds"] = None
+
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# End-to-end throughput of fetch, decrypt, store, publish and map render against synthetic reports, with fetch,
+# decrypt and store overlapped in the report pipeline the CLIs and the GUI run and measured per pipeline stage,
+# run from AirTagGeneration with:
+#   python -m benchmarks.bench_pipeline --tags 20 --reports 50 --out bench.json
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import RequestReportMap
+import cores.pypush_gsa_icloud
+from benchmarks.fake_upstream import FakeUpstream, StubBroker
+from benchmarks.synthetic import generate_tags, synthesize_reports, write_key_files
+from cores.auth_manager import AuthManager
+from cores.db_pool import ConnectionPool
+from cores.fusion import fuse_reports
+from cores.pipeline import chunked
+from cores.report_db import latest_positions
+from cores.sinks import MqttSink, create_outbox_table, deliver, enqueue
+
+
+def stage(results, name, items, func):
+    start = time.perf_counter()
+    value = func()
+    elapsed = time.perf_counter() - start
+    results[name] = {
+        "seconds": round(elapsed, 6),
+        "items": items(value) if callable(items) else items,
+    }
+    results[name]["items_per_second"] = round(results[name]["items"] / elapsed, 2) if elapsed else None
+    return value
+
+
+def fetch_all(auth_manager, ids, startdate, enddate, batch_size):
+    reports = []
+    for i in range(0, len(ids), batch_size):
+        data = {"search": [{"startDate": startdate * 1000, "endDate": enddate * 1000, "ids": ids[i:i + batch_size]}]}
+        response = auth_manager.fetch(data)
+        response.raise_for_status()
+        reports.extend(response.json()["results"])
+    return reports
+
+
+# web_service's tags table, the MQTT broker of every tag is read from it by MqttSink
+create_tags_query = """CREATE TABLE IF NOT EXISTS tags (
+hash_adv_key TEXT, private_key TEXT, friendly_name TEXT, mqtt_server TEXT, mqtt_port INTEGER, mqtt_over_tls BOOLEAN,
+mqtt_publish_encryption_key TEXT, mqtt_username TEXT, mqtt_userpass TEXT, mqtt_topic TEXT,
+PRIMARY KEY(private_key,mqtt_server));"""
+
+
+def register_tags(db, broker, names, privkeys):
+    # Every tag monitored through /KeyToMonitor/ with the stub broker as its MQTT server
+    with db.writer() as sq3:
+        sq3.execute(create_tags_query)
+        create_outbox_table(sq3)
+        sq3.executemany(
+            "INSERT OR REPLACE INTO tags (hash_adv_key, private_key, friendly_name, mqtt_server, mqtt_port, "
+            "mqtt_over_tls, mqtt_username, mqtt_userpass) VALUES (?, ?, ?, ?, ?, 0, 'bench', '')",
+            [(key, privkeys[key], name, broker.host, broker.port) for key, name in names.items()],
+        )
+
+
+def publish_latest(db, sinks):
+    # web_service's /Publish_MQTT/: the latest position of every tag queued in the outbox, then delivered
+    positions = latest_positions(db.reader())
+    names = dict(db.reader().execute("SELECT hash_adv_key, friendly_name FROM tags").fetchall())
+    events = sorted(
+        (
+            {"id": key, "name": name, "timestamp": positions[key]["timestamp"], "lat": positions[key]["lat"],
+             "lon": positions[key]["lon"], "conf": positions[key]["conf"], "status": positions[key]["status"],
+             "place": positions[key]["place"]}
+            for key, name in names.items()
+            if key in positions
+        ),
+        key=lambda event: event["timestamp"],
+    )
+    with db.writer() as sq3:
+        enqueue(sq3, sinks, events)
+    return asyncio.run(deliver(db, sinks))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--tags", help="number of synthetic tags", type=int, default=10)
+    parser.add_argument("-n", "--reports", help="reports per tag", type=int, default=100)
+    parser.add_argument("-H", "--hours", help="time span the reports are spread over", type=int, default=24)
+    parser.add_argument("-b", "--batch-size", help="ids per fetch request, 0 sends all at once", type=int, default=0)
+    parser.add_argument("--extra-byte-ratio", help="share of 89 byte payloads", type=float, default=0.5)
+    parser.add_argument("--no-map", help="skip the map render stage", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--out", help="also write the JSON results to this file")
+    args = parser.parse_args()
+
+    enddate = int(datetime.datetime.now().timestamp())
+    startdate = enddate - 60 * 60 * args.hours
+    results = {
+        "config": vars(args),
+        "python": platform.python_version(),
+        "timestamp": enddate,
+        "stages": {},
+    }
+    stages = results["stages"]
+
+    # Keep stdout for the JSON results, the pipeline prints progress of its own
+    with tempfile.TemporaryDirectory() as workdir, contextlib.redirect_stdout(sys.stderr):
+        setup = time.perf_counter()
+        tags = generate_tags(args.tags)
+        reports = synthesize_reports(tags, args.reports, startdate, enddate - 300, args.extra_byte_ratio, args.seed)
+        write_key_files(tags, os.path.join(workdir, "keys"))
+        privkeys, names = RequestReportMap.load_key_files("bench", os.path.join(workdir, "keys"))
+        results["setup_seconds"] = round(time.perf_counter() - setup, 6)
+
+        with open(os.path.join(workdir, "auth.json"), "w") as f:
+            json.dump({"dsid": "0", "searchPartyToken": "bench"}, f)
+
+        with FakeUpstream(reports) as upstream, StubBroker() as broker:
+            cores.pypush_gsa_icloud.ANISETTE_URL = upstream.url
+            auth_manager = AuthManager(config_path=os.path.join(workdir, "auth.json"), fetch_url=upstream.fetch_url)
+            ids = list(names.keys())
+
+            # Upstream alone, the floor of what the pipeline can reach
+            stage(stages, "fetch", len, lambda: fetch_all(
+                auth_manager, ids, startdate, enddate + 600, args.batch_size or len(ids)))
+            stages["fetch"]["requests"] = upstream.requests
+
+            # Fetch, dedupe, decrypt and store as RequestReportMap.py runs them, into a fresh database. A second
+            # account keeps the fetch above from eating the rate limiter's burst
+            pipelined_manager = AuthManager(config_path=os.path.join(workdir, "auth.json"), fetch_url=upstream.fetch_url)
+            pipeline = RequestReportMap.build_pipeline(names, privkeys, args.hours + 1, pool=pipelined_manager,
+                                                       db_path=os.path.join(workdir, "reports.db"))
+            pipelined = stage(stages, "pipeline", len, lambda: pipeline.run(chunked(ids, args.batch_size or len(ids))))
+            stages["pipeline"].update(pipeline.stats())
+
+            # A second sync of the same window reads every report back instead of decrypting it again
+            rerun = RequestReportMap.build_pipeline(names, privkeys, args.hours + 1, pool=pipelined_manager,
+                                                    db_path=os.path.join(workdir, "reports.db"))
+            stage(stages, "pipeline_stored", len, lambda: rerun.run(chunked(ids, args.batch_size or len(ids))))
+            stages["pipeline_stored"]["skipped_stored"] = rerun.counts["stored"]
+
+            ordered = sorted(pipelined, key=lambda tag: tag["timestamp"])
+            # Through the sink outbox and MqttSink, one connection for the batch of every tag's latest position
+            db = ConnectionPool(os.path.join(workdir, "reports.db"))
+            register_tags(db, broker, names, privkeys)
+            sinks = [MqttSink(db)]
+            published = stage(stages, "publish", lambda counts: counts["mqtt"][0], lambda: publish_latest(db, sinks))
+            stages["publish"]["failed"] = published["mqtt"][1]
+            stages["publish"]["broker_messages"] = broker.messages
+
+        if not args.no_map:
+            json_path = os.path.join(workdir, "data.json")
+            with open(json_path, "w") as f:
+                json.dump(ordered, f)
+            stage(stages, "map", len(ordered), lambda: RequestReportMap.advanced_map_loc.main(json_path, save=False))
+
+            # Reports of a tag within a minute fused into one position before rendering
+            fused = stage(stages, "fuse", len(ordered), lambda: fuse_reports(ordered))
+            stages["fuse"]["points"] = len(fused)
+            with open(json_path, "w") as f:
+                json.dump(fused, f)
+            stage(stages, "map_fused", len(fused), lambda: RequestReportMap.advanced_map_loc.main(json_path, save=False))
+
+    results["total_seconds"] = round(sum(s["seconds"] for s in stages.values()), 6)
+    output = json.dumps(results, indent=4)
+    print(output)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
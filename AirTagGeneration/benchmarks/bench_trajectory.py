@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# Trajectory analytics over a long synthetic history of many tags, run from AirTagGeneration with:
+#   python -m benchmarks.bench_trajectory --tags 300 --days 365
+import argparse
+import json
+import time
+
+import numpy as np
+
+from cores.trajectory import analyze_many
+
+
+def synthesize_history(tags, days, interval, seed):
+    # Each tag alternates between staying put and driving off, reported every interval seconds
+    rng = np.random.default_rng(seed)
+    per_tag = days * 24 * 60 * 60 // interval
+    n = tags * per_tag
+    moving = np.repeat(rng.random(n // 12 + 1) < 0.3, 12)[:n]
+    step = np.where(moving, 0.004, 0.0002)
+    lats = 52 + np.cumsum(rng.normal(0, 1, n) * step)
+    lons = 13 + np.cumsum(rng.normal(0, 1, n) * step)
+    timestamps = np.tile(np.arange(per_tag) * interval, tags) + rng.integers(0, 60, n)
+    return (
+        np.repeat(np.arange(tags), per_tag),
+        timestamps,
+        lats,
+        lons,
+        rng.integers(0, 255, n),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--tags", help="number of synthetic tags", type=int, default=300)
+    parser.add_argument("-d", "--days", help="days of history per tag", type=int, default=365)
+    parser.add_argument("-i", "--interval", help="seconds between reports", type=int, default=15 * 60)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--out", help="also write the JSON results to this file")
+    args = parser.parse_args()
+
+    history = synthesize_history(args.tags, args.days, args.interval, args.seed)
+    start = time.perf_counter()
+    summaries = analyze_many(*history)
+    elapsed = time.perf_counter() - start
+
+    results = {
+        "tags": args.tags,
+        "reports": len(history[0]),
+        "seconds": round(elapsed, 6),
+        "reports_per_second": round(len(history[0]) / elapsed, 2) if elapsed else None,
+        "rejected": sum(summary["rejected"] for summary in summaries.values()),
+        "stops": sum(len(summary["stops"]) for summary in summaries.values()),
+        "trips": sum(len(summary["trips"]) for summary in summaries.values()),
+    }
+    print(json.dumps(results, indent=4))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+# Local stand-ins for acsnservice/fetch, the anisette server, an MQTT broker and HTTP receivers
+import base64
+import json
+import os
+import socketserver
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeUpstream:
+    """Serves synthetic reports the way gateway.icloud.com/acsnservice/fetch does.
+
+    POST /acsnservice/fetch filters by ids and datePublished range, GET / answers
+    like an anisette server so generate_anisette_headers() works without pyprovision.
+    """
+
+    def __init__(self, reports, host="127.0.0.1", port=0):
+        self.reports = defaultdict(list)
+        for report in reports:
+            self.reports[report["id"]].append(report)
+        self.requests = 0
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, status, body):
+                content = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                self.send_json(200, {
+                    "X-Apple-I-MD": base64.b64encode(os.urandom(16)).decode(),
+                    "X-Apple-I-MD-M": base64.b64encode(os.urandom(60)).decode(),
+                })
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                data = json.loads(self.rfile.read(length))
+                upstream.requests += 1
+                if self.path.rstrip("/") != "/acsnservice/fetch":
+                    self.send_json(404, {"statusCode": "404"})
+                    return
+                results = []
+                for search in data["search"]:
+                    for id in search["ids"]:
+                        results.extend(report for report in upstream.reports.get(id, ())
+                                       if search["startDate"] <= report["datePublished"] <= search["endDate"])
+                self.send_json(200, {"results": results, "statusCode": "200"})
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+        self.fetch_url = self.url + "/acsnservice/fetch"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class StubBroker:
+    """Just enough MQTT 3.1.1 to accept the QoS 1 publishes paho sends: CONNACK, PUBACK and PINGRESP."""
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.messages = 0
+        broker = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def read(self, n):
+                data = b""
+                while len(data) < n:
+                    chunk = self.request.recv(n - len(data))
+                    if not chunk:
+                        raise ConnectionError
+                    data += chunk
+                return data
+
+            def handle(self):
+                try:
+                    while True:
+                        header = self.read(1)[0]
+                        length, shift = 0, 0
+                        while True:
+                            byte = self.read(1)[0]
+                            length |= (byte & 0x7F) << shift
+                            shift += 7
+                            if not byte & 0x80:
+                                break
+                        body = self.read(length)
+                        packet_type, qos = header >> 4, (header >> 1) & 0x03
+                        if packet_type == 1:
+                            self.request.sendall(b"\x20\x02\x00\x00")
+                        elif packet_type == 3:
+                            broker.messages += 1
+                            if qos:
+                                topic_length = int.from_bytes(body[0:2], "big")
+                                self.request.sendall(b"\x40\x02" + body[2 + topic_length:4 + topic_length])
+                        elif packet_type == 12:
+                            self.request.sendall(b"\xd0\x00")
+                        elif packet_type == 14:
+                            return
+                except (ConnectionError, OSError):
+                    return
+
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.host, self.port = host, self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class StubReceiver:
+    """Records the JSON bodies POSTed to it, like a webhook or OwnTracks Recorder would receive them.
+
+    The next fail requests are answered with 503, every request is delayed by delay seconds.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, fail=0, delay=0):
+        self.received = []
+        self.fail = fail
+        self.delay = delay
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                time.sleep(receiver.delay)
+                if receiver.fail > 0:
+                    receiver.fail -= 1
+                    status = 503
+                else:
+                    receiver.received.append({"path": self.path, "headers": dict(self.headers), "body": body})
+                    status = 200
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,81 @@
+# Synthetic tags and correctly encrypted location reports, so the pipeline can be exercised without Apple
+import base64
+import hashlib
+import math
+import os
+import random
+import struct
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from cores.report_crypto import APPLE_EPOCH
+
+
+def generate_tag(name):
+    # Same key material generate_keys.py writes to a .keys file
+    private_key = ec.generate_private_key(ec.SECP224R1(), default_backend())
+    private_key_bytes = private_key.private_numbers().private_value.to_bytes(28, byteorder="big")
+    public_key_bytes = private_key.public_key().public_numbers().x.to_bytes(28, byteorder="big")
+    return {
+        "name": name,
+        "private_key": base64.b64encode(private_key_bytes).decode("ascii"),
+        "advertisement_key": base64.b64encode(public_key_bytes).decode("ascii"),
+        "hashed_adv_key": base64.b64encode(hashlib.sha256(public_key_bytes).digest()).decode("ascii"),
+        "public_key": private_key.public_key(),
+    }
+
+
+def generate_tags(count, prefix="bench"):
+    return [generate_tag(f"{prefix}_{i:05d}") for i in range(count)]
+
+
+def write_key_files(tags, directory):
+    os.makedirs(directory, exist_ok=True)
+    for tag in tags:
+        with open(os.path.join(directory, tag["name"] + ".keys"), "w") as f:
+            f.write(f"Private key: {tag['private_key']}\n")
+            f.write(f"Advertisement key: {tag['advertisement_key']}\n")
+            f.write(f"Hashed adv key: {tag['hashed_adv_key']}\n")
+
+
+def encrypt_report(tag, timestamp, lat, lon, conf=50, status=0, extra_byte=False):
+    """Build a payload the way a finder device does, 88 bytes or 89 with extra_byte."""
+    ephemeral = ec.generate_private_key(ec.SECP224R1(), default_backend())
+    ephemeral_bytes = ephemeral.public_key().public_bytes(
+        serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint
+    )
+    shared_key = ephemeral.exchange(ec.ECDH(), tag["public_key"])
+    symmetric_key = hashlib.sha256(shared_key + b"\x00\x00\x00\x01" + ephemeral_bytes).digest()
+
+    clear_text = struct.pack(">ii", int(lat * 10000000), int(lon * 10000000)) + bytes([conf, status])
+    # AESGCM appends the 16 byte auth tag to the 10 byte cipher text
+    encrypted = AESGCM(symmetric_key[:16]).encrypt(symmetric_key[16:], clear_text, None)
+
+    header = (timestamp - APPLE_EPOCH).to_bytes(4, "big") + bytes([conf])
+    if extra_byte:
+        header += b"\x00"
+    return base64.b64encode(header + ephemeral_bytes + encrypted).decode("ascii")
+
+
+def synthesize_reports(tags, per_tag, start, end, extra_byte_ratio=0.5, seed=0):
+    """Random walk per tag between start and end (unix seconds), mixing both payload layouts."""
+    rng = random.Random(seed)
+    reports = []
+    for tag in tags:
+        lat, lon = rng.uniform(-60, 60), rng.uniform(-170, 170)
+        for i in range(per_tag):
+            timestamp = start + (end - start) * i // max(per_tag, 1)
+            lat += rng.gauss(0, 0.001)
+            lon += rng.gauss(0, 0.001) / max(math.cos(math.radians(lat)), 0.1)
+            reports.append({
+                "datePublished": (timestamp + rng.randint(0, 300)) * 1000,
+                "payload": encrypt_report(tag, timestamp, lat, lon, rng.randint(10, 150), 0,
+                                          rng.random() < extra_byte_ratio),
+                "description": "found",
+                "id": tag["hashed_adv_key"],
+                "statusCode": 0,
+            })
+    return reports
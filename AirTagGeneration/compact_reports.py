@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import sqlite3
+
+from cores.report_db import DB_PATH, create_tables
+from cores.retention import run_retention
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Downsample old reports into hourly/daily aggregates and reclaim space in reports.db. "
+                    "Meant to be run periodically, e.g. from cron."
+    )
+    parser.add_argument(
+        "-d", "--raw-days", help="keep raw reports for this many days", type=int, default=30
+    )
+    parser.add_argument(
+        "--drop-payloads", help="clear the encrypted payload of already decoded reports", action="store_true"
+    )
+    parser.add_argument(
+        "--no-vacuum", help="skip the incremental vacuum", action="store_true"
+    )
+    parser.add_argument(
+        "--vacuum-pages", help="free at most this many pages per run, 0 frees all", type=int, default=0
+    )
+    parser.add_argument("--db", help="path to reports.db", default=DB_PATH)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    sq3db = sqlite3.connect(args.db)
+    create_tables(sq3db.cursor())
+    stats = run_retention(
+        sq3db,
+        args.raw_days,
+        drop_raw_payloads=args.drop_payloads,
+        vacuum=not args.no_vacuum,
+        vacuum_pages=args.vacuum_pages,
+    )
+    sq3db.close()
+
+    print(f"{stats['reports_expired']} reports folded into aggregates, "
+          f"{stats['bytes_reclaimed'] / 1024 / 1024:.2f} MiB reclaimed.")
+    print(json.dumps(stats))
+
+
+if __name__ == "__main__":
+    main()
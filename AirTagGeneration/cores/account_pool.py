@@ -0,0 +1,192 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from cores.auth_manager import AUTH_PATH, AuthManager
+
+# keys/auth.json plus any number of keys/auth_<name>.json, one per Apple account
+AUTH_GLOB = os.path.dirname(AUTH_PATH) + "/auth*.json"
+
+# An account that keeps failing is skipped for a while, doubling up to this many seconds
+MAX_COOLDOWN = 600
+# ids per request when spreading over the least loaded accounts
+CHUNK_SIZE = 32
+
+
+class Account:
+    def __init__(self, manager):
+        self.manager = manager
+        self.name = manager.name
+        self.in_flight = 0
+        self.failures = 0
+        self.cooldown_until = 0
+
+    def healthy(self):
+        return time.monotonic() >= self.cooldown_until
+
+    def load(self):
+        # Seconds of work already queued on this account at its current rate
+        return self.manager.limiter.backlog() + self.in_flight / self.manager.limiter.rate
+
+
+class AccountPool:
+    """Spreads acsnservice/fetch requests over several Apple accounts.
+
+    Behaves like a single AuthManager (get, refresh, fetch). With "shard" scheduling a
+    tag always goes to the same account, chosen by hashing its id, with "least_loaded"
+    ids are cut into chunks handed to whichever account has the least queued work.
+    Each account keeps its own token, rate limiter and health: a failed request is
+    retried on another account and the failing one cools down before it is used again.
+    When only some shards fail on every account, fetch() still returns the reports of
+    the others, with the ids it could not fetch listed under "failed".
+    """
+
+    def __init__(self, managers, schedule="shard", chunk_size=CHUNK_SIZE):
+        if schedule not in ("shard", "least_loaded"):
+            raise ValueError(f"Unknown schedule {schedule}")
+        self.accounts = [Account(manager) for manager in managers]
+        self.schedule = schedule
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(len(self.accounts), 1), thread_name_prefix="account")
+
+    @classmethod
+    def load(cls, pattern=AUTH_GLOB, schedule="shard", **kwargs):
+        paths = sorted(glob.glob(pattern)) or [AUTH_PATH]
+        return cls([AuthManager(config_path=path, **kwargs) for path in paths], schedule)
+
+    @property
+    def second_factor(self):
+        return self.accounts[0].manager.second_factor
+
+    @second_factor.setter
+    def second_factor(self, second_factor):
+        for account in self.accounts:
+            account.manager.second_factor = second_factor
+
+    def get(self):
+        auths = [account.manager.get() for account in self.accounts]
+        return auths[0]
+
+    def refresh(self):
+        auths = [account.manager.refresh() for account in self.accounts]
+        return auths[0]
+
+    def _candidates(self, exclude=()):
+        accounts = [account for account in self.accounts if account not in exclude]
+        # Rather try an unhealthy account than none at all
+        return [account for account in accounts if account.healthy()] or accounts
+
+    def _assign(self, ids):
+        accounts = self._candidates()
+        shards = {}
+        if self.schedule == "shard":
+            for id in ids:
+                account = accounts[int.from_bytes(hashlib.sha256(id.encode()).digest()[:8], "big") % len(accounts)]
+                shards.setdefault(account, []).append(id)
+            return list(shards.items())
+
+        chunks = []
+        with self._lock:
+            planned = {account: account.load() for account in accounts}
+            for i in range(0, len(ids), self.chunk_size):
+                account = min(accounts, key=planned.get)
+                planned[account] += 1 / account.manager.limiter.rate
+                chunks.append((account, ids[i:i + self.chunk_size]))
+        return chunks
+
+    def _post(self, account, data):
+        with self._lock:
+            account.in_flight += 1
+        try:
+            response = account.manager.fetch(data)
+        except requests.RequestException:
+            self._record(account, False)
+            raise
+        finally:
+            with self._lock:
+                account.in_flight -= 1
+        self._record(account, response.status_code == 200)
+        return response
+
+    def _record(self, account, ok):
+        with self._lock:
+            if ok:
+                account.failures = 0
+                account.cooldown_until = 0
+            else:
+                account.failures += 1
+                account.cooldown_until = time.monotonic() + min(MAX_COOLDOWN, 30 * 2 ** (account.failures - 1))
+                logging.warning(f"Account {account.name} failed {account.failures} time(s), cooling down")
+
+    def _fetch_shard(self, account, search, ids):
+        data = {"search": [dict(search, ids=ids)]}
+        tried = []
+        while True:
+            tried.append(account)
+            error = response = None
+            try:
+                response = self._post(account, data)
+                if response.status_code == 200:
+                    return response
+            except requests.RequestException as e:
+                error = e
+            others = self._candidates(exclude=tried)
+            if not others:
+                if error is not None:
+                    raise error
+                return response
+            account = min(others, key=Account.load)
+
+    def fetch(self, data):
+        if len(self.accounts) == 1:
+            return self._post(self.accounts[0], data)
+
+        shards = [(self._executor.submit(self._fetch_shard, account, search, ids), ids)
+                  for search in data["search"] for account, ids in self._assign(search["ids"])]
+        if not shards:
+            return self._post(self.accounts[0], data)
+
+        # A shard that failed on every account does not cost the others their reports, its ids are listed as failed
+        results, failed, errors = [], [], []
+        for future, ids in shards:
+            try:
+                response = future.result()
+            except requests.RequestException as e:
+                errors.append(e)
+                failed.extend(ids)
+                continue
+            if response.status_code != 200:
+                errors.append(response)
+                failed.extend(ids)
+                continue
+            results.extend(json.loads(response.content.decode())["results"])
+        if len(errors) == len(shards):
+            if isinstance(errors[0], Exception):
+                raise errors[0]
+            return errors[0]
+        if failed:
+            logging.warning(f"{len(failed)} id(s) could not be fetched from any account, returning the other shards")
+
+        merged = requests.Response()
+        merged.status_code = 200
+        merged.headers["Content-Type"] = "application/json"
+        merged._content = json.dumps({"results": results, "statusCode": "200", "failed": failed}).encode()
+        return merged
+
+
+account_pool = AccountPool.load()
+
+
+def getAuth(regenerate=False, second_factor="sms"):
+    account_pool.second_factor = second_factor
+    if regenerate:
+        return account_pool.refresh()
+    return account_pool.get()
@@ -0,0 +1,115 @@
+import json
+import os
+import threading
+import time
+
+import requests
+
+from cores.metrics import (ANISETTE_SECONDS, UPSTREAM_FETCH_SECONDS, UPSTREAM_QUEUE_SECONDS, UPSTREAM_RATE,
+                           UPSTREAM_RETRIES)
+from cores.pypush_gsa_icloud import icloud_login_mobileme, generate_anisette_headers
+from cores.rate_limiter import THROTTLE_STATUS, RateLimiter, retry_after_seconds
+
+AUTH_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__))) + "/keys/auth.json"
+FETCH_URL = "https://gateway.icloud.com/acsnservice/fetch"
+
+# Apple answers with these once the searchPartyToken has expired
+AUTH_EXPIRED_STATUS = (401, 403)
+# Replays of a throttled fetch before its answer is handed back to the caller
+MAX_THROTTLE_RETRIES = 3
+
+
+class AuthManager:
+    """Caches (dsid, searchPartyToken) in memory and re-logs in once when Apple rejects it.
+
+    Every fetch goes through fetch(), which replays the request after a refresh. The
+    generation counter makes concurrent callers that saw the same expired token share
+    a single login instead of each starting their own. Every request to Apple waits for
+    the account's rate limiter, throttled requests are replayed once it lets them through.
+    """
+
+    def __init__(self, config_path=AUTH_PATH, login=icloud_login_mobileme, second_factor="sms", fetch_url=FETCH_URL,
+                 limiter=None):
+        self.config_path = config_path
+        self.name = os.path.splitext(os.path.basename(config_path))[0]
+        self.fetch_url = fetch_url
+        self.limiter = limiter or RateLimiter()
+        self.login = login
+        self.second_factor = second_factor
+        self._lock = threading.Lock()
+        self._auth = None
+        self._generation = 0
+
+    def _read_config(self):
+        if not os.path.exists(self.config_path):
+            return None
+        with open(self.config_path, "r") as f:
+            j = json.load(f)
+        return (j["dsid"], j["searchPartyToken"])
+
+    def _login(self):
+        mobileme = self.login(second_factor=self.second_factor)
+        j = {
+            "dsid": mobileme["dsid"],
+            "searchPartyToken": mobileme["delegates"]["com.apple.mobileme"]["service-data"]["tokens"][
+                "searchPartyToken"
+            ],
+        }
+        with open(self.config_path, "w") as f:
+            json.dump(j, f)
+        return (j["dsid"], j["searchPartyToken"])
+
+    def _current(self):
+        with self._lock:
+            if self._auth is None:
+                self._auth = self._read_config() or self._login()
+            return self._auth, self._generation
+
+    def get(self):
+        return self._current()[0]
+
+    def refresh(self, stale_generation=None):
+        with self._lock:
+            if stale_generation is not None and stale_generation != self._generation:
+                # Someone else already refreshed while we were waiting for the lock
+                return self._auth
+            stale = self._auth
+            on_disk = self._read_config()
+            if stale_generation is not None and on_disk is not None and on_disk != stale:
+                # Another process logged in and saved a newer token
+                self._auth = on_disk
+            else:
+                self._auth = self._login()
+            self._generation += 1
+            return self._auth
+
+    def post(self, auth, data):
+        UPSTREAM_QUEUE_SECONDS.observe(self.limiter.acquire())
+        with ANISETTE_SECONDS.time():
+            headers = generate_anisette_headers()
+        start = time.perf_counter()
+        try:
+            response = requests.post(self.fetch_url, auth=auth, headers=headers, json=data)
+        except requests.RequestException:
+            UPSTREAM_FETCH_SECONDS.labels(status="error").observe(time.perf_counter() - start)
+            self.limiter.record(None)
+            raise
+        UPSTREAM_FETCH_SECONDS.labels(status=str(response.status_code)).observe(time.perf_counter() - start)
+        self.limiter.record(response.status_code, retry_after_seconds(response))
+        UPSTREAM_RATE.labels(account=self.name).set(self.limiter.rate)
+        return response
+
+    def fetch(self, data):
+        auth, generation = self._current()
+        response = self.post(auth, data)
+        refreshed = False
+        for _ in range(MAX_THROTTLE_RETRIES + 1):
+            if response.status_code in AUTH_EXPIRED_STATUS and not refreshed:
+                auth, refreshed = self.refresh(generation), True
+            elif response.status_code in THROTTLE_STATUS:
+                UPSTREAM_RETRIES.labels(status=str(response.status_code)).inc()
+            else:
+                break
+            response = self.post(auth, data)
+        return response
+
@@ -0,0 +1,110 @@
+import asyncio
+import datetime
+import threading
+
+from cores.metrics import STREAM_CLIENTS, STREAM_EVENTS
+from cores.report_db import latest_positions
+
+# Events buffered per client, a client that falls this far behind is disconnected
+CLIENT_QUEUE = 256
+# How often latest_position is checked for reports written by other processes
+POLL_SECONDS = 5
+
+# Queued in place of the backlog of a client that was too slow
+DROPPED = None
+
+
+class Subscription:
+    def __init__(self, report_ids, maxsize):
+        self.report_ids = set(report_ids) if report_ids else None
+        self.queue = asyncio.Queue(maxsize)
+        self.dropped = False
+
+    def wants(self, report_id):
+        return self.report_ids is None or report_id in self.report_ids
+
+    async def get(self):
+        # (kind, report_id, data) or DROPPED
+        return await self.queue.get()
+
+
+class BroadcastHub:
+    """Fans new positions out to every subscribed stream client from one place in the process.
+
+    Events are positions or, with kind "geofence", fence transitions. publish() may be
+    called from any thread, delivery happens on the event loop the clients subscribed
+    from. Each client has a bounded queue, one that fills up is dropped instead of
+    holding back the others or growing without bound. poll() picks up positions written
+    by other processes, e.g. sync_worker.py or a second uvicorn worker, from
+    latest_position.
+    """
+
+    def __init__(self, maxsize=CLIENT_QUEUE):
+        self.maxsize = maxsize
+        self.subscriptions = set()
+        self.loop = None
+        self._lock = threading.Lock()
+        self._last_sent = None
+
+    def subscribe(self, report_ids=None):
+        self.loop = asyncio.get_running_loop()
+        subscription = Subscription(report_ids, self.maxsize)
+        self.subscriptions.add(subscription)
+        STREAM_CLIENTS.set(len(self.subscriptions))
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscriptions.discard(subscription)
+        STREAM_CLIENTS.set(len(self.subscriptions))
+
+    def _seen(self, report_id, timestamp):
+        with self._lock:
+            if self._last_sent is not None:
+                self._last_sent[report_id] = max(timestamp, self._last_sent.get(report_id, timestamp))
+
+    def publish(self, report_id, data, kind="position"):
+        if kind == "position":
+            self._seen(report_id, data["timestamp"])
+        if self.loop is None or not self.subscriptions:
+            return
+        self.loop.call_soon_threadsafe(self._deliver, report_id, data, kind)
+
+    def _deliver(self, report_id, data, kind="position"):
+        for subscription in list(self.subscriptions):
+            if not subscription.wants(report_id):
+                continue
+            try:
+                subscription.queue.put_nowait((kind, report_id, data))
+                STREAM_EVENTS.labels(outcome="queued").inc()
+            except asyncio.QueueFull:
+                self._drop(subscription)
+
+    def _drop(self, subscription):
+        self.unsubscribe(subscription)
+        subscription.dropped = True
+        while not subscription.queue.empty():
+            subscription.queue.get_nowait()
+        subscription.queue.put_nowait(DROPPED)
+        STREAM_EVENTS.labels(outcome="client_dropped").inc()
+
+    def _changed(self, reader):
+        positions = latest_positions(reader())
+        with self._lock:
+            if self._last_sent is None:
+                # Clients only get what is new after they connected
+                self._last_sent = {report_id: position["timestamp"] for report_id, position in positions.items()}
+                return []
+            changed = [(report_id, position) for report_id, position in positions.items()
+                       if position["timestamp"] > self._last_sent.get(report_id, 0)]
+            for report_id, position in changed:
+                self._last_sent[report_id] = position["timestamp"]
+        return changed
+
+    async def poll(self, reader, interval=POLL_SECONDS):
+        """Run forever, broadcasting latest positions that changed behind this process' back."""
+        while True:
+            changed = await asyncio.to_thread(self._changed, reader)
+            for report_id, position in changed:
+                position["isodatetime"] = datetime.datetime.fromtimestamp(position["timestamp"]).isoformat()
+                self._deliver(report_id, position)
+            await asyncio.sleep(interval)
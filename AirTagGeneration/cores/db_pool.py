@@ -0,0 +1,55 @@
+import contextlib
+import sqlite3
+import threading
+
+# How long a connection waits for another process holding the write lock before raising "database is locked"
+BUSY_TIMEOUT_MS = 30000
+
+
+class ConnectionPool:
+    """SQLite access for a multi-threaded, possibly multi-process server.
+
+    The database runs in WAL mode so readers never wait for a writer. Every thread gets
+    its own read-only connection, writes go through one writer connection per process,
+    serialized by a lock and wrapped in BEGIN IMMEDIATE so writers of other processes
+    (uvicorn --workers, the CLIs, compact_reports.py) queue on SQLite's lock instead of
+    failing halfway through a transaction.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._writer = self._connect()
+        # Persistent for the file, later connections of any process inherit it
+        self._writer.execute("PRAGMA journal_mode=WAL")
+        self._writer.execute("PRAGMA synchronous=NORMAL")
+
+    def _connect(self):
+        # isolation_level None leaves transactions to writer(), reads then always see the latest commit
+        sq3db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None,
+                                check_same_thread=False)
+        sq3db.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        return sq3db
+
+    def reader(self):
+        sq3db = getattr(self._local, "reader", None)
+        if sq3db is None:
+            sq3db = self._local.reader = self._connect()
+            sq3db.execute("PRAGMA query_only=1")
+        return sq3db.cursor()
+
+    @contextlib.contextmanager
+    def writer(self):
+        """Yields a cursor inside one write transaction, committed on exit or rolled back on error."""
+        with self._write_lock:
+            sq3 = self._writer.cursor()
+            sq3.execute("BEGIN IMMEDIATE")
+            try:
+                yield sq3
+            except BaseException:
+                if self._writer.in_transaction:
+                    self._writer.rollback()
+                raise
+            if self._writer.in_transaction:
+                self._writer.commit()
@@ -0,0 +1,56 @@
+import base64
+import datetime
+import hashlib
+
+from cores.report_db import stored_reports
+from cores.report_crypto import report_timestamp
+
+
+def dedupe_reports(reports, sq3=None, seen=None):
+    """Drop reports that need no ECDH before any is decrypted.
+
+    Repeats within reports are dropped by (id, sha256(payload)), seen can carry those
+    digests over several calls. With a database cursor the rest is checked against what
+    is already stored: a report counts as stored when its tag has a row with the same
+    timestamp and payload, or the same timestamp once retention dropped the payload.
+    Returns the reports still to decrypt, (report, stored row) pairs and the counts.
+    """
+    seen = set() if seen is None else seen
+    counts = {"duplicate": 0, "stored": 0}
+    fresh = []
+    for report in reports:
+        key = (report["id"], hashlib.sha256(report["payload"].encode("ascii")).digest())
+        if key in seen:
+            counts["duplicate"] += 1
+            continue
+        seen.add(key)
+        fresh.append(report)
+    if sq3 is None or not fresh:
+        return fresh, [], counts
+
+    payloads = [base64.b64decode(report["payload"]) for report in fresh]
+    timestamps = [report_timestamp(data) for data in payloads]
+    existing = stored_reports(sq3, {report["id"] for report in fresh}, min(timestamps), max(timestamps))
+
+    new, stored = [], []
+    for report, data, timestamp in zip(fresh, payloads, timestamps):
+        row = existing.get((report["id"], timestamp))
+        if row is None or row["lat"] is None or (row["payload"] is not None and row["payload"] != data):
+            new.append(report)
+        else:
+            stored.append((report, row))
+    counts["stored"] = len(stored)
+    return new, stored, counts
+
+
+def tag_from_stored(row, timestamp):
+    # Same shape as decrypt_report(), status is whatever the pipeline that stored the row kept
+    return {
+        "lat": row["lat"],
+        "lon": row["lon"],
+        "conf": row["conf"],
+        "status": row["status"],
+        "place": row.get("place"),
+        "timestamp": timestamp,
+        "isodatetime": datetime.datetime.fromtimestamp(timestamp).isoformat(),
+    }
@@ -0,0 +1,150 @@
+import datetime
+
+import numpy as np
+
+from cores.trajectory import EARTH_RADIUS_METERS
+
+# Reports of one tag within this many seconds are fused into one position
+BUCKET_SECONDS = 60
+# Spread of a report with the highest confidence, lower confidences are trusted proportionally less
+MEASUREMENT_METERS = 50
+# Random walk of a tag between reports, its spread grows by this many meters times the root of the seconds passed
+PROCESS_METERS = 10
+
+METERS_PER_DEGREE = EARTH_RADIUS_METERS * np.pi / 180
+
+
+def _weights(confs, n):
+    # Confidence 0 still counts a little, a bucket never ends up without weight
+    return np.ones(n) if confs is None else np.maximum(np.asarray(confs, dtype=float), 1)
+
+
+def fuse(tags, timestamps, lats, lons, confs=None, bucket_seconds=BUCKET_SECONDS):
+    """Confidence-weighted mean position per tag and time bucket, for a whole batch at once.
+
+    Returns a dict of arrays ordered by tag and time: tags, timestamps (weighted mean
+    time of the bucket), lats, lons, confs (best of the bucket), counts and members,
+    the index into the input of each bucket's most confident report.
+    """
+    tags = np.asarray(tags)
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    weights = _weights(confs, len(timestamps))
+    labels, codes = np.unique(tags, return_inverse=True)
+    if len(timestamps) == 0:
+        none = np.zeros(0, dtype=np.int64)
+        return {"tags": labels, "timestamps": none, "lats": lats, "lons": lons, "confs": weights, "counts": none,
+                "members": none}
+
+    buckets = timestamps // bucket_seconds
+    # Most confident report last within each bucket, so the bucket's end points at it
+    order = np.lexsort((weights, buckets, codes))
+    codes, buckets = codes[order], buckets[order]
+    new_bucket = np.concatenate(([True], (codes[1:] != codes[:-1]) | (buckets[1:] != buckets[:-1])))
+    starts = np.flatnonzero(new_bucket)
+    ends = np.concatenate((starts[1:], [len(order)])) - 1
+
+    w = weights[order]
+    total = np.add.reduceat(w, starts)
+    return {
+        "tags": labels[codes[starts]],
+        "timestamps": np.rint(np.add.reduceat(w * timestamps[order], starts) / total).astype(np.int64),
+        "lats": np.add.reduceat(w * lats[order], starts) / total,
+        "lons": np.add.reduceat(w * lons[order], starts) / total,
+        "confs": w[ends],
+        "counts": ends - starts + 1,
+        "members": order[ends],
+    }
+
+
+def kalman_smooth(tags, timestamps, lats, lons, confs=None, measurement_meters=MEASUREMENT_METERS,
+                  process_meters=PROCESS_METERS):
+    """Rauch-Tung-Striebel smoothed positions of reports sorted by tag and time.
+
+    Every tag is a random walk in meters, whose variance grows by process_meters² per
+    second between reports, observed with a variance of measurement_meters² scaled by
+    the inverse confidence. The filter steps through the i-th report of all tags
+    together, so the loop runs as often as the longest track has reports.
+    """
+    tags = np.asarray(tags)
+    timestamps = np.asarray(timestamps, dtype=float)
+    n = len(timestamps)
+    if n == 0:
+        return np.zeros(0), np.zeros(0)
+    weights = _weights(confs, n)
+    measurement = measurement_meters**2 * weights.max() / weights
+
+    _, codes = np.unique(tags, return_inverse=True)
+    starts = np.flatnonzero(np.concatenate(([True], codes[1:] != codes[:-1])))
+    lengths = np.diff(np.concatenate((starts, [n])))
+
+    # Positions in meters around each tag's first report
+    lat0 = np.repeat(np.asarray(lats, dtype=float)[starts], lengths)
+    lon0 = np.repeat(np.asarray(lons, dtype=float)[starts], lengths)
+    scale = np.cos(np.radians(lat0))
+    ys = (np.asarray(lats, dtype=float) - lat0) * METERS_PER_DEGREE
+    xs = (np.asarray(lons, dtype=float) - lon0) * METERS_PER_DEGREE * scale
+
+    filtered = np.zeros((n, 2))
+    variance = np.zeros(n)
+    predicted = np.zeros(n)
+    first = starts
+    filtered[first] = np.column_stack((xs[first], ys[first]))
+    variance[first] = measurement[first]
+    for k in range(1, lengths.max()):
+        i = starts[lengths > k] + k
+        prior = filtered[i - 1]
+        predicted[i] = variance[i - 1] + process_meters**2 * (timestamps[i] - timestamps[i - 1])
+        gain = predicted[i] / (predicted[i] + measurement[i])
+        filtered[i] = prior + gain[:, None] * (np.column_stack((xs[i], ys[i])) - prior)
+        variance[i] = (1 - gain) * predicted[i]
+
+    smoothed = filtered.copy()
+    for k in range(lengths.max() - 2, -1, -1):
+        i = starts[lengths > k + 1] + k
+        gain = variance[i] / predicted[i + 1]
+        smoothed[i] = filtered[i] + gain[:, None] * (smoothed[i + 1] - filtered[i])
+
+    return (lat0 + smoothed[:, 1] / METERS_PER_DEGREE, lon0 + smoothed[:, 0] / (METERS_PER_DEGREE * scale))
+
+
+def fuse_reports(tags, bucket_seconds=BUCKET_SECONDS, smooth=False):
+    """fuse(), optionally followed by kalman_smooth(), on decrypted reports labelled by key.
+
+    Every fused position keeps the other fields of its bucket's most confident report
+    and counts the reports it replaces in fused. Ordered by time like the input.
+    """
+    if not tags:
+        return []
+    fused = fuse(
+        [tag["key"] for tag in tags],
+        [tag["timestamp"] for tag in tags],
+        [tag["lat"] for tag in tags],
+        [tag["lon"] for tag in tags],
+        [tag["conf"] for tag in tags],
+        bucket_seconds,
+    )
+    lats, lons = fused["lats"], fused["lons"]
+    if smooth:
+        lats, lons = kalman_smooth(fused["tags"], fused["timestamps"], lats, lons, fused["confs"])
+
+    results = []
+    for member, timestamp, lat, lon, count in zip(
+        fused["members"].tolist(), fused["timestamps"].tolist(), lats.tolist(), lons.tolist(), fused["counts"].tolist()
+    ):
+        tag = dict(tags[member])
+        tag.update(
+            {
+                "timestamp": timestamp,
+                "isodatetime": datetime.datetime.fromtimestamp(timestamp).isoformat(),
+                "lat": round(lat, 7),
+                "lon": round(lon, 7),
+                "fused": count,
+            }
+        )
+        if "goog" in tag:
+            tag["goog"] = "https://maps.google.com/maps?q=" + str(tag["lat"]) + "," + str(tag["lon"])
+        results.append(tag)
+    results.sort(key=lambda tag: tag["timestamp"])
+    return results
@@ -0,0 +1,194 @@
+import csv
+import math
+import os
+
+import numpy as np
+
+from cores.trajectory import EARTH_RADIUS_METERS, haversine
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    # The grid index below answers the same queries, only cache misses get slower
+    cKDTree = None
+
+GAZETTEER_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__))) + "/keys/gazetteer.txt"
+
+# Lookups are memoized per cell of this many degrees, about 110 m north-south
+CELL_DEGREES = 0.001
+# Cells remembered before the cache starts over
+MAX_CACHE = 1000000
+# Positions farther than this from every gazetteer entry get no place
+MAX_DISTANCE_METERS = 25000
+# Bucket edge of the fallback grid index in degrees
+GRID_DEGREES = 0.25
+
+_MISSING = object()
+
+
+def load_gazetteer(path):
+    """Names and coordinates of a GeoNames dump (e.g. cities1000.txt) or a CSV file.
+
+    A CSV file needs a header with name, lat and lon columns and may add a country
+    column, e.g. street names exported from OpenStreetMap. Returns (lats, lons, places).
+    """
+    lats, lons, places = [], [], []
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            for row in csv.DictReader(f):
+                lats.append(float(row["lat"]))
+                lons.append(float(row["lon"]))
+                places.append(f"{row['name']}, {row['country']}" if row.get("country") else row["name"])
+        else:
+            # geonameid, name, asciiname, alternatenames, latitude, longitude, feature class, feature code, country
+            for row in csv.reader(f, delimiter="\t", quoting=csv.QUOTE_NONE):
+                lats.append(float(row[4]))
+                lons.append(float(row[5]))
+                places.append(f"{row[1]}, {row[8]}" if row[8] else row[1])
+    return np.array(lats), np.array(lons), places
+
+
+def _unit_vectors(lats, lons):
+    lats, lons = np.radians(lats), np.radians(lons)
+    return np.column_stack((np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons), np.sin(lats)))
+
+
+class _GridIndex:
+    # Nearest neighbour by searching rings of grid buckets outwards, used when scipy is not installed
+    def __init__(self, lats, lons, max_distance):
+        self.lats = lats
+        self.lons = lons
+        self.max_distance = max_distance
+        # Bucket columns around the globe, longitudes are wrapped at the antimeridian
+        self.columns = int(round(360 / GRID_DEGREES))
+        rows, columns = (np.floor(values / GRID_DEGREES).astype(np.int64) for values in (lats, lons))
+        keys = self._key(rows, columns)
+        order = np.argsort(keys, kind="stable")
+        unique, starts = np.unique(keys[order], return_index=True)
+        self.buckets = dict(zip(unique.tolist(), np.split(order, starts[1:])))
+
+    def _key(self, row, column):
+        return row * self.columns + column % self.columns
+
+    def _bound(self, lat, lon, x, y, rows, columns):
+        # Meters that every entry outside rows and columns of buckets around (x, y) is at least away from lat, lon
+        north, south = (x + rows + 1) * GRID_DEGREES - lat, lat - (x - rows) * GRID_DEGREES
+        bound = math.inf
+        if (x + rows + 1) * GRID_DEGREES < 90:
+            bound = min(bound, math.radians(north) * EARTH_RADIUS_METERS)
+        if (x - rows) * GRID_DEGREES > -90:
+            bound = min(bound, math.radians(south) * EARTH_RADIUS_METERS)
+        if 2 * columns + 1 < self.columns:
+            # Distance to the great circle of the nearest meridian not searched yet
+            offset = min((y + columns + 1) * GRID_DEGREES - lon, lon - (y - columns) * GRID_DEGREES, 90)
+            across = math.sin(math.radians(offset)) * math.cos(math.radians(lat))
+            bound = min(bound, math.asin(min(across, 1)) * EARTH_RADIUS_METERS)
+        return bound
+
+    def nearest(self, lat, lon):
+        x, y = math.floor(lat / GRID_DEGREES), math.floor(lon / GRID_DEGREES)
+        # A degree of longitude shrinks with the cosine of the latitude, rings widen by as many columns
+        stretch = 1 / max(math.cos(math.radians(lat)), 1e-9)
+        best, best_distance = -1, math.inf
+        seen = set()
+        ring, columns = 0, 0
+        while True:
+            candidates = []
+            for dx in range(-ring, ring + 1):
+                for dy in range(-columns, columns + 1):
+                    key = self._key(x + dx, y + dy)
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    bucket = self.buckets.get(key)
+                    if bucket is not None:
+                        candidates.append(bucket)
+            if candidates:
+                candidates = np.concatenate(candidates)
+                distances = haversine(lat, lon, self.lats[candidates], self.lons[candidates])
+                i = int(np.argmin(distances))
+                if distances[i] < best_distance:
+                    best, best_distance = int(candidates[i]), float(distances[i])
+            # Entries outside the searched buckets are at least bound away, past the best one or max_distance they
+            # cannot change the answer
+            bound = self._bound(lat, lon, x, y, ring, columns)
+            if bound >= min(best_distance, self.max_distance):
+                return best, best_distance
+            ring += 1
+            columns = min(math.ceil(ring * stretch), self.columns // 2)
+
+    def query(self, lats, lons):
+        results = [self.nearest(lat, lon) for lat, lon in zip(lats.tolist(), lons.tolist())]
+        return np.array([r[0] for r in results], dtype=np.int64), np.array([r[1] for r in results])
+
+
+class Geocoder:
+    """Nearest gazetteer place of positions, memoized per CELL_DEGREES cell.
+
+    Cache misses are answered by a KD-tree over unit vectors when scipy is installed,
+    else by a grid of buckets. lookup_many() resolves a whole batch with one index
+    query for the cells it has not seen yet.
+    """
+
+    def __init__(self, lats, lons, places, cell=CELL_DEGREES, max_distance=MAX_DISTANCE_METERS):
+        self.places = places
+        self.cell = cell
+        self.max_distance = max_distance
+        self.cache = {}
+        lats, lons = np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)
+        if cKDTree is not None:
+            self.tree = cKDTree(_unit_vectors(lats, lons))
+            self.grid = None
+        else:
+            self.tree = None
+            self.grid = _GridIndex(lats, lons, max_distance)
+
+    @classmethod
+    def load(cls, path=GAZETTEER_PATH, **options):
+        return cls(*load_gazetteer(path), **options)
+
+    def _resolve(self, lats, lons):
+        # Places of cell centres, None past max_distance
+        if self.tree is not None:
+            chord = 2 * math.sin(min(self.max_distance / EARTH_RADIUS_METERS, math.pi) / 2)
+            distances, indices = self.tree.query(_unit_vectors(lats, lons), distance_upper_bound=chord)
+            found = np.isfinite(distances)
+        else:
+            indices, distances = self.grid.query(lats, lons)
+            found = distances <= self.max_distance
+        return [self.places[i] if ok else None for i, ok in zip(indices.tolist(), found.tolist())]
+
+    def _cells(self, lats, lons):
+        return np.rint(lats / self.cell).astype(np.int64) * 1000000 + np.rint(lons / self.cell).astype(np.int64)
+
+    def lookup_many(self, lats, lons):
+        """Places of many positions, a list in the order of lats and lons."""
+        lats, lons = np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)
+        if len(lats) == 0:
+            return []
+        cells, first, inverse = np.unique(self._cells(lats, lons), return_index=True, return_inverse=True)
+        keys = cells.tolist()
+        resolved = [self.cache.get(key, _MISSING) for key in keys]
+        missing = [i for i, place in enumerate(resolved) if place is _MISSING]
+        if missing:
+            if len(self.cache) + len(missing) > MAX_CACHE:
+                self.cache.clear()
+            rows = first[missing]
+            centres = (np.rint(lats[rows] / self.cell) * self.cell, np.rint(lons[rows] / self.cell) * self.cell)
+            for i, place in zip(missing, self._resolve(*centres)):
+                resolved[i] = self.cache[keys[i]] = place
+        return [resolved[i] for i in inverse.tolist()]
+
+    def lookup(self, lat, lon):
+        key = round(lat / self.cell) * 1000000 + round(lon / self.cell)
+        place = self.cache.get(key, _MISSING)
+        if place is _MISSING:
+            place = self.lookup_many([lat], [lon])[0]
+        return place
+
+
+def load_geocoder(path=GAZETTEER_PATH):
+    # Reverse geocoding is optional, it is enabled by placing a gazetteer file at path
+    if not path or not os.path.exists(path):
+        return None
+    return Geocoder.load(path)
@@ -0,0 +1,183 @@
+import base64
+import json
+import math
+import time
+
+from cores.metrics import GEOFENCE_SECONDS
+from cores.report_db import tag_id_of
+from cores.scheduler import haversine_meters
+
+# Grid cell edge in degrees, about 2.2 km north-south
+CELL_DEGREES = 0.02
+# Fences covering more cells than this are kept out of the grid and tested by bounding box
+MAX_CELLS_PER_FENCE = 10000
+METERS_PER_DEGREE = 111320
+
+create_geofences_query = """CREATE TABLE IF NOT EXISTS geofences (
+fence_id INTEGER PRIMARY KEY, name TEXT, kind TEXT, geometry TEXT, updated REAL);"""
+
+# Fences each tag is inside of, since the timestamp of the report that entered
+create_geofence_state_query = """CREATE TABLE IF NOT EXISTS geofence_state (
+tag_id INTEGER, fence_id INTEGER, since INTEGER, PRIMARY KEY(tag_id,fence_id)) WITHOUT ROWID;"""
+
+# Timestamp of the newest report evaluated per tag, older ones arriving late are not replayed
+create_geofence_tags_query = """CREATE TABLE IF NOT EXISTS geofence_tags (
+tag_id INTEGER PRIMARY KEY, timestamp INTEGER);"""
+
+create_geofence_events_query = """CREATE TABLE IF NOT EXISTS geofence_events (
+event_id INTEGER PRIMARY KEY, tag_id INTEGER, fence_id INTEGER, event TEXT, timestamp INTEGER,
+lat REAL, lon REAL, published INTEGER DEFAULT 0);"""
+
+
+def create_geofence_tables(sq3):
+    sq3.execute(create_geofences_query)
+    sq3.execute(create_geofence_state_query)
+    sq3.execute(create_geofence_tags_query)
+    sq3.execute(create_geofence_events_query)
+
+
+class Fence:
+    """A circle ({"lat", "lon", "radius"} in meters) or polygon ({"points": [[lat, lon], ...]})."""
+
+    def __init__(self, fence_id, name, kind, geometry):
+        self.fence_id = fence_id
+        self.name = name
+        self.kind = kind
+        self.geometry = geometry
+        if kind == "circle":
+            lat, lon, radius = geometry["lat"], geometry["lon"], geometry["radius"]
+            dlat = radius / METERS_PER_DEGREE
+            dlon = radius / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+            self.bbox = (lat - dlat, lon - dlon, lat + dlat, lon + dlon)
+        elif kind == "polygon":
+            points = geometry["points"]
+            if len(points) < 3:
+                raise ValueError("A polygon needs at least 3 points")
+            self.lats = [point[0] for point in points]
+            self.lons = [point[1] for point in points]
+            self.bbox = (min(self.lats), min(self.lons), max(self.lats), max(self.lons))
+        else:
+            raise ValueError(f"Unknown fence kind {kind}")
+
+    def in_bbox(self, lat, lon):
+        return self.bbox[0] <= lat <= self.bbox[2] and self.bbox[1] <= lon <= self.bbox[3]
+
+    def contains(self, lat, lon):
+        if not self.in_bbox(lat, lon):
+            return False
+        if self.kind == "circle":
+            return haversine_meters(self.geometry["lat"], self.geometry["lon"], lat, lon) <= self.geometry["radius"]
+        # Even-odd ray casting along the longitude axis
+        inside = False
+        lats, lons = self.lats, self.lons
+        j = len(lats) - 1
+        for i in range(len(lats)):
+            if (lats[i] > lat) != (lats[j] > lat) and lon < (lons[j] - lons[i]) * (lat - lats[i]) / (
+                lats[j] - lats[i]
+            ) + lons[i]:
+                inside = not inside
+            j = i
+        return inside
+
+
+class GeofenceIndex:
+    """Finds the fences containing a point by looking only at those registered in its grid cell.
+
+    Every fence is registered in the cells its bounding box overlaps, a point then needs
+    exact tests against a handful of fences however many there are in total.
+    """
+
+    def __init__(self, fences, cell=CELL_DEGREES):
+        self.cell = cell
+        self.fences = {fence.fence_id: fence for fence in fences}
+        self.grid = {}
+        self.large = []
+        for fence in fences:
+            lat0, lon0, lat1, lon1 = (math.floor(value / cell) for value in fence.bbox)
+            if (lat1 - lat0 + 1) * (lon1 - lon0 + 1) > MAX_CELLS_PER_FENCE:
+                self.large.append(fence)
+                continue
+            for x in range(lat0, lat1 + 1):
+                for y in range(lon0, lon1 + 1):
+                    self.grid.setdefault((x, y), []).append(fence)
+
+    def candidates(self, lat, lon):
+        return self.grid.get((math.floor(lat / self.cell), math.floor(lon / self.cell)), []) + self.large
+
+    def containing(self, lat, lon):
+        return {fence.fence_id for fence in self.candidates(lat, lon) if fence.contains(lat, lon)}
+
+
+_cached = (None, None)
+
+
+def load_index(sq3):
+    # Rebuilt only when a fence was added, changed or removed, also by another process
+    global _cached
+    signature = sq3.execute("SELECT count(*), max(fence_id), max(updated) FROM geofences").fetchone()
+    if _cached[0] != signature:
+        fences = [Fence(row[0], row[1], row[2], json.loads(row[3]))
+                  for row in sq3.execute("SELECT fence_id, name, kind, geometry FROM geofences")]
+        _cached = (signature, GeofenceIndex(fences))
+    return _cached[1]
+
+
+def add_fence(sq3, name, kind, geometry):
+    # Validates the geometry before storing it
+    Fence(None, name, kind, geometry)
+    sq3.execute("INSERT INTO geofences (name, kind, geometry, updated) VALUES (?, ?, ?, ?)",
+                (name, kind, json.dumps(geometry), time.time()))
+    return sq3.lastrowid
+
+
+def delete_fence(sq3, fence_id):
+    sq3.execute("DELETE FROM geofences WHERE fence_id = ?", (fence_id,))
+    sq3.execute("DELETE FROM geofence_state WHERE fence_id = ?", (fence_id,))
+    sq3.execute("DELETE FROM geofence_events WHERE fence_id = ?", (fence_id,))
+
+
+@GEOFENCE_SECONDS.time()
+def evaluate(sq3, positions):
+    """Compare new positions with the fences each tag was in and record enter and exit events.
+
+    positions maps report ids to dicts with timestamp, lat and lon, as record_poll() gets
+    them. Runs inside the write transaction that stored the reports, returns the number
+    of events written.
+    """
+    index = load_index(sq3)
+    events = []
+    for report_id, points in positions.items():
+        tag_id = tag_id_of(sq3, report_id)
+        if tag_id is None:
+            continue
+        inside = dict(sq3.execute("SELECT fence_id, since FROM geofence_state WHERE tag_id = ?", (tag_id,)))
+        if not index.fences and not inside:
+            continue
+        last = (sq3.execute("SELECT timestamp FROM geofence_tags WHERE tag_id = ?", (tag_id,)).fetchone() or (None,))[0]
+        for point in sorted(points, key=lambda p: p["timestamp"]):
+            if last is not None and point["timestamp"] <= last:
+                continue
+            now_inside = index.containing(point["lat"], point["lon"])
+            for fence_id in now_inside - inside.keys():
+                inside[fence_id] = point["timestamp"]
+                events.append((tag_id, fence_id, "enter", point["timestamp"], point["lat"], point["lon"]))
+            for fence_id in inside.keys() - now_inside:
+                del inside[fence_id]
+                events.append((tag_id, fence_id, "exit", point["timestamp"], point["lat"], point["lon"]))
+            last = point["timestamp"]
+        sq3.execute("DELETE FROM geofence_state WHERE tag_id = ?", (tag_id,))
+        sq3.executemany("INSERT INTO geofence_state VALUES (?, ?, ?)",
+                        [(tag_id, fence_id, since) for fence_id, since in inside.items()])
+        sq3.execute("INSERT OR REPLACE INTO geofence_tags VALUES (?, ?)", (tag_id, last))
+    sq3.executemany("INSERT INTO geofence_events (tag_id, fence_id, event, timestamp, lat, lon) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", events)
+    return len(events)
+
+
+def event_rows(sq3, where="", parameters=(), limit=1000):
+    rows = sq3.execute(
+        "SELECT event_id, tag_ids.id, geofence_events.fence_id, name, event, timestamp, lat, lon "
+        "FROM geofence_events JOIN tag_ids USING (tag_id) JOIN geofences USING (fence_id) "
+        + where + " ORDER BY event_id LIMIT ?", tuple(parameters) + (limit,)).fetchall()
+    return [{"event_id": row[0], "id": base64.b64encode(row[1]).decode("ascii"), "fence_id": row[2],
+             "fence": row[3], "event": row[4], "timestamp": row[5], "lat": row[6], "lon": row[7]} for row in rows]
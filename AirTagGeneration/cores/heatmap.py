@@ -0,0 +1,188 @@
+import numpy as np
+
+from cores.report_db import tag_id_of
+
+# Grid cell edge in degrees the cache is kept at, about 110 m north-south, coarser views merge these cells
+CELL_DEGREES = 0.001
+# Time until the next report is spent in the cell of the previous one, capped at this many seconds
+MAX_DWELL_SECONDS = 60 * 60
+METERS_PER_DEGREE = 111320
+
+create_heat_cells_query = """CREATE TABLE IF NOT EXISTS heat_cells (
+tag_id INTEGER, cell_lat INTEGER, cell_lon INTEGER, count INTEGER, dwell_seconds INTEGER,
+first_timestamp INTEGER, last_timestamp INTEGER, PRIMARY KEY(tag_id,cell_lat,cell_lon)) WITHOUT ROWID;"""
+
+# Newest report aggregated per tag and its cell, which is owed the dwell until the next report
+create_heat_state_query = """CREATE TABLE IF NOT EXISTS heat_state (
+tag_id INTEGER PRIMARY KEY, timestamp INTEGER, cell_lat INTEGER, cell_lon INTEGER);"""
+
+
+def create_heat_tables(sq3):
+    new = sq3.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'heat_state'").fetchone() is None
+    sq3.execute(create_heat_cells_query)
+    sq3.execute(create_heat_state_query)
+    if new:
+        # Backfill databases that were written before the cache existed
+        rows = sq3.execute("SELECT tag_id, timestamp, lat, lon FROM reports "
+                           "WHERE lat IS NOT NULL AND lon IS NOT NULL").fetchall()
+        if rows:
+            _merge(sq3, aggregate(*zip(*rows)))
+
+
+def _group(keys, counts, dwell, first, last):
+    # One sort over the key columns, then every sum, min and max with reduceat over the runs of equal keys
+    order = np.lexsort(keys[::-1])
+    keys = [key[order] for key in keys]
+    change = np.zeros(len(order), dtype=bool)
+    change[:1] = True
+    for key in keys:
+        change[1:] |= key[1:] != key[:-1]
+    starts = np.flatnonzero(change)
+    return {
+        "keys": [key[starts] for key in keys],
+        "counts": np.add.reduceat(counts[order], starts),
+        "dwell_seconds": np.add.reduceat(dwell[order], starts),
+        "first_timestamps": np.minimum.reduceat(first[order], starts),
+        "last_timestamps": np.maximum.reduceat(last[order], starts),
+    }
+
+
+def aggregate(tags, timestamps, lats, lons, counted=None, cell=CELL_DEGREES, max_dwell=MAX_DWELL_SECONDS):
+    """Reports per tag and grid cell, counted and with the seconds spent there, in one group-by.
+
+    tags are integer labels, the reports need not be sorted. A report's dwell is the time
+    until the tag's next report, capped at max_dwell, the last one of each tag has none
+    yet. Reports whose counted is False only hand on their dwell. Returns a dict of arrays:
+    tags, cell_lats, cell_lons (integer cell indices), counts, dwell_seconds,
+    first_timestamps and last_timestamps, plus last, the newest report of each tag as
+    (tags, timestamps, cell_lats, cell_lons).
+    """
+    tags = np.asarray(tags, dtype=np.int64)
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    counted = np.ones(len(tags), dtype=np.int64) if counted is None else np.asarray(counted, dtype=np.int64)
+
+    if len(tags) == 0:
+        none = np.zeros(0, dtype=np.int64)
+        columns = ("tags", "cell_lats", "cell_lons", "counts", "dwell_seconds", "first_timestamps", "last_timestamps")
+        return dict.fromkeys(columns, none) | {"last": (none,) * 4}
+
+    order = np.lexsort((timestamps, tags))
+    tags, timestamps, counted = tags[order], timestamps[order], counted[order]
+    cell_lats = np.floor(lats[order] / cell).astype(np.int64)
+    cell_lons = np.floor(lons[order] / cell).astype(np.int64)
+    same = tags[1:] == tags[:-1]
+    dwell = np.zeros(len(tags), dtype=np.int64)
+    dwell[:-1] = np.where(same, np.minimum(timestamps[1:] - timestamps[:-1], max_dwell), 0)
+    newest = np.flatnonzero(np.concatenate((~same, [True])))
+    last = (tags[newest], timestamps[newest], cell_lats[newest], cell_lons[newest])
+
+    grouped = _group([tags, cell_lats, cell_lons], counted, dwell, timestamps, timestamps)
+    return {
+        "tags": grouped["keys"][0],
+        "cell_lats": grouped["keys"][1],
+        "cell_lons": grouped["keys"][2],
+        "counts": grouped["counts"],
+        "dwell_seconds": grouped["dwell_seconds"],
+        "first_timestamps": grouped["first_timestamps"],
+        "last_timestamps": grouped["last_timestamps"],
+        "last": last,
+    }
+
+
+def _merge(sq3, cells, late=False):
+    sq3.executemany(
+        "INSERT INTO heat_cells VALUES (?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(tag_id, cell_lat, cell_lon) DO UPDATE SET count = count + excluded.count, "
+        "dwell_seconds = dwell_seconds + excluded.dwell_seconds, "
+        "first_timestamp = min(first_timestamp, excluded.first_timestamp), "
+        "last_timestamp = max(last_timestamp, excluded.last_timestamp)",
+        zip(*(cells[column].tolist() for column in
+              ("tags", "cell_lats", "cell_lons", "counts", "dwell_seconds", "first_timestamps", "last_timestamps"))),
+    )
+    if not late:
+        sq3.executemany("INSERT OR REPLACE INTO heat_state VALUES (?, ?, ?, ?)",
+                        zip(*(column.tolist() for column in cells["last"])))
+    return len(cells["tags"])
+
+
+def update(sq3, positions, cell=CELL_DEGREES):
+    """Add new positions to the cached cells, runs inside the write transaction that stored them.
+
+    positions maps report ids to the newly stored reports, dicts with timestamp, lat and
+    lon. The newest cached report of each tag is carried along, so it gets the time until
+    the first new one. Reports older than that arrive late, they are counted but the
+    dwell already handed out is not redistributed. Returns the number of cells touched.
+    """
+    current, late = [], []
+    for report_id, points in positions.items():
+        tag_id = tag_id_of(sq3, report_id)
+        if tag_id is None:
+            continue
+        state = sq3.execute("SELECT timestamp, cell_lat, cell_lon FROM heat_state WHERE tag_id = ?",
+                            (tag_id,)).fetchone()
+        newest = state[0] if state else None
+        if state is not None and any(point["timestamp"] > newest for point in points):
+            current.append((tag_id, newest, (state[1] + 0.5) * cell, (state[2] + 0.5) * cell, 0))
+        for point in points:
+            if point["lat"] is None or point["lon"] is None:
+                continue
+            row = (tag_id, point["timestamp"], point["lat"], point["lon"], 1)
+            if newest is not None and point["timestamp"] <= newest:
+                late.append(row)
+            else:
+                current.append(row)
+
+    touched = 0
+    if current:
+        tags, timestamps, lats, lons, counted = zip(*current)
+        touched += _merge(sq3, aggregate(tags, timestamps, lats, lons, counted, cell))
+    if late:
+        tags, timestamps, lats, lons, counted = zip(*late)
+        touched += _merge(sq3, aggregate(tags, timestamps, lats, lons, counted, cell, max_dwell=0), late=True)
+    return touched
+
+
+def cell_rows(sq3, tag_ids=None, cell_meters=None, cell=CELL_DEGREES):
+    """Cached cells of tag_ids (all tags by default), merged into cells of about cell_meters.
+
+    Returns a dict of arrays like aggregate(), labelled by tag_id and with the cell
+    centres in lats and lons instead of cell indices.
+    """
+    query = "SELECT tag_id, cell_lat, cell_lon, count, dwell_seconds, first_timestamp, last_timestamp FROM heat_cells"
+    if tag_ids is None:
+        rows = sq3.execute(query).fetchall()
+    else:
+        tag_ids = list(tag_ids)
+        rows = sq3.execute(query + " WHERE tag_id IN (%s)" % ",".join("?" * len(tag_ids)), tag_ids).fetchall()
+    columns = [np.array(column, dtype=np.int64) for column in zip(*rows)] or [np.zeros(0, dtype=np.int64)] * 7
+    tags, cell_lats, cell_lons, counts, dwell, first, last = columns
+
+    factor = max(int(round((cell_meters or 0) / (cell * METERS_PER_DEGREE))), 1)
+    if factor > 1 and len(tags):
+        # Counts and dwell add up, first and last seen widen
+        grouped = _group([tags, cell_lats // factor, cell_lons // factor], counts, dwell, first, last)
+        tags, cell_lats, cell_lons = grouped["keys"]
+        counts, dwell = grouped["counts"], grouped["dwell_seconds"]
+        first, last = grouped["first_timestamps"], grouped["last_timestamps"]
+    return {
+        "tags": tags,
+        "lats": (cell_lats + 0.5) * cell * factor,
+        "lons": (cell_lons + 0.5) * cell * factor,
+        "counts": counts,
+        "dwell_seconds": dwell,
+        "first_timestamps": first,
+        "last_timestamps": last,
+    }
+
+
+def heat_points(cells, weight="dwell_seconds"):
+    # [lat, lon, weight] of cell_rows() for folium's HeatMap, weights scaled to 1 at the busiest cell
+    weights = cells[weight].astype(float)
+    if not weights.any():
+        # A single report per tag has no dwell yet
+        weights = cells["counts"].astype(float)
+    if weights.any():
+        weights /= weights.max()
+    return np.column_stack((cells["lats"], cells["lons"], weights)).round(7).tolist()
@@ -0,0 +1,48 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+# Latency buckets in seconds, from a single decrypt up to a slow upstream round trip
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+NETWORK_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+ALL_BUCKETS = tuple(sorted(set(FAST_BUCKETS + NETWORK_BUCKETS)))
+
+UPSTREAM_FETCH_SECONDS = Histogram(
+    "findmy_upstream_fetch_seconds", "Latency of acsnservice/fetch requests", ["status"], buckets=NETWORK_BUCKETS
+)
+UPSTREAM_QUEUE_SECONDS = Histogram(
+    "findmy_upstream_queue_seconds", "Time a fetch waited for the rate limiter", buckets=ALL_BUCKETS
+)
+UPSTREAM_RATE = Gauge(
+    "findmy_upstream_rate", "Current acsnservice/fetch requests per second allowed by the limiter", ["account"]
+)
+UPSTREAM_RETRIES = Counter("findmy_upstream_retries_total", "Fetches replayed after a throttling answer", ["status"])
+ANISETTE_SECONDS = Histogram(
+    "findmy_anisette_seconds", "Time spent generating anisette headers", buckets=NETWORK_BUCKETS
+)
+SYNC_REPORTS = Counter(
+    "findmy_sync_reports_total", "Reports handled by sync_latest_decrypted_reports", ["outcome"]
+)
+SCHEDULED_TAGS = Gauge("findmy_scheduled_tags", "Monitored tags by poll state in the last sync", ["state"])
+SYNC_LEASES = Counter("findmy_sync_leases_total", "Tag leases taken and released on the sync queue", ["outcome"])
+SYNC_SECONDS = Histogram(
+    "findmy_sync_seconds", "Duration of one sync_latest_decrypted_reports run", buckets=NETWORK_BUCKETS
+)
+DECRYPT_SECONDS = Histogram("findmy_decrypt_seconds", "Time to decrypt one report", buckets=FAST_BUCKETS)
+SQLITE_WRITE_SECONDS = Histogram(
+    "findmy_sqlite_write_seconds", "Time to write and commit a batch of reports", buckets=ALL_BUCKETS
+)
+MQTT_PUBLISH_SECONDS = Histogram(
+    "findmy_mqtt_publish_seconds", "Latency of one MQTT publish", ["broker", "outcome"], buckets=NETWORK_BUCKETS
+)
+SINK_DELIVERIES = Counter("findmy_sink_deliveries_total", "Events handed to output sinks", ["sink", "outcome"])
+SINK_SECONDS = Histogram("findmy_sink_seconds", "Latency of one sink batch delivery", ["sink"], buckets=NETWORK_BUCKETS)
+SINK_BACKLOG = Gauge("findmy_sink_backlog", "Events waiting in the outbox of a sink", ["sink"])
+GEOFENCE_EVENTS = Counter("findmy_geofence_events_total", "Geofence enter and exit events recorded by the sync")
+GEOFENCE_SECONDS = Histogram(
+    "findmy_geofence_seconds", "Time to evaluate the geofences of one sync's new positions", buckets=FAST_BUCKETS
+)
+STREAM_CLIENTS = Gauge("findmy_stream_clients", "Clients connected to the /Stream/ endpoint")
+STREAM_EVENTS = Counter("findmy_stream_events_total", "Position events of the /Stream/ endpoint", ["outcome"])
+HTTP_REQUEST_SECONDS = Histogram(
+    "findmy_http_request_seconds", "web_service request latency", ["method", "endpoint", "status"],
+    buckets=ALL_BUCKETS,
+)
@@ -0,0 +1,206 @@
+import queue
+import threading
+import time
+
+# Items buffered in front of a stage, a full queue blocks the stage feeding it
+QUEUE_SIZE = 64
+# How often blocked threads look whether the pipeline was stopped
+POLL_SECONDS = 0.1
+
+_DONE = object()
+
+
+def chunked(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+class _Stage:
+    def __init__(self, name, fn, workers, batch, maxsize):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.batch = batch
+        self.maxsize = maxsize
+        self.inbox = None
+        self.outbox = None
+        self.remaining = workers
+        self.items_in = 0
+        self.items_out = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+        self.depth_total = 0
+        self.depth_max = 0
+        self.gets = 0
+        self.started = None
+        self.finished = None
+        self.lock = threading.Lock()
+
+
+class Pipeline:
+    """Runs a chain of stages concurrently, each in its own threads, joined by bounded queues.
+
+    A stage function takes one item, or a list of up to batch items, and returns an
+    iterable of items for the next stage or None. Batches are cut from whatever is
+    queued, they never wait for more input. A full queue blocks the stage feeding it,
+    so a slow stage throttles everything before it and at most maxsize items wait in
+    front of a stage, stages taking large items set a smaller bound of their own. The
+    first exception stops every stage and is raised by run(), cancel() stops them and
+    run() returns what got through.
+    """
+
+    def __init__(self, maxsize=QUEUE_SIZE):
+        self.maxsize = maxsize
+        self.stages = []
+        self.results = []
+        self._stop = threading.Event()
+        self._error = None
+        self._results_lock = threading.Lock()
+        self._wall = None
+
+    def stage(self, name, fn, workers=1, batch=1, maxsize=None):
+        self.stages.append(_Stage(name, fn, workers, batch, maxsize or self.maxsize))
+        return self
+
+    def cancel(self):
+        self._stop.set()
+
+    @property
+    def cancelled(self):
+        return self._stop.is_set() and self._error is None
+
+    def _fail(self, error):
+        if self._error is None:
+            self._error = error
+        self._stop.set()
+
+    def _get(self, inbox):
+        while not self._stop.is_set():
+            try:
+                return inbox.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _put(self, outbox, item):
+        while not self._stop.is_set():
+            try:
+                outbox.put(item, timeout=POLL_SECONDS)
+                return
+            except queue.Full:
+                continue
+
+    def _emit(self, stage, items):
+        count, blocked = 0, 0.0
+        for item in items or ():
+            count += 1
+            if stage.outbox is None:
+                with self._results_lock:
+                    self.results.append(item)
+                continue
+            start = time.perf_counter()
+            self._put(stage.outbox, item)
+            blocked += time.perf_counter() - start
+        return count, blocked
+
+    def _feed(self, source):
+        first = self.stages[0]
+        try:
+            for item in source:
+                if self._stop.is_set():
+                    return
+                self._put(first.inbox, item)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            for _ in range(first.workers):
+                self._put(first.inbox, _DONE)
+
+    def _work(self, stage):
+        try:
+            done = False
+            while not done:
+                depth = stage.inbox.qsize()
+                item = self._get(stage.inbox)
+                if item is _DONE:
+                    break
+                items = [item]
+                while len(items) < stage.batch:
+                    try:
+                        item = stage.inbox.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _DONE:
+                        done = True
+                        break
+                    items.append(item)
+
+                start = time.perf_counter()
+                count, blocked = self._emit(stage, stage.fn(items if stage.batch > 1 else items[0]))
+                elapsed = time.perf_counter() - start
+                with stage.lock:
+                    stage.started = stage.started or start
+                    stage.items_in += len(items)
+                    stage.items_out += count
+                    stage.busy += elapsed - blocked
+                    stage.blocked += blocked
+                    stage.gets += 1
+                    stage.depth_total += depth
+                    stage.depth_max = max(stage.depth_max, depth)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            with stage.lock:
+                stage.remaining -= 1
+                last = stage.remaining == 0
+                stage.finished = time.perf_counter()
+            if last and stage.outbox is not None:
+                following = self.stages[self.stages.index(stage) + 1]
+                for _ in range(following.workers):
+                    self._put(stage.outbox, _DONE)
+
+    def run(self, source):
+        """Feeds every item of source through the stages and returns what the last one yields."""
+        for stage in self.stages:
+            stage.inbox = queue.Queue(stage.maxsize)
+        for stage, following in zip(self.stages, self.stages[1:]):
+            stage.outbox = following.inbox
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=self._feed, args=(source,), name="pipeline-source", daemon=True)]
+        for stage in self.stages:
+            threads.extend(
+                threading.Thread(target=self._work, args=(stage,), name=f"pipeline-{stage.name}-{i}", daemon=True)
+                for i in range(stage.workers)
+            )
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self._wall = time.perf_counter() - start
+
+        if self._error is not None:
+            raise self._error
+        return self.results
+
+    def stats(self):
+        """Per stage counts, busy and blocked seconds, throughput and input queue depth of the last run."""
+        records = []
+        for stage in self.stages:
+            wall = (stage.finished - stage.started) if stage.started and stage.finished else 0
+            records.append(
+                {
+                    "name": stage.name,
+                    "workers": stage.workers,
+                    "items_in": stage.items_in,
+                    "items_out": stage.items_out,
+                    "busy_seconds": round(stage.busy, 6),
+                    "blocked_seconds": round(stage.blocked, 6),
+                    "items_per_second": round(stage.items_in / wall, 2) if wall else None,
+                    "utilization": round(stage.busy / (wall * stage.workers), 3) if wall else None,
+                    "queue_max": stage.depth_max,
+                    "queue_mean": round(stage.depth_total / stage.gets, 2) if stage.gets else 0,
+                }
+            )
+        return {"wall_seconds": round(self._wall or 0, 6), "stages": records}
@@ -0,0 +1,105 @@
+import contextlib
+import cProfile
+import json
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the process wide high-water mark is skipped there
+    resource = None
+
+
+def max_rss_kb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+class StageProfiler:
+    """Wall time, CPU time, peak Python memory and item counts per pipeline stage.
+
+    Does nothing unless enabled, so the CLIs can wrap their stages unconditionally.
+    With a stats_path every stage also runs under cProfile and the combined pstats
+    are written there by dump(). Threads started during a stage, e.g. the report
+    pipeline's stage workers, are profiled too and merged into the same stats.
+    """
+
+    def __init__(self, enabled=False, stats_path=None):
+        self.enabled = enabled or bool(stats_path)
+        self.stats_path = stats_path
+        self.stages = []
+        self._profile = cProfile.Profile() if stats_path else None
+        self._thread_profiles = []
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    def _profile_thread(self, frame, event, arg):
+        # Installed through threading.setprofile(), runs once at the start of every new thread
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ profiles through sys.monitoring, the stage's profile already sees every thread
+            return
+        with self._lock:
+            self._thread_profiles.append(profile)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        record = {"name": name, "items": None}
+        if not self.enabled:
+            yield record
+            return
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        wall, cpu = time.perf_counter(), time.process_time()
+        if self._profile:
+            self._profile.enable()
+            threading.setprofile(self._profile_thread)
+        try:
+            yield record
+        finally:
+            if self._profile:
+                threading.setprofile(None)
+                self._profile.disable()
+            record["wall_seconds"] = round(time.perf_counter() - wall, 6)
+            record["cpu_seconds"] = round(time.process_time() - cpu, 6)
+            record["peak_python_kb"] = tracemalloc.get_traced_memory()[1] // 1024
+            record["max_rss_kb"] = max_rss_kb()
+            if record["items"] is not None and record["wall_seconds"]:
+                record["items_per_second"] = round(record["items"] / record["wall_seconds"], 2)
+            self.stages.append(record)
+
+    def summary(self):
+        return {
+            "total_wall_seconds": round(time.perf_counter() - self._start, 6),
+            "max_rss_kb": max_rss_kb(),
+            "stages": self.stages,
+        }
+
+    def dump(self, path="-"):
+        if not self.enabled:
+            return
+        output = json.dumps(self.summary(), indent=4)
+        if path == "-":
+            print(output, file=sys.stderr)
+        else:
+            with open(path, "w") as f:
+                f.write(output + "\n")
+        if self._profile:
+            stats = pstats.Stats(self._profile)
+            with self._lock:
+                for profile in self._thread_profiles:
+                    stats.add(profile)
+            stats.dump_stats(self.stats_path)
+        tracemalloc.stop()
@@ -2,7 +2,7 @@ from getpass import getpass
 import plistlib as plist
 import json
 import uuid
-import pbkdf2
+import functools
 import requests
 import hashlib
 import hmac
@@ -12,7 +12,6 @@ from datetime import datetime
 import srp._pysrp as srp
 from cryptography.hazmat.primitives import padding
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from Crypto.Hash import SHA256
 
 # Created here so that it is consistent
 USER_ID = uuid.uuid4()
@@ -36,7 +35,10 @@ def icloud_login_mobileme(username="", password="", second_factor="sms"):
     if not password:
         password = getpass("Password: ")
 
-    g = gsa_authenticate(username, password, second_factor)
+    try:
+        g = gsa_authenticate(username, password, second_factor)
+    finally:
+        derive_password_key.cache_clear()
     pet = g["t"]["com.apple.gs.idms.pet"]["token"]
     adsid = g["adsid"]
 
@@ -222,10 +224,17 @@ def generate_meta_headers(serial="0", user_id=uuid.uuid4(), device_id=uuid.uuid4
     }
 
 
+# gsa_authenticate runs the whole SRP flow again after 2FA, with the same salt and iteration count.
+# Keeping the derived key avoids a second PBKDF2 run, the cache is cleared once the login is done.
+@functools.lru_cache(maxsize=4)
+def derive_password_key(p, salt, iterations):
+    return hashlib.pbkdf2_hmac("sha256", p, salt, iterations, 32)
+
+
 def encrypt_password(password, salt, iterations, hex=False):
     hash = hashlib.sha256(password.encode("utf-8"))
-    p = hash.hexdigest() if hex else hash.digest()
-    return pbkdf2.PBKDF2(p, salt, iterations, SHA256).read(32)
+    p = hash.hexdigest().encode("ascii") if hex else hash.digest()
+    return derive_password_key(p, salt, iterations)
 
 
 def create_session_key(usr, name):
@@ -0,0 +1,78 @@
+import threading
+import time
+
+# Apple does not document a limit, these stay well below what an account is throttled at
+FETCH_RATE = 1.0
+FETCH_BURST = 5
+MIN_FETCH_RATE = 1 / 60
+MAX_BACKOFF = 300
+
+# Upstream answers that mean "slow down" rather than "this request is wrong"
+THROTTLE_STATUS = (429, 500, 502, 503, 504)
+
+
+class RateLimiter:
+    """Token bucket for one Apple account with AIMD rate adaptation.
+
+    acquire() never rejects, callers are handed consecutive send slots and sleep until
+    theirs comes up, so bursts queue up instead of failing. A throttling answer halves
+    the rate and holds every caller back for an exponentially growing pause (or the
+    Retry-After Apple sent), each success after that wins back a tenth of the rate.
+    """
+
+    def __init__(self, rate=FETCH_RATE, burst=FETCH_BURST, min_rate=MIN_FETCH_RATE, max_backoff=MAX_BACKOFF):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_backoff = max_backoff
+        self.backoff = 0
+        self._lock = threading.Lock()
+        # Theoretical arrival time of the next request, the bucket is full while it lies in the past
+        self._tat = time.monotonic()
+        self._paused_until = 0
+
+    def _reserve(self):
+        # Returns the monotonic time of the slot handed out
+        with self._lock:
+            now = time.monotonic()
+            interval = 1 / self.rate
+            tat = max(self._tat, now, self._paused_until)
+            self._tat = tat + interval
+            return max(now, self._paused_until, tat - (self.burst - 1) * interval)
+
+    def backlog(self):
+        """Seconds until a request that asks now would be sent."""
+        with self._lock:
+            now = time.monotonic()
+            return max(0, self._paused_until - now, self._tat - (self.burst - 1) / self.rate - now)
+
+    def acquire(self):
+        """Block until a request may be sent, returns the seconds spent waiting."""
+        start = time.monotonic()
+        send_at = self._reserve()
+        while True:
+            # A backoff that started while we slept also applies to slots handed out before it, the slot is kept and
+            # used once the pause is over
+            with self._lock:
+                delay = max(send_at, self._paused_until) - time.monotonic()
+            if delay <= 0:
+                return time.monotonic() - start
+            time.sleep(delay)
+
+    def record(self, status, retry_after=None):
+        with self._lock:
+            if status in THROTTLE_STATUS or status is None:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.backoff = min(self.max_backoff, max(1, self.backoff * 2))
+                pause = retry_after if retry_after is not None else self.backoff
+                self._paused_until = max(self._paused_until, time.monotonic() + pause)
+            else:
+                self.backoff = 0
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+def retry_after_seconds(response):
+    # Only the delta-seconds form, Apple has not been seen sending an HTTP date
+    value = response.headers.get("Retry-After", "")
+    return min(int(value), MAX_BACKOFF) if value.isdigit() else None
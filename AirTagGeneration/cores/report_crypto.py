@@ -0,0 +1,62 @@
+import base64
+import datetime
+import hashlib
+import struct
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+# Apple timestamps count seconds from 2001-01-01
+APPLE_EPOCH = 978307200
+
+
+def sha256(data):
+    digest = hashlib.new("sha256")
+    digest.update(data)
+    return digest.digest()
+
+
+def decrypt(enc_data, algorithm_dkey, mode):
+    decryptor = Cipher(algorithm_dkey, mode, default_backend()).decryptor()
+    return decryptor.update(enc_data) + decryptor.finalize()
+
+
+def decode_tag(data):
+    latitude = struct.unpack(">i", data[0:4])[0] / 10000000.0
+    longitude = struct.unpack(">i", data[4:8])[0] / 10000000.0
+    confidence = int.from_bytes(data[8:9], "big")
+    status = int.from_bytes(data[9:10], "big")
+    return {"lat": latitude, "lon": longitude, "conf": confidence, "status": status}
+
+
+def report_timestamp(data):
+    # Readable without decrypting, the first four bytes are in clear text
+    return int.from_bytes(data[0:4], "big") + APPLE_EPOCH
+
+
+def private_key_int(private_key_b64):
+    return int.from_bytes(base64.b64decode(private_key_b64), byteorder="big")
+
+
+def decrypt_report(data, priv):
+    """Decrypt one raw report payload with the tag's private key given as an int.
+
+    Payloads are usually 88 bytes, some carry an extra byte after the timestamp,
+    the slices are shifted by that difference.
+    """
+    # the following is all copied from https://github.com/hatomist/openhaystack-python, thanks @hatomist!
+    # check if NULL bytes are present in the data, if so slice the data accordingly | Thanks, @c4pitalSteez!
+    adj = len(data) - 88
+    eph_key = ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP224R1(), data[5 + adj : 62 + adj])
+    shared_key = ec.derive_private_key(priv, ec.SECP224R1(), default_backend()).exchange(ec.ECDH(), eph_key)
+    symmetric_key = sha256(shared_key + b"\x00\x00\x00\x01" + data[5 + adj : 62 + adj])
+    decryption_key = symmetric_key[:16]
+    iv = symmetric_key[16:]
+    enc_data = data[62 + adj : 72 + adj]
+    auth_tag = data[72 + adj :]
+
+    tag = decode_tag(decrypt(enc_data, algorithms.AES(decryption_key), modes.GCM(iv, auth_tag)))
+    tag["timestamp"] = report_timestamp(data)
+    tag["isodatetime"] = datetime.datetime.fromtimestamp(tag["timestamp"]).isoformat()
+    return tag
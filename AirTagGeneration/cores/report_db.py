@@ -0,0 +1,228 @@
+import base64
+import os
+
+DB_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__))) + "/keys/reports.db"
+
+# Hashed advertisement keys are stored once as 32 byte blobs, every other table refers to the integer tag_id
+# AUTOINCREMENT never hands the tag_id of a removed tag to a new one, which would inherit its leftover state
+create_tag_ids_query = """CREATE TABLE IF NOT EXISTS tag_ids (
+tag_id INTEGER PRIMARY KEY AUTOINCREMENT, id BLOB UNIQUE NOT NULL, id_short TEXT);"""
+
+create_reports_query = """CREATE TABLE IF NOT EXISTS reports (
+tag_id INTEGER, timestamp INTEGER, datePublished INTEGER, payload BLOB,
+statusCode INTEGER, lat REAL, lon REAL, conf INTEGER, place TEXT,
+PRIMARY KEY(tag_id,timestamp)) WITHOUT ROWID;"""
+
+# One row per tag holding its newest decrypted position, kept up to date by insert_report
+create_latest_position_query = """CREATE TABLE IF NOT EXISTS latest_position (
+tag_id INTEGER PRIMARY KEY, timestamp INTEGER, datePublished INTEGER,
+statusCode INTEGER, lat REAL, lon REAL, conf INTEGER, place TEXT);"""
+
+# Which fleets, groups of key file prefixes handled in one run, a tag belongs to
+create_fleet_tags_query = """CREATE TABLE IF NOT EXISTS fleet_tags (
+fleet TEXT, tag_id INTEGER, PRIMARY KEY(fleet,tag_id)) WITHOUT ROWID;"""
+
+# Raw reports older than the retention window are folded into these, see cores/retention.py
+AGGREGATE_TABLES = {"reports_hourly": 60 * 60, "reports_daily": 60 * 60 * 24}
+
+create_aggregate_table_query = """CREATE TABLE IF NOT EXISTS {table} (
+tag_id INTEGER, bucket INTEGER, count INTEGER, lat REAL, lon REAL, conf INTEGER,
+first_timestamp INTEGER, last_timestamp INTEGER, PRIMARY KEY(tag_id,bucket)) WITHOUT ROWID;"""
+
+
+def table_columns(sq3, table):
+    return [column[1] for column in sq3.execute(f"PRAGMA table_info({table})")]
+
+
+def migrate_text_tables(sq3, commit=True):
+    # Databases written before tag_ids existed keep base64 TEXT ids and payloads in every row. Without commit the
+    # migration becomes part of the caller's transaction, e.g. a ConnectionPool.writer()
+    text_tables = [table for table in ("reports", "latest_position") + tuple(AGGREGATE_TABLES)
+                   if "id" in table_columns(sq3, table)]
+    if not text_tables:
+        return
+
+    sq3.connection.create_function(
+        "b64decode", 1, lambda value: base64.b64decode(value) if value else None, deterministic=True
+    )
+    if commit:
+        if sq3.connection.in_transaction:
+            sq3.connection.commit()
+        sq3.execute("BEGIN")
+    for table in text_tables:
+        sq3.execute(f"ALTER TABLE {table} RENAME TO {table}_text")
+        # The old index followed the renamed table, free its name for the new one
+        sq3.execute("DROP INDEX IF EXISTS reports_id_timestamp")
+    sq3.execute(create_tag_ids_query)
+
+    if "reports" in text_tables:
+        sq3.execute(
+            "INSERT OR IGNORE INTO tag_ids (id, id_short) "
+            "SELECT b64decode(id), min(id_short) FROM reports_text GROUP BY id"
+        )
+        sq3.execute(create_reports_query)
+        sq3.execute(
+            "INSERT OR REPLACE INTO reports (tag_id, timestamp, datePublished, payload, statusCode, lat, lon, conf) "
+            "SELECT tag_ids.tag_id, r.timestamp, r.datePublished, b64decode(r.payload), r.statusCode, "
+            "CAST(r.lat AS REAL), CAST(r.lon AS REAL), r.conf "
+            "FROM reports_text AS r JOIN tag_ids ON tag_ids.id = b64decode(r.id)"
+        )
+    for table in AGGREGATE_TABLES:
+        if table in text_tables:
+            sq3.execute(
+                f"INSERT OR IGNORE INTO tag_ids (id) SELECT DISTINCT b64decode(id) FROM {table}_text"
+            )
+            sq3.execute(create_aggregate_table_query.format(table=table))
+            sq3.execute(
+                f"INSERT INTO {table} SELECT tag_ids.tag_id, a.bucket, a.count, a.lat, a.lon, a.conf, "
+                f"a.first_timestamp, a.last_timestamp "
+                f"FROM {table}_text AS a JOIN tag_ids ON tag_ids.id = b64decode(a.id)"
+            )
+    for table in text_tables:
+        # latest_position is rebuilt from reports by create_tables
+        sq3.execute(f"DROP TABLE {table}_text")
+    if commit:
+        sq3.connection.commit()
+
+
+def migrate_tag_ids(sq3):
+    # tag_ids created without AUTOINCREMENT are rebuilt with it, keeping every tag_id
+    row = sq3.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'tag_ids'").fetchone()
+    if row is None or "AUTOINCREMENT" in row[0].upper():
+        return
+    sq3.execute("ALTER TABLE tag_ids RENAME TO tag_ids_old")
+    sq3.execute(create_tag_ids_query)
+    sq3.execute("INSERT INTO tag_ids (tag_id, id, id_short) SELECT tag_id, id, id_short FROM tag_ids_old")
+    sq3.execute("DROP TABLE tag_ids_old")
+
+
+def create_tables(sq3, commit=True):
+    # Pass commit=False inside a ConnectionPool.writer(), which commits on exit
+    migrate_text_tables(sq3, commit)
+    migrate_tag_ids(sq3)
+    sq3.execute(create_tag_ids_query)
+    sq3.execute(create_reports_query)
+    sq3.execute(create_latest_position_query)
+    sq3.execute(create_fleet_tags_query)
+    for table in ("reports", "latest_position"):
+        # Reverse geocoded place name, see cores/geocoder.py
+        if "place" not in table_columns(sq3, table):
+            sq3.execute(f"ALTER TABLE {table} ADD COLUMN place TEXT")
+    if sq3.execute("SELECT 1 FROM latest_position LIMIT 1").fetchone() is None:
+        # Backfill databases that were written before this table existed
+        sq3.execute(
+            "INSERT OR REPLACE INTO latest_position "
+            "SELECT tag_id, timestamp, datePublished, statusCode, lat, lon, conf, place "
+            "FROM reports AS r WHERE lat IS NOT NULL AND lon IS NOT NULL AND timestamp = "
+            "(SELECT max(timestamp) FROM reports WHERE tag_id = r.tag_id AND lat IS NOT NULL AND lon IS NOT NULL)"
+        )
+    if commit:
+        sq3.connection.commit()
+
+
+def tag_id_of(sq3, report_id):
+    row = sq3.execute("SELECT tag_id FROM tag_ids WHERE id = ?", (base64.b64decode(report_id),)).fetchone()
+    return row[0] if row else None
+
+
+def tag_id_for(sq3, report_id, id_short=None):
+    sq3.execute(
+        "INSERT OR IGNORE INTO tag_ids (id, id_short) VALUES (?, ?)",
+        (base64.b64decode(report_id), id_short or report_id[:7]),
+    )
+    return tag_id_of(sq3, report_id)
+
+
+def update_latest_position(sq3, tag_id, timestamp, date_published, status, lat, lon, conf, place=None):
+    sq3.execute(
+        "INSERT INTO latest_position VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(tag_id) DO UPDATE SET timestamp = excluded.timestamp, "
+        "datePublished = excluded.datePublished, statusCode = excluded.statusCode, "
+        "lat = excluded.lat, lon = excluded.lon, conf = excluded.conf, place = excluded.place "
+        "WHERE excluded.timestamp >= latest_position.timestamp",
+        (tag_id, timestamp, date_published, status, lat, lon, conf, place),
+    )
+
+
+def insert_report(sq3, id_short, timestamp, date_published, payload, report_id, status, lat, lon, conf, place=None):
+    # All statements run in the same implicit transaction, the caller commits
+    tag_id = tag_id_for(sq3, report_id, id_short)
+    sq3.execute(
+        "INSERT OR REPLACE INTO reports VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (tag_id, timestamp, date_published, base64.b64decode(payload), status, lat, lon, conf, place),
+    )
+    update_latest_position(sq3, tag_id, timestamp, date_published, status, lat, lon, conf, place)
+
+
+def assign_fleets(sq3, fleets):
+    # fleets maps each fleet name to {report_id: id_short} of its tags, the caller commits
+    for fleet, report_ids in fleets.items():
+        for report_id, id_short in report_ids.items():
+            sq3.execute(
+                "INSERT OR IGNORE INTO fleet_tags VALUES (?, ?)", (fleet, tag_id_for(sq3, report_id, id_short))
+            )
+
+
+def delete_tag(sq3, report_id):
+    tag_id = tag_id_of(sq3, report_id)
+    if tag_id is None:
+        return
+    tables = ("reports", "latest_position", "tag_schedule", "fleet_tags", "heat_cells", "heat_state",
+              "geofence_state", "geofence_tags", "geofence_events", "sync_jobs")
+    for table in tables + tuple(AGGREGATE_TABLES):
+        if sq3.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone():
+            sq3.execute(f"DELETE FROM {table} WHERE tag_id = ?", (tag_id,))
+    sq3.execute("DELETE FROM tag_ids WHERE tag_id = ?", (tag_id,))
+
+
+def stored_reports(sq3, report_ids, start, end):
+    """Reports already stored for these ids between two timestamps, keyed by (base64 id, timestamp).
+
+    Walks the (tag_id, timestamp) primary key, so it stays cheap however large reports gets.
+    """
+    report_ids = [base64.b64decode(report_id) for report_id in report_ids]
+    if not report_ids:
+        return {}
+    rows = sq3.execute(
+        "SELECT tag_ids.id, timestamp, payload, datePublished, statusCode, lat, lon, conf, place "
+        "FROM tag_ids JOIN reports USING (tag_id) WHERE tag_ids.id IN (%s) AND timestamp BETWEEN ? AND ?"
+        % ",".join("?" * len(report_ids)),
+        report_ids + [start, end],
+    ).fetchall()
+    return {
+        (base64.b64encode(row[0]).decode("ascii"), row[1]): {
+            "payload": row[2],
+            "datePublished": row[3],
+            "status": row[4],
+            "lat": row[5],
+            "lon": row[6],
+            "conf": row[7],
+            "place": row[8],
+        }
+        for row in rows
+    }
+
+
+def latest_positions(sq3, report_ids=None):
+    query = ("SELECT tag_ids.id, id_short, timestamp, datePublished, statusCode, lat, lon, conf, place "
+             "FROM latest_position JOIN tag_ids USING (tag_id)")
+    if report_ids is None:
+        rows = sq3.execute(query).fetchall()
+    else:
+        report_ids = [base64.b64decode(report_id) for report_id in report_ids]
+        rows = sq3.execute(
+            query + " WHERE tag_ids.id IN (%s)" % ",".join("?" * len(report_ids)), report_ids
+        ).fetchall()
+    return {
+        base64.b64encode(row[0]).decode("ascii"): {
+            "id_short": row[1],
+            "timestamp": row[2],
+            "datePublished": row[3],
+            "status": row[4],
+            "lat": row[5],
+            "lon": row[6],
+            "conf": row[7],
+            "place": row[8],
+        }
+        for row in rows
+    }
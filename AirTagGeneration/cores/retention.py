@@ -0,0 +1,80 @@
+import time
+
+from cores.report_db import AGGREGATE_TABLES, create_aggregate_table_query
+
+
+def create_aggregate_tables(sq3):
+    for table in AGGREGATE_TABLES:
+        sq3.execute(create_aggregate_table_query.format(table=table))
+
+
+def database_size(sq3):
+    page_size = sq3.execute("PRAGMA page_size").fetchone()[0]
+    page_count = sq3.execute("PRAGMA page_count").fetchone()[0]
+    freelist_count = sq3.execute("PRAGMA freelist_count").fetchone()[0]
+    return page_size * page_count, page_size * freelist_count
+
+
+def downsample(sq3, cutoff):
+    for table, bucket in AGGREGATE_TABLES.items():
+        # Buckets that already hold older rows are merged as a count weighted mean
+        sq3.execute(
+            f"INSERT INTO {table} "
+            f"SELECT tag_id, timestamp / :bucket * :bucket AS bucket_start, count(*), avg(lat), avg(lon), "
+            f"max(conf), min(timestamp), max(timestamp) "
+            f"FROM reports WHERE timestamp < :cutoff AND lat IS NOT NULL AND lon IS NOT NULL "
+            f"GROUP BY tag_id, bucket_start "
+            f"ON CONFLICT(tag_id, bucket) DO UPDATE SET "
+            f"lat = (lat * count + excluded.lat * excluded.count) / (count + excluded.count), "
+            f"lon = (lon * count + excluded.lon * excluded.count) / (count + excluded.count), "
+            f"count = count + excluded.count, conf = max(conf, excluded.conf), "
+            f"first_timestamp = min(first_timestamp, excluded.first_timestamp), "
+            f"last_timestamp = max(last_timestamp, excluded.last_timestamp)",
+            {"bucket": bucket, "cutoff": cutoff},
+        )
+
+
+def expire_raw_reports(sq3, cutoff):
+    return sq3.execute("DELETE FROM reports WHERE timestamp < ?", (cutoff,)).rowcount
+
+
+def drop_payloads(sq3):
+    return sq3.execute("UPDATE reports SET payload = NULL WHERE payload IS NOT NULL AND lat IS NOT NULL").rowcount
+
+
+def incremental_vacuum(sq3db, pages=0):
+    sq3db.commit()
+    if sq3db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        # Switching an existing file to incremental mode needs one full VACUUM
+        sq3db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        sq3db.execute("VACUUM")
+    else:
+        # The pragma frees one page per step, executescript runs it to completion
+        sq3db.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+
+
+def run_retention(sq3db, raw_retention_days, drop_raw_payloads=False, vacuum=True, vacuum_pages=0):
+    sq3 = sq3db.cursor()
+    size_before, _ = database_size(sq3)
+    cutoff = int(time.time()) - raw_retention_days * 60 * 60 * 24
+
+    create_aggregate_tables(sq3)
+    downsample(sq3, cutoff)
+    expired = expire_raw_reports(sq3, cutoff)
+    dropped = drop_payloads(sq3) if drop_raw_payloads else 0
+    sq3db.commit()
+
+    if vacuum:
+        incremental_vacuum(sq3db, vacuum_pages)
+
+    size_after, free_after = database_size(sq3)
+    sq3.close()
+    return {
+        "cutoff": cutoff,
+        "reports_expired": expired,
+        "payloads_dropped": dropped,
+        "bytes_before": size_before,
+        "bytes_after": size_after,
+        "bytes_reclaimed": size_before - size_after,
+        "bytes_free": free_after,
+    }
@@ -0,0 +1,100 @@
+import base64
+import math
+import time
+
+from cores.report_db import tag_id_for
+
+# Poll intervals in seconds, a tag starts at the default and moves between the bounds
+MIN_INTERVAL = 5 * 60
+DEFAULT_INTERVAL = 15 * 60
+MAX_INTERVAL = 24 * 60 * 60
+# Empty polls stretch the interval by this factor, polls with new reports halve it
+BACKOFF = 1.5
+# A tag that moved further than this since its last report is polled at MIN_INTERVAL
+MOVING_METERS = 100
+# Apple keeps reports for about a week, there is no point looking back further
+MAX_LOOKBACK = 7 * 24 * 60 * 60
+
+create_tag_schedule_query = """CREATE TABLE IF NOT EXISTS tag_schedule (
+tag_id INTEGER PRIMARY KEY, interval INTEGER, next_poll INTEGER, last_poll INTEGER,
+last_report INTEGER, lat REAL, lon REAL);"""
+
+
+def create_schedule_table(sq3, commit=True):
+    sq3.execute(create_tag_schedule_query)
+    if commit:
+        sq3.connection.commit()
+
+
+def haversine_meters(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371000 * math.asin(math.sqrt(a))
+
+
+def due_tags(sq3, report_ids, now=None):
+    """Split report_ids into the ones to poll now and return them with the look-back window.
+
+    Tags without a schedule yet are always due. The window, in seconds, reaches back to
+    the oldest last poll among the due tags, it is None when one of them was never polled.
+    """
+    now = int(now or time.time())
+    rows = {
+        base64.b64encode(row[0]).decode("ascii"): row[1:]
+        for row in sq3.execute(
+            "SELECT tag_ids.id, next_poll, last_poll FROM tag_schedule JOIN tag_ids USING (tag_id)"
+        )
+    }
+    due, lookback = [], 0
+    for report_id in report_ids:
+        next_poll, last_poll = rows.get(report_id, (None, None))
+        if next_poll is not None and next_poll > now:
+            continue
+        due.append(report_id)
+        if lookback is not None:
+            lookback = None if last_poll is None else max(lookback, now - last_poll)
+    if lookback is not None:
+        lookback = min(lookback, MAX_LOOKBACK)
+    return due, lookback
+
+
+def lookback_hours(lookback, default):
+    return default if lookback is None else max(1, math.ceil(lookback / 3600))
+
+
+def next_interval(interval, new_reports, moved):
+    if moved is not None and moved >= MOVING_METERS:
+        return MIN_INTERVAL
+    if new_reports:
+        return max(MIN_INTERVAL, int(interval / 2))
+    return min(MAX_INTERVAL, int(interval * BACKOFF))
+
+
+def record_poll(sq3, polled, positions, now=None):
+    """Adapt the schedule of every polled tag to what its poll returned.
+
+    polled maps each fetched report id to its id_short, positions maps report ids to the
+    decrypted reports (dicts with timestamp, lat and lon) the poll returned for them.
+    The caller commits.
+    """
+    now = int(now or time.time())
+    for report_id, id_short in polled.items():
+        tag_id = tag_id_for(sq3, report_id, id_short)
+        row = sq3.execute(
+            "SELECT interval, last_report, lat, lon FROM tag_schedule WHERE tag_id = ?", (tag_id,)
+        ).fetchone()
+        interval, last_report, lat, lon = row or (DEFAULT_INTERVAL, None, None, None)
+
+        new = [p for p in positions.get(report_id, ()) if last_report is None or p["timestamp"] > last_report]
+        moved = None
+        if new:
+            newest = max(new, key=lambda p: p["timestamp"])
+            if lat is not None:
+                moved = max(haversine_meters(lat, lon, p["lat"], p["lon"]) for p in new)
+            last_report, lat, lon = newest["timestamp"], newest["lat"], newest["lon"]
+        interval = next_interval(interval, len(new), moved)
+
+        sq3.execute(
+            "INSERT OR REPLACE INTO tag_schedule VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (tag_id, interval, now + interval, now, last_report, lat, lon),
+        )
@@ -0,0 +1,288 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+import certifi
+import paho.mqtt.client as mqtt
+import requests
+
+from cores.metrics import MQTT_PUBLISH_SECONDS, SINK_BACKLOG, SINK_DELIVERIES, SINK_SECONDS
+
+SINKS_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__))) + "/keys/sinks.json"
+
+# A delivery that takes longer counts as failed, the sink is retried later without holding up the others. The clients
+# enforce it themselves, a batch's outbox claim lasts twice as long
+SINK_TIMEOUT = 30
+# Failed events are retried after RETRY_DELAY seconds, doubling up to MAX_RETRY_DELAY, and dropped after MAX_ATTEMPTS
+RETRY_DELAY = 10
+MAX_RETRY_DELAY = 60 * 60
+MAX_ATTEMPTS = 10
+# Events delivered per sink and delivery round, claimed from the outbox one batch at a time
+OUTBOX_LIMIT = 1000
+
+# Events waiting for a sink, removed once delivered
+create_sink_outbox_query = """CREATE TABLE IF NOT EXISTS sink_outbox (
+event_id INTEGER PRIMARY KEY, sink TEXT, event TEXT, attempts INTEGER DEFAULT 0, next_attempt REAL,
+created REAL);"""
+
+
+def create_outbox_table(sq3):
+    sq3.execute(create_sink_outbox_query)
+
+
+def publish_messages(messages, hostname, port, username, userpass, over_tls, timeout=SINK_TIMEOUT):
+    # publish.multiple() without its unbounded wait: QoS 1 messages, all acknowledged within timeout seconds or an error
+    deadline = time.monotonic() + timeout
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=username)
+    client.connect_timeout = timeout
+    client.username_pw_set(username, userpass)
+    if over_tls:
+        client.tls_set(ca_certs=certifi.where())
+    client.connect(hostname, port, keepalive=60)
+    try:
+        infos = None
+        while infos is None or not all(info.is_published() for info in infos):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"MQTT broker {hostname} did not acknowledge within {timeout}s")
+            rc = client.loop(timeout=min(1.0, max(deadline - time.monotonic(), 0)))
+            if rc != mqtt.MQTT_ERR_SUCCESS:
+                raise ConnectionError(f"MQTT connection to {hostname} failed: {mqtt.error_string(rc)}")
+            if infos is None and client.is_connected():
+                infos = [client.publish(message["topic"], message["payload"], qos=message["qos"],
+                                        retain=message["retain"]) for message in messages]
+    finally:
+        client.disconnect()
+
+
+def owntracks_location(event):
+    # https://owntracks.org/booklet/tech/json/#_typelocation
+    return {"_type": "location", "lat": event["lat"], "lon": event["lon"], "timestamp": event["timestamp"],
+            "tag": event["name"]}
+
+
+def owntracks_transition(event):
+    # https://owntracks.org/booklet/tech/json/#_typetransition
+    return {"_type": "transition", "event": "enter" if event["event"] == "enter" else "leave", "desc": event["fence"],
+            "lat": event["lat"], "lon": event["lon"], "tst": event["timestamp"], "t": "c", "tag": event["name"]}
+
+
+def owntracks_payload(event):
+    return owntracks_transition(event) if "event" in event else owntracks_location(event)
+
+
+class Sink:
+    """An output for positions.
+
+    An event is a dict with id, name, timestamp, lat, lon, conf and status, or for a
+    geofence transition with id, name, event (enter or exit), fence, fence_id, timestamp,
+    lat and lon. route() turns
+    it into the events stored in the outbox for this sink, send() delivers a batch of up
+    to batch_size of them and raises on failure, which retries the whole batch.
+    """
+
+    name = "sink"
+    batch_size = 1
+
+    def route(self, event):
+        return [event]
+
+    def send(self, events):
+        raise NotImplementedError
+
+    async def deliver(self, events):
+        # Blocking clients run in a thread, so the sinks of one round are delivered concurrently. send() stops at
+        # SINK_TIMEOUT on its own, a thread abandoned by wait_for() could still deliver after the retry was scheduled
+        await asyncio.to_thread(self.send, events)
+
+
+class MqttSink(Sink):
+    """OwnTracks over MQTT to the brokers configured per tag through /KeyToMonitor/.
+
+    Events are routed once per broker of their tag and a batch opens a single
+    connection per broker. Credentials are read from the tags table at send time.
+    """
+
+    name = "mqtt"
+    batch_size = 100
+
+    def __init__(self, db):
+        self.db = db
+
+    def route(self, event):
+        return [dict(event, mqtt_server=row[0]) for row in self.db.reader().execute(
+            "SELECT mqtt_server FROM tags WHERE hash_adv_key = ?", (event["id"],))]
+
+    def send(self, events):
+        deadline = time.monotonic() + SINK_TIMEOUT
+        brokers = {}
+        for event in events:
+            row = self.db.reader().execute(
+                "SELECT friendly_name, mqtt_port, mqtt_over_tls, mqtt_username, mqtt_userpass FROM tags "
+                "WHERE hash_adv_key = ? AND mqtt_server = ?", (event["id"], event["mqtt_server"])).fetchone()
+            if row is None:
+                # Removed through /Tag_Removal/ since it was queued
+                continue
+            friendly_name, port, over_tls, username, userpass = row
+            # "/" would add a topic level, "+" is a wildcard paho refuses to publish to
+            escape_keyname = event["id"].replace("/", "_").replace("+", "_")
+            broker = brokers.setdefault((event["mqtt_server"], port, over_tls, username, userpass), [])
+            topic = f"owntracks/{username}/{friendly_name}_{escape_keyname[:4]}"
+            broker.append({"topic": topic + "/event" if "event" in event else topic,
+                           "payload": json.dumps(owntracks_payload(dict(event, name=friendly_name)),
+                                                 separators=(',', ':')),
+                           "qos": 1, "retain": "event" not in event})
+
+        for (server, port, over_tls, username, userpass), messages in brokers.items():
+            logging.info(f"Publishing {len(messages)} MQTT message(s) to {server}")
+            start = time.perf_counter()
+            try:
+                # One deadline for the batch, however many brokers it goes to
+                publish_messages(messages, server, int(port), username, userpass, over_tls,
+                                 timeout=max(deadline - time.monotonic(), 1))
+            except Exception:
+                MQTT_PUBLISH_SECONDS.labels(broker=server, outcome="error").observe(time.perf_counter() - start)
+                raise
+            MQTT_PUBLISH_SECONDS.labels(broker=server, outcome="ok").observe(time.perf_counter() - start)
+
+
+class WebhookSink(Sink):
+    # POSTs a JSON array of events
+    def __init__(self, url, headers=None, batch_size=50, name="webhook"):
+        self.url = url
+        self.headers = headers or {}
+        self.batch_size = batch_size
+        self.name = name
+
+    def send(self, events):
+        requests.post(self.url, json=events, headers=self.headers, timeout=SINK_TIMEOUT).raise_for_status()
+
+
+class OwnTracksHttpSink(Sink):
+    # OwnTracks Recorder HTTP mode, one location or transition per request with the tag's name as device
+    def __init__(self, url, user="findmy", auth=None, name="owntracks"):
+        self.url = url
+        self.user = user
+        self.auth = tuple(auth) if auth else None
+        self.name = name
+
+    def send(self, events):
+        for event in events:
+            requests.post(self.url, json=owntracks_payload(event), auth=self.auth, timeout=SINK_TIMEOUT,
+                          headers={"X-Limit-U": self.user, "X-Limit-D": event["name"]}).raise_for_status()
+
+
+class NdjsonFileSink(Sink):
+    # Appends one JSON line per event, path is rotated to path.1 .. path.<backups> past max_bytes
+    batch_size = 1000
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backups=5, name="ndjson"):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.name = name
+
+    def rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def send(self, events):
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+            self.rotate()
+        with open(self.path, "a") as f:
+            f.write("".join(json.dumps(event, separators=(',', ':')) + "\n" for event in events))
+
+
+SINK_TYPES = {"webhook": WebhookSink, "owntracks": OwnTracksHttpSink, "ndjson": NdjsonFileSink}
+
+
+def load_sinks(db, path=SINKS_PATH):
+    """MQTT plus the sinks listed in keys/sinks.json.
+
+    The file holds a list of objects with a type (webhook, owntracks or ndjson) and the
+    keyword arguments of that sink, e.g. {"type": "webhook", "url": "https://..."}.
+    """
+    sinks = [MqttSink(db)]
+    if os.path.exists(path):
+        with open(path) as f:
+            for config in json.load(f):
+                config = dict(config)
+                sinks.append(SINK_TYPES[config.pop("type")](**config))
+    return sinks
+
+
+def enqueue(sq3, sinks, events, now=None):
+    # Runs inside a write transaction
+    now = now or time.time()
+    rows = [(sink.name, json.dumps(routed), now, now) for event in events for sink in sinks
+            for routed in sink.route(event)]
+    sq3.executemany("INSERT INTO sink_outbox (sink, event, next_attempt, created) VALUES (?, ?, ?, ?)", rows)
+    return len(rows)
+
+
+def _claim(db, sink, now):
+    # One batch per claim, pushing next_attempt past the delivery timeout keeps other workers' rounds off these events
+    # for as long as this batch can take
+    with db.writer() as sq3:
+        rows = sq3.execute(
+            "SELECT event_id, event, attempts FROM sink_outbox WHERE sink = ? AND next_attempt <= ? "
+            "ORDER BY event_id LIMIT ?", (sink.name, now, sink.batch_size)).fetchall()
+        sq3.executemany("UPDATE sink_outbox SET next_attempt = ? WHERE event_id = ?",
+                        [(now + 2 * SINK_TIMEOUT, row[0]) for row in rows])
+    return rows
+
+
+def _settle(db, sink, delivered, failed, now):
+    with db.writer() as sq3:
+        sq3.executemany("DELETE FROM sink_outbox WHERE event_id = ?", [(event_id,) for event_id in delivered])
+        for event_id, attempts in failed:
+            if attempts + 1 >= MAX_ATTEMPTS:
+                sq3.execute("DELETE FROM sink_outbox WHERE event_id = ?", (event_id,))
+                SINK_DELIVERIES.labels(sink=sink.name, outcome="dropped").inc()
+            else:
+                sq3.execute("UPDATE sink_outbox SET attempts = ?, next_attempt = ? WHERE event_id = ?",
+                            (attempts + 1, now + min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** attempts), event_id))
+        backlog = sq3.execute("SELECT count(*) FROM sink_outbox WHERE sink = ?", (sink.name,)).fetchone()[0]
+    SINK_BACKLOG.labels(sink=sink.name).set(backlog)
+
+
+async def _deliver_sink(db, sink):
+    delivered = failed = 0
+    while delivered < OUTBOX_LIMIT:
+        rows = await asyncio.to_thread(_claim, db, sink, time.time())
+        if not rows:
+            break
+        start = time.perf_counter()
+        try:
+            await sink.deliver([json.loads(row[1]) for row in rows])
+        except Exception as e:
+            logging.error(f"Sink {sink.name} failed for {len(rows)} event(s): {e!r}")
+            SINK_DELIVERIES.labels(sink=sink.name, outcome="retry").inc(len(rows))
+            await asyncio.to_thread(_settle, db, sink, [], [(row[0], row[2]) for row in rows], time.time())
+            failed += len(rows)
+            # Later batches of a failing sink would most likely fail the same way, they wait for the next round
+            break
+        finally:
+            SINK_SECONDS.labels(sink=sink.name).observe(time.perf_counter() - start)
+        SINK_DELIVERIES.labels(sink=sink.name, outcome="delivered").inc(len(rows))
+        await asyncio.to_thread(_settle, db, sink, [row[0] for row in rows], [], time.time())
+        delivered += len(rows)
+    return delivered, failed
+
+
+async def deliver(db, sinks):
+    """Deliver every due outbox event, all sinks concurrently. Returns {sink name: (delivered, failed)}."""
+    results = await asyncio.gather(*(_deliver_sink(db, sink) for sink in sinks), return_exceptions=True)
+    counts = {}
+    for sink, result in zip(sinks, results):
+        if isinstance(result, BaseException):
+            logging.error(f"Sink {sink.name} delivery round failed: {result!r}")
+            result = (0, 0)
+        counts[sink.name] = result
+    return counts
@@ -0,0 +1,229 @@
+import base64
+import json
+import logging
+import os
+import threading
+import time
+
+from cores.account_pool import account_pool
+from cores.dedup import dedupe_reports, tag_from_stored
+from cores.geofence import evaluate as evaluate_geofences
+from cores.heatmap import update as update_heat_cells
+from cores.metrics import DECRYPT_SECONDS, GEOFENCE_EVENTS, SQLITE_WRITE_SECONDS, SYNC_LEASES, SYNC_REPORTS
+from cores.pipeline import QUEUE_SIZE, Pipeline, chunked
+from cores.report_crypto import decrypt_report, private_key_int, report_timestamp
+from cores.report_db import insert_report
+from cores.scheduler import due_tags, lookback_hours, record_poll
+from cores.work_queue import LEASE_SECONDS, complete_jobs, fail_jobs, heartbeat
+
+
+# ids per upstream request, each chunk flows through the pipeline on its own
+FETCH_CHUNK = 64
+# cryptography releases the GIL during ECDH and AES, so a few threads decrypt in parallel
+DECRYPT_WORKERS = min(4, os.cpu_count() or 1)
+# Reports written per write transaction
+STORE_BATCH = 500
+# Fetched chunks waiting for dedupe, each one holds every report of FETCH_CHUNK tags
+FETCHED_QUEUE = 2
+
+
+class UpstreamError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"Failed to fetch reports. Status code: {status_code}")
+        self.status_code = status_code
+
+
+def store_report(sq3, report, tag):
+    insert_report(sq3, report["id"][:7], tag["timestamp"], report["datePublished"], report["payload"], report["id"],
+                  tag["status"], tag["lat"], tag["lon"], tag["conf"], tag.get("place"))
+
+
+def report_pipeline(db, private_keys, hours, pool=account_pool, store=store_report, drop_older=False,
+                    decrypt_workers=DECRYPT_WORKERS, store_batch=STORE_BATCH, maxsize=QUEUE_SIZE, geocoder=None,
+                    on_fetch=None):
+    """Build the fetch -> dedupe -> decrypt -> store pipeline shared by every entry point.
+
+    Feed it chunks of report ids, e.g. pipeline.run(chunked(ids, FETCH_CHUNK)). Chunks are
+    fetched concurrently, one thread per account of pool, reports already stored are read
+    back instead of decrypted and new ones are written by store(sq3, report, tag) in batches
+    of store_batch. Every stage yields (report, tag, stored) downstream, so callers append
+    their own stages, e.g. to collect positions or publish them. With drop_older reports
+    whose own timestamp lies before the look-back window are left out. With a geocoder
+    (see cores/geocoder.py) every batch is reverse geocoded into tag["place"] before it
+    is written, reports stored without a place get one too. The pipeline's
+    counts attribute tells how many reports were fetched and skipped as duplicate or stored,
+    on_fetch(count) is called with the running fetched count as each chunk comes in. Ids
+    the account pool could not fetch while other shards succeeded end up in its failed set.
+    """
+    unix_epoch = int(time.time())
+    start_date = unix_epoch - (60 * 60 * hours)
+    seen = set()
+    counts = {"fetched": 0, "duplicate": 0, "stored": 0}
+    failed = set()
+
+    def fetch(report_ids):
+        data = {"search": [{"startDate": start_date * 1000, "endDate": unix_epoch * 1000, "ids": report_ids}]}
+        r = pool.fetch(data)
+        reports = json.loads(r.content.decode(encoding="utf-8")) if r.status_code == 200 else {}
+        if "results" not in reports:
+            raise UpstreamError(r.status_code)
+        failed.update(reports.get("failed", ()))
+        SYNC_REPORTS.labels(outcome="fetched").inc(len(reports["results"]))
+        return [reports["results"]]
+
+    def dedupe(reports):
+        # Apple repeats reports across overlapping windows, only decrypt the ones not stored yet
+        new_reports, stored, skipped = dedupe_reports(reports, db.reader(), seen)
+        counts["fetched"] += len(reports)
+        counts["duplicate"] += skipped["duplicate"]
+        counts["stored"] += skipped["stored"]
+        SYNC_REPORTS.labels(outcome="duplicate").inc(skipped["duplicate"])
+        SYNC_REPORTS.labels(outcome="already_stored").inc(skipped["stored"])
+        if on_fetch is not None:
+            on_fetch(counts["fetched"])
+        return [(report, None) for report in new_reports] + stored
+
+    def decrypt(item):
+        report, row = item
+        data = base64.b64decode(report["payload"])
+        timestamp = report_timestamp(data)
+        if drop_older and timestamp < start_date:
+            return None
+        if row is not None:
+            return [(report, tag_from_stored(row, timestamp), True)]
+        if report["id"] not in private_keys:
+            return None
+        try:
+            with DECRYPT_SECONDS.time():
+                tag = decrypt_report(data, private_key_int(private_keys[report["id"]]))
+        except Exception as e:
+            logging.error(f"Report Decryption Failed: {e}", exc_info=True)
+            SYNC_REPORTS.labels(outcome="failed").inc()
+            return None
+        SYNC_REPORTS.labels(outcome="decrypted").inc()
+        return [(report, tag, False)]
+
+    def write(items):
+        if geocoder is not None:
+            unnamed = [tag for _, tag, _ in items if tag.get("place") is None]
+            places = geocoder.lookup_many([tag["lat"] for tag in unnamed], [tag["lon"] for tag in unnamed])
+            for tag, place in zip(unnamed, places):
+                tag["place"] = place
+        start = time.perf_counter()
+        with db.writer() as sq3:
+            for report, tag, stored in items:
+                if not stored:
+                    store(sq3, report, tag)
+        SQLITE_WRITE_SECONDS.observe(time.perf_counter() - start)
+        return items
+
+    pipeline = (Pipeline(maxsize)
+                .stage("fetch", fetch, workers=len(getattr(pool, "accounts", ())) or 1)
+                .stage("dedupe", dedupe, maxsize=FETCHED_QUEUE)
+                .stage("decrypt", decrypt, workers=decrypt_workers)
+                .stage("store", write, batch=store_batch))
+    pipeline.counts = counts
+    pipeline.failed = failed
+    return pipeline
+
+
+def sync_tags(db, private_keys, report_ids, hours, pool=account_pool, on_commit=None, on_report=None, geocoder=None):
+    """Fetch, decrypt and store the reports of report_ids, then record their poll.
+
+    private_keys maps report ids to base64 private keys, db is a ConnectionPool. Reports
+    are written batch by batch while later chunks are still being fetched, the poll is
+    recorded once all are in and on_commit(sq3, failed) runs in that last transaction,
+    which also writes the geofence enter and exit events of the new positions and adds
+    them to the heatmap cells. failed holds the ids upstream failed for while the others
+    were fetched, they are not recorded as polled. Every new report is passed to
+    on_report(report, tag) as soon as its batch is written. Returns the number of
+    decrypted reports, or None when upstream failed. geocoder names the new positions.
+    """
+    positions = {}
+    fresh = {}
+    decrypted = 0
+
+    def collect(item):
+        nonlocal decrypted
+        report, tag, stored = item
+        positions.setdefault(report["id"], []).append(tag)
+        decrypted += not stored
+        if not stored:
+            fresh.setdefault(report["id"], []).append(tag)
+            if on_report is not None:
+                on_report(report, tag)
+
+    pipeline = report_pipeline(db, private_keys, hours, pool, geocoder=geocoder).stage("collect", collect)
+    try:
+        pipeline.run(chunked(report_ids, FETCH_CHUNK))
+    except UpstreamError as e:
+        logging.error(f"Upstream informed an error. {e.status_code}")
+        return None
+    logging.debug(f"sync pipeline: {pipeline.stats()}")
+
+    with db.writer() as sq3:
+        # A tag that was not fetched has not been polled
+        record_poll(sq3, {key: key[:7] for key in report_ids if key not in pipeline.failed}, positions)
+        geofence_events = evaluate_geofences(sq3, positions)
+        update_heat_cells(sq3, fresh)
+        if on_commit is not None:
+            on_commit(sq3, pipeline.failed)
+    GEOFENCE_EVENTS.inc(geofence_events)
+    return decrypted
+
+
+def sync_claimed(db, owner, private_keys, report_ids, hours=1, pool=account_pool, lease_seconds=LEASE_SECONDS,
+                 on_report=None, geocoder=None):
+    """Run sync_tags() for tags owner leased with claim_jobs() and release the leases.
+
+    The leases are renewed every third of lease_seconds while upstream is queried, so a
+    slow batch is not handed to another worker, but one whose process died is. Tags are
+    released in the transaction that stores their reports, a failed batch is held back
+    for a retry delay. hours is the look-back for tags that were never polled.
+    """
+    stop = threading.Event()
+    unfetched = set()
+
+    def release(sq3, failed):
+        # Tags upstream failed for are retried like a failed batch
+        fetched = [report_id for report_id in report_ids if report_id not in failed]
+        if fetched:
+            complete_jobs(sq3, owner, fetched)
+        if failed:
+            fail_jobs(sq3, owner, sorted(failed))
+        unfetched.update(failed)
+
+    def beat():
+        while not stop.wait(lease_seconds / 3):
+            try:
+                with db.writer() as sq3:
+                    held = heartbeat(sq3, owner, report_ids, lease_seconds)
+            except Exception as e:
+                logging.error(f"Lease Heartbeat Failed: {e}", exc_info=True)
+                continue
+            if held < len(report_ids):
+                # Process work anyway, reports are stored idempotently
+                logging.warning(f"{len(report_ids) - held} lease(s) of {owner} were reclaimed by another worker")
+                SYNC_LEASES.labels(outcome="lost").inc(len(report_ids) - held)
+
+    thread = threading.Thread(target=beat, name=f"heartbeat-{owner}", daemon=True)
+    thread.start()
+    try:
+        _, lookback = due_tags(db.reader(), report_ids)
+        decrypted = sync_tags(db, private_keys, report_ids, lookback_hours(lookback, hours), pool,
+                              on_commit=release, on_report=on_report, geocoder=geocoder)
+    except Exception:
+        decrypted = None
+        logging.error(f"Sync of {len(report_ids)} tag(s) failed", exc_info=True)
+    finally:
+        stop.set()
+        thread.join()
+
+    if decrypted is None:
+        with db.writer() as sq3:
+            fail_jobs(sq3, owner, report_ids)
+        SYNC_LEASES.labels(outcome="failed").inc(len(report_ids))
+    else:
+        SYNC_LEASES.labels(outcome="completed").inc(len(report_ids) - len(unfetched))
+        SYNC_LEASES.labels(outcome="failed").inc(len(unfetched))
+    return decrypted
@@ -0,0 +1,175 @@
+import numpy as np
+
+EARTH_RADIUS_METERS = 6371000
+# Reports below this confidence are left out of every figure. 0 is the floor a finder sends without any estimate of
+# its fix, fuse() already gives those the least weight and here they are dropped
+MIN_CONF = 1
+# A report reached from the previous one and left for the next one faster than this (m/s, 300 km/h) is a stray fix
+MAX_SPEED = 300 / 3.6
+# Consecutive reports closer than this are the tag standing still
+STOP_RADIUS = 100
+# Standing still at least this long is a stop
+STOP_SECONDS = 10 * 60
+# No report for longer than this ends a trip
+TRIP_GAP = 2 * 60 * 60
+# Trips shorter than this are left out, they are mostly noise around a stop
+MIN_TRIP_METERS = 250
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    # Element-wise over arrays of degrees, in meters
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(value, dtype=float)) for value in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+def _runs(mask):
+    # Start and end (exclusive) indices of the runs of True in mask
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def _steps(codes, timestamps, lats, lons):
+    same = codes[1:] == codes[:-1]
+    distance = np.where(same, haversine(lats[:-1], lons[:-1], lats[1:], lons[1:]), 0)
+    seconds = np.where(same, timestamps[1:] - timestamps[:-1], 0)
+    speed = distance / np.maximum(seconds, 1)
+    return same, distance, seconds, speed
+
+
+def _span_mean(cumulative, starts, ends):
+    # Mean of the values summed up in cumulative (with a leading 0) over points starts..ends inclusive
+    return (cumulative[ends + 1] - cumulative[starts]) / (ends - starts + 1)
+
+
+def analyze_many(
+    tags,
+    timestamps,
+    lats,
+    lons,
+    confs=None,
+    min_conf=MIN_CONF,
+    max_speed=MAX_SPEED,
+    stop_radius=STOP_RADIUS,
+    stop_seconds=STOP_SECONDS,
+    trip_gap=TRIP_GAP,
+    min_trip_meters=MIN_TRIP_METERS,
+):
+    """Distance, speeds, stops and trips of every tag in one pass over flat arrays.
+
+    tags may be any labels, one per report, and the reports need not be sorted. Reports
+    below min_conf and single fixes implying a jump faster than max_speed there and
+    back are rejected first. Consecutive reports within stop_radius meters form a stop
+    once they span stop_seconds, the moves between stops form trips, split where no
+    report came in for trip_gap seconds. Returns {tag: summary}, speeds in m/s.
+    """
+    tags = np.asarray(tags)
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    labels, codes = np.unique(tags, return_inverse=True)
+    received = np.bincount(codes, minlength=len(labels))
+
+    keep = np.isfinite(lats) & np.isfinite(lons)
+    if confs is not None:
+        keep &= np.asarray(confs, dtype=float) >= min_conf
+    order = np.lexsort((timestamps, codes))
+    order = order[keep[order]]
+    codes, timestamps, lats, lons = codes[order], timestamps[order], lats[order], lons[order]
+
+    same, distance, seconds, speed = _steps(codes, timestamps, lats, lons)
+    too_fast = same & (speed > max_speed)
+    spike = np.concatenate(([False], too_fast)) & np.concatenate((too_fast, [False]))
+    if spike.any():
+        codes, timestamps, lats, lons = codes[~spike], timestamps[~spike], lats[~spike], lons[~spike]
+        same, distance, seconds, speed = _steps(codes, timestamps, lats, lons)
+    points = np.bincount(codes, minlength=len(labels))
+
+    # Stops: runs of short steps that last long enough
+    starts, ends = _runs(same & (distance <= stop_radius))
+    long_enough = timestamps[ends] - timestamps[starts] >= stop_seconds
+    stop_starts, stop_ends = starts[long_enough], ends[long_enough]
+    in_stop = np.zeros(len(same) + 1, dtype=np.int64)
+    np.add.at(in_stop, stop_starts, 1)
+    np.add.at(in_stop, stop_ends, -1)
+    in_stop = np.cumsum(in_stop)[:-1] > 0
+
+    # Trips: runs of the remaining steps, cut at tag changes and long silences
+    moving = same & ~in_stop & (seconds <= trip_gap)
+    trip_starts, trip_ends = _runs(moving)
+    step_distance = np.concatenate(([0], np.cumsum(distance)))
+    trip_meters = step_distance[trip_ends] - step_distance[trip_starts]
+    real = trip_meters >= min_trip_meters
+    trip_starts, trip_ends, trip_meters = trip_starts[real], trip_ends[real], trip_meters[real]
+
+    step_codes = codes[:-1]
+    total_meters = np.bincount(step_codes, weights=distance, minlength=len(labels))
+    moving_seconds = np.bincount(step_codes, weights=np.where(moving, seconds, 0), minlength=len(labels))
+    stopped_seconds = np.bincount(step_codes, weights=np.where(in_stop, seconds, 0), minlength=len(labels))
+    top_speed = np.zeros(len(labels))
+    np.maximum.at(top_speed, step_codes, np.where(same & (seconds > 0), speed, 0))
+
+    names = labels.tolist()
+    summaries = {}
+    for code, label in enumerate(names):
+        summaries[label] = {
+            "reports": int(received[code]),
+            "points": int(points[code]),
+            "rejected": int(received[code] - points[code]),
+            "distance_meters": round(float(total_meters[code]), 1),
+            "moving_seconds": int(moving_seconds[code]),
+            "stopped_seconds": int(stopped_seconds[code]),
+            "max_speed": round(float(top_speed[code]), 2),
+            "mean_speed": round(float(total_meters[code] / moving_seconds[code]), 2) if moving_seconds[code] else 0,
+            "stops": [],
+            "trips": [],
+        }
+
+    # Built from whole columns, a year of history can hold hundreds of thousands of stops
+    lat_sum = np.concatenate(([0], np.cumsum(lats)))
+    lon_sum = np.concatenate(([0], np.cumsum(lons)))
+    stops = zip(
+        codes[stop_starts].tolist(),
+        timestamps[stop_starts].tolist(),
+        timestamps[stop_ends].tolist(),
+        np.round(_span_mean(lat_sum, stop_starts, stop_ends), 7).tolist(),
+        np.round(_span_mean(lon_sum, stop_starts, stop_ends), 7).tolist(),
+        (stop_ends - stop_starts + 1).tolist(),
+    )
+    for code, start, end, lat, lon, count in stops:
+        summaries[names[code]]["stops"].append(
+            {"start": start, "end": end, "dwell_seconds": end - start, "lat": lat, "lon": lon, "points": count}
+        )
+
+    durations = timestamps[trip_ends] - timestamps[trip_starts]
+    trips = zip(
+        codes[trip_starts].tolist(),
+        timestamps[trip_starts].tolist(),
+        timestamps[trip_ends].tolist(),
+        np.round(trip_meters, 1).tolist(),
+        np.round(trip_meters / np.maximum(durations, 1), 2).tolist(),
+        lats[trip_starts].tolist(),
+        lons[trip_starts].tolist(),
+        lats[trip_ends].tolist(),
+        lons[trip_ends].tolist(),
+        (trip_ends - trip_starts + 1).tolist(),
+    )
+    for code, start, end, meters, mean_speed, lat0, lon0, lat1, lon1, count in trips:
+        summaries[names[code]]["trips"].append(
+            {
+                "start": start,
+                "end": end,
+                "distance_meters": meters,
+                "mean_speed": mean_speed,
+                "from": [lat0, lon0],
+                "to": [lat1, lon1],
+                "points": count,
+            }
+        )
+    return summaries
+
+
+def analyze(timestamps, lats, lons, confs=None, **options):
+    # analyze_many() for the reports of a single tag
+    summaries = analyze_many(np.zeros(len(timestamps), dtype=np.int8), timestamps, lats, lons, confs, **options)
+    return summaries.get(0) or analyze_many([0], [0], [0], [0])[0] | {"reports": 0, "points": 0}
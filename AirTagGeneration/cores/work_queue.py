@@ -0,0 +1,99 @@
+import base64
+import time
+
+from cores.report_db import tag_id_for
+
+# A claimed batch is handed to another worker when its lease is not renewed in time
+LEASE_SECONDS = 120
+# A failed batch is retried after this many seconds, doubling per attempt up to MAX_RETRY_DELAY
+RETRY_DELAY = 15
+MAX_RETRY_DELAY = 15 * 60
+
+# One row per monitored tag. A lease is held while lease_owner is set and lease_expires lies ahead,
+# a past lease_expires without owner holds a failed tag back until its retry time
+create_sync_jobs_query = """CREATE TABLE IF NOT EXISTS sync_jobs (
+tag_id INTEGER PRIMARY KEY, lease_owner TEXT, lease_expires REAL, attempts INTEGER DEFAULT 0);"""
+
+
+def create_queue_table(sq3):
+    sq3.execute(create_sync_jobs_query)
+
+
+def enqueue_tags(sq3, report_ids):
+    # Every monitored tag is a job, already queued ones are left alone
+    for report_id in report_ids:
+        sq3.execute("INSERT OR IGNORE INTO sync_jobs (tag_id) VALUES (?)", (tag_id_for(sq3, report_id),))
+    # Tags no longer monitored drop out of the queue
+    sq3.execute(
+        "DELETE FROM sync_jobs WHERE tag_id NOT IN (SELECT tag_id FROM tag_ids WHERE id IN (%s))"
+        % ",".join("?" * len(report_ids)),
+        [base64.b64decode(report_id) for report_id in report_ids],
+    )
+
+
+def claim_jobs(sq3, owner, limit, lease_seconds=LEASE_SECONDS, now=None):
+    """Lease up to limit due tags to owner and return their base64 ids and how many were reclaimed.
+
+    Must run in a write transaction (ConnectionPool.writer), which makes select and update
+    atomic across processes. Tags whose tag_schedule next_poll has not come yet are skipped,
+    the most overdue are handed out first.
+    """
+    now = now or time.time()
+    rows = sq3.execute(
+        "SELECT tag_id, tag_ids.id, lease_owner FROM sync_jobs JOIN tag_ids USING (tag_id) "
+        "LEFT JOIN tag_schedule USING (tag_id) "
+        "WHERE (lease_expires IS NULL OR lease_expires < :now) AND (next_poll IS NULL OR next_poll <= :now) "
+        "ORDER BY coalesce(next_poll, 0) LIMIT :limit",
+        {"now": now, "limit": limit},
+    ).fetchall()
+    sq3.executemany(
+        "UPDATE sync_jobs SET lease_owner = ?, lease_expires = ? WHERE tag_id = ?",
+        [(owner, now + lease_seconds, row[0]) for row in rows],
+    )
+    reclaimed = sum(1 for row in rows if row[2] is not None)
+    return [base64.b64encode(row[1]).decode("ascii") for row in rows], reclaimed
+
+
+def _owned(report_ids):
+    return "tag_id IN (SELECT tag_id FROM tag_ids WHERE id IN (%s)) AND lease_owner = ?" % ",".join(
+        "?" * len(report_ids)
+    )
+
+
+def _ids(report_ids):
+    return [base64.b64decode(report_id) for report_id in report_ids]
+
+
+def heartbeat(sq3, owner, report_ids, lease_seconds=LEASE_SECONDS, now=None):
+    # Returns how many of the leases were still held, the rest went to another worker
+    now = now or time.time()
+    return sq3.execute(
+        "UPDATE sync_jobs SET lease_expires = ? WHERE " + _owned(report_ids),
+        [now + lease_seconds] + _ids(report_ids) + [owner],
+    ).rowcount
+
+
+def complete_jobs(sq3, owner, report_ids):
+    sq3.execute(
+        "UPDATE sync_jobs SET lease_owner = NULL, lease_expires = NULL, attempts = 0 WHERE " + _owned(report_ids),
+        _ids(report_ids) + [owner],
+    )
+
+
+def fail_jobs(sq3, owner, report_ids, now=None):
+    now = now or time.time()
+    sq3.execute(
+        "UPDATE sync_jobs SET lease_owner = NULL, attempts = attempts + 1, "
+        "lease_expires = ? + min(?, ? * (1 << min(attempts, 16))) WHERE " + _owned(report_ids),
+        [now, MAX_RETRY_DELAY, RETRY_DELAY] + _ids(report_ids) + [owner],
+    )
+
+
+def queue_stats(sq3, now=None):
+    now = now or time.time()
+    row = sq3.execute(
+        "SELECT count(*), sum(lease_owner IS NOT NULL AND lease_expires >= :now), "
+        "sum(lease_owner IS NOT NULL AND lease_expires < :now), sum(attempts > 0) FROM sync_jobs",
+        {"now": now},
+    ).fetchone()
+    return {"jobs": row[0], "leased": row[1] or 0, "expired": row[2] or 0, "failing": row[3] or 0}
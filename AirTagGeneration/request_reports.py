@@ -1,54 +1,20 @@
 #!/usr/bin/env python3
 import argparse
-import base64
 import datetime
 import glob
-import hashlib
-import json
 import os
 import sqlite3
-import struct
+import sys
 
-import requests
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-
-from cores.pypush_gsa_icloud import icloud_login_mobileme, generate_anisette_headers
-
-
-def sha256(data):
-    digest = hashlib.new("sha256")
-    digest.update(data)
-    return digest.digest()
-
-
-def decrypt(enc_data, algorithm_dkey, mode):
-    decryptor = Cipher(algorithm_dkey, mode, default_backend()).decryptor()
-    return decryptor.update(enc_data) + decryptor.finalize()
-
-
-def decode_tag(data):
-    latitude = struct.unpack(">i", data[0:4])[0] / 10000000.0
-    longitude = struct.unpack(">i", data[4:8])[0] / 10000000.0
-    confidence = int.from_bytes(data[8:9], 'big')
-    status = int.from_bytes(data[9:10], 'big')
-    return {'lat': latitude, 'lon': longitude, 'conf': confidence, 'status': status}
-
-
-def getAuth(regenerate=False, second_factor='sms'):
-    CONFIG_PATH = os.path.dirname(os.path.realpath(__file__)) + "/keys/auth.json"
-    if os.path.exists(CONFIG_PATH) and not regenerate:
-        with open(CONFIG_PATH, "r") as f:
-            j = json.load(f)
-    else:
-        mobileme = icloud_login_mobileme(second_factor=second_factor)
-        j = {'dsid': mobileme['dsid'],
-             'searchPartyToken': mobileme['delegates']['com.apple.mobileme']['service-data']['tokens'][
-                 'searchPartyToken']}
-        with open(CONFIG_PATH, "w") as f:
-            json.dump(j, f)
-    return (j['dsid'], j['searchPartyToken'])
+from cores.account_pool import getAuth
+from cores.db_pool import ConnectionPool
+from cores.geocoder import GAZETTEER_PATH, load_geocoder
+from cores.heatmap import create_heat_tables
+from cores.heatmap import update as update_heat_cells
+from cores.pipeline import chunked
+from cores.report_db import assign_fleets, create_tables, insert_report, latest_positions
+from cores.scheduler import create_schedule_table, due_tags, lookback_hours, record_poll
+from cores.sync import FETCH_CHUNK, UpstreamError, report_pipeline
 
 
 if __name__ == "__main__":
@@ -56,100 +22,121 @@ if __name__ == "__main__":
 
         parser = argparse.ArgumentParser()
         parser.add_argument('-H', '--hours', help='only show reports not older than these hours', type=int, default=24)
-        parser.add_argument('-p', '--prefix', help='only use keyfiles starting with this prefix', default='')
+        parser.add_argument('-p', '--prefix', help='only use keyfiles starting with this prefix, repeat to handle '
+                                                  'several fleets with one fetch', action='append')
         parser.add_argument('-r', '--regen', help='regenerate search-party-token', action='store_true')
         parser.add_argument('-t', '--trusteddevice', help='use trusted device for 2FA instead of SMS',
                             action='store_true')
+        parser.add_argument('-s', '--scheduled', help='only fetch tags whose adaptive poll interval has elapsed',
+                            action='store_true')
+        parser.add_argument('--gazetteer', help='GeoNames dump or CSV of name,lat,lon used to label positions with the '
+                                                'nearest place, used when the file exists', default=GAZETTEER_PATH,
+                            metavar='FILE')
         args = parser.parse_args()
 
-        sq3db = sqlite3.connect(os.path.dirname(os.path.realpath(__file__)) + '/keys/reports.db')
+        db_path = os.path.dirname(os.path.realpath(__file__)) + '/keys/reports.db'
+        sq3db = sqlite3.connect(db_path)
         sq3 = sq3db.cursor()
 
         privkeys = {}
         names = {}
-        for keyfile in glob.glob(os.path.dirname(os.path.realpath(__file__)) + '/keys/' + args.prefix + '*.keys'):
-            # read key files generated with generate_keys.py
-            with open(keyfile) as f:
-                hashed_adv = priv = ''
-                name = os.path.basename(keyfile)[len(args.prefix):-5]
-                for line in f:
-                    key = line.rstrip('\n').split(': ')
-                    if key[0] == 'Private key':
-                        priv = key[1]
-                    elif key[0] == 'Hashed adv key':
-                        hashed_adv = key[1]
-
-                if priv and hashed_adv:
-                    privkeys[hashed_adv] = priv
-                    names[hashed_adv] = name
-                else:
-                    print(f"Couldn't find key pair in {keyfile}")
-
-        unixEpoch = int(datetime.datetime.now().timestamp())
-        startdate = unixEpoch - (60 * 60 * args.hours)
-        data = {"search": [{"startDate": startdate * 1000, "endDate": unixEpoch * 1000, "ids": list(names.keys())}]}
-
-        r = requests.post("https://gateway.icloud.com/acsnservice/fetch",
-                          auth=getAuth(regenerate=args.regen,
-                                       second_factor='trusted_device' if args.trusteddevice else 'sms'),
-                          headers=generate_anisette_headers(),
-                          json=data)
-        res = json.loads(r.content.decode())['results']
-        print(f'{r.status_code}: {len(res)} reports received.')
+        prefixes = args.prefix or ['']
+        # Tags of every prefix are fetched together, fleets remembers which prefix they came from
+        fleets = {prefix: set() for prefix in prefixes}
+        for prefix in prefixes:
+            for keyfile in glob.glob(os.path.dirname(os.path.realpath(__file__)) + '/keys/' + prefix + '*.keys'):
+                # read key files generated with generate_keys.py
+                with open(keyfile) as f:
+                    hashed_adv = priv = ''
+                    name = os.path.basename(keyfile)[len(prefix):-5]
+                    for line in f:
+                        key = line.rstrip('\n').split(': ')
+                        if key[0] == 'Private key':
+                            priv = key[1]
+                        elif key[0] == 'Hashed adv key':
+                            hashed_adv = key[1]
+
+                    if priv and hashed_adv:
+                        privkeys[hashed_adv] = priv
+                        # Keep tag1.keys of two prefixes apart
+                        names[hashed_adv] = prefix + name if len(prefixes) > 1 else name
+                        fleets[prefix].add(hashed_adv)
+                    else:
+                        print(f"Couldn't find key pair in {keyfile}")
+
+        if args.scheduled:
+            create_tables(sq3)
+            create_schedule_table(sq3)
+            due, lookback = due_tags(sq3, names)
+            names = {hashed_adv: names[hashed_adv] for hashed_adv in due}
+            args.hours = lookback_hours(lookback, args.hours)
+            if not names:
+                print('No tag is due for polling yet.')
+                sys.exit(0)
+            print(f'{len(names)} tag(s) due, looking back {args.hours} hour(s).')
+
+        getAuth(regenerate=args.regen, second_factor='trusted_device' if args.trusteddevice else 'sms')
+
+        # Create the report tables if they do not exist, migrating databases that still store base64 TEXT. The heatmap
+        # cells are backfilled now, before this run's reports are stored and added to them below
+        create_tables(sq3)
+        create_heat_tables(sq3)
+        sq3db.commit()
+
+        def store(sq3, report, tag):
+            # SQL Injection Mitigation
+            insert_report(sq3, names[report['id']], tag['timestamp'], report['datePublished'], report['payload'],
+                          report['id'], report['statusCode'], tag['lat'], tag['lon'], tag['conf'],
+                          tag.get('place'))
+
+        # Fetched chunks are decrypted and written in batches while the next ones are still in flight. Repeated and
+        # already stored reports are not decrypted again, stored ones are read back instead
+        pipeline = report_pipeline(ConnectionPool(db_path), privkeys, args.hours, store=store, drop_older=True,
+                                   geocoder=load_geocoder(args.gazetteer))
+        try:
+            results = pipeline.run(chunked(names, FETCH_CHUNK))
+        except UpstreamError as e:
+            print(e)
+            sys.exit(1)
+        counts = pipeline.counts
+        print(f'{counts["fetched"]} reports received.')
+        print(f'{counts["duplicate"]} duplicate and {counts["stored"]} already stored reports skipped.')
 
         ordered = []
         found = set()
-
-        # SQL query to create a table named 'report' if it does not exist
-        create_table_query = '''CREATE TABLE IF NOT EXISTS reports (
-        id_short TEXT, timestamp INTEGER, datePublished INTEGER, payload TEXT, 
-        id TEXT, statusCode INTEGER, lat TEXT, lon TEXT, conf INTEGER, PRIMARY KEY(id_short,timestamp));'''
-
-        # Execute the SQL query
-        sq3.execute(create_table_query)
-
-        for report in res:
-            priv = int.from_bytes(base64.b64decode(privkeys[report['id']]), byteorder='big')
-            data = base64.b64decode(report['payload'])
-            # the following is all copied from https://github.com/hatomist/openhaystack-python, thanks @hatomist!
-            timestamp = int.from_bytes(data[0:4], 'big') + 978307200
-
-            if timestamp >= startdate:
-                # check if NULL bytes are present in the data
-                adj = len(data) - 88
-
-                # If so slice the data accordingly | Thanks, @c4pitalSteez!
-                eph_key = ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP224R1(), data[5+adj:62+adj])
-                shared_key = ec.derive_private_key(priv, ec.SECP224R1(), default_backend()).exchange(ec.ECDH(), eph_key)
-                symmetric_key = sha256(shared_key + b'\x00\x00\x00\x01' + data[5+adj:62+adj])
-                decryption_key = symmetric_key[:16]
-                iv = symmetric_key[16:]
-                enc_data = data[62+adj:72+adj]
-                auth_tag = data[72+adj:]
-
-                decrypted = decrypt(enc_data, algorithms.AES(decryption_key), modes.GCM(iv, auth_tag))
-                tag = decode_tag(decrypted)
-                tag['timestamp'] = timestamp
-                tag['isodatetime'] = datetime.datetime.fromtimestamp(timestamp).isoformat()
-                tag['key'] = names[report['id']]
-                tag['goog'] = 'https://maps.google.com/maps?q=' + str(tag['lat']) + ',' + str(tag['lon'])
-                found.add(tag['key'])
-                ordered.append(tag)
-
-                # SQL Injection Mitigation
-                query = "INSERT OR REPLACE INTO reports VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
-                parameters = (names[report['id']], timestamp, report['datePublished'], report['payload'], report['id'],
-                              report['statusCode'], str(tag['lat']), str(tag['lon']), tag['conf'])
-                sq3.execute(query, parameters)
+        positions = {}
+        # New reports per id for the heatmap cells, the ones read back are already counted
+        fresh = {}
+
+        for report, tag, stored in results:
+            tag['key'] = names[report['id']]
+            tag['goog'] = 'https://maps.google.com/maps?q=' + str(tag['lat']) + ',' + str(tag['lon'])
+            found.add(tag['key'])
+            ordered.append(tag)
+            positions.setdefault(report['id'], []).append(tag)
+            if not stored:
+                fresh.setdefault(report['id'], []).append(tag)
+
+        update_heat_cells(sq3, fresh)
+        if args.scheduled:
+            record_poll(sq3, names, positions)
 
         print(f'{len(ordered)} reports used.')
         ordered.sort(key=lambda item: item.get('timestamp'))
         for rep in ordered: print(rep)
+        if len(prefixes) > 1:
+            assign_fleets(sq3, {prefix.rstrip('_-.') or prefix: {k: names[k] for k in fleets[prefix] if k in names}
+                                for prefix in prefixes})
+            for prefix in prefixes:
+                fleet_names = [names[k] for k in fleets[prefix] if k in names]
+                print(f'{prefix}: found {len([n for n in fleet_names if n in found])}/{len(fleet_names)}')
         print(f'found:   {list(found)}')
         print(f'missing: {[key for key in names.values() if key not in found]}')
-        
-        res = json.loads(r.content.decode())['results']
-        if r.status_code == 200 and len(res) == 0:
+        for hashed_adv, last in latest_positions(sq3, [k for k in names if names[k] not in found]).items():
+            print(f"last known position of {names[hashed_adv]}: {last['lat']},{last['lon']} at "
+                  f"{datetime.datetime.fromtimestamp(last['timestamp']).isoformat()}")
+
+        if counts['fetched'] == 0:
             print()
             print("No reports have been uploaded yet. Bring your Flipper to a more populated area and try again.")
             print("For best results, lower the interval to 1 second and increase power to 6 dBm.")
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# Fetches the tags monitored by web_service.py in batches leased from the sync_jobs queue in keys/reports.db.
+# Run as many as needed, on one host or on several sharing the database: each tag is fetched by one worker at a
+# time, and the batch of a worker that died is picked up by another once its lease expires.
+import argparse
+import logging
+import os
+import socket
+import sys
+import time
+
+import cores.pypush_gsa_icloud
+from cores.account_pool import AccountPool, account_pool
+from cores.db_pool import ConnectionPool
+from cores.geocoder import GAZETTEER_PATH, load_geocoder
+from cores.geofence import create_geofence_tables
+from cores.heatmap import create_heat_tables
+from cores.metrics import SYNC_LEASES
+from cores.report_db import create_tables
+from cores.scheduler import create_schedule_table
+from cores.sync import sync_claimed
+from cores.work_queue import LEASE_SECONDS, claim_jobs, create_queue_table, enqueue_tags, queue_stats
+
+DB_PATH = os.path.dirname(os.path.realpath(__file__)) + '/keys/reports.db'
+
+
+def run(db, pool, owner, batch_size, lease_seconds, hours, idle_seconds, once, geocoder=None):
+    while True:
+        private_keys = dict(db.reader().execute("SELECT hash_adv_key, private_key FROM tags").fetchall())
+        due, reclaimed = [], 0
+        if private_keys:
+            with db.writer() as sq3:
+                enqueue_tags(sq3, list(private_keys))
+                due, reclaimed = claim_jobs(sq3, owner, batch_size, lease_seconds)
+        SYNC_LEASES.labels(outcome="claimed").inc(len(due))
+        SYNC_LEASES.labels(outcome="reclaimed").inc(reclaimed)
+
+        if not due:
+            if once:
+                return
+            time.sleep(idle_seconds)
+            continue
+
+        start = time.perf_counter()
+        decrypted = sync_claimed(db, owner, private_keys, due, hours, pool, lease_seconds, geocoder=geocoder)
+        logging.info(f"{owner}: {len(due)} tag(s), {reclaimed} reclaimed, "
+                     f"{'failed' if decrypted is None else f'{decrypted} new report(s)'} "
+                     f"in {time.perf_counter() - start:.2f}s, queue {queue_stats(db.reader())}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', '--batch-size', help='tags leased and fetched together', type=int, default=50)
+    parser.add_argument('-l', '--lease', help='seconds before an unrenewed batch goes to another worker', type=int,
+                        default=LEASE_SECONDS)
+    parser.add_argument('-H', '--hours', help='look-back for tags that were never polled', type=int, default=24)
+    parser.add_argument('-i', '--idle', help='seconds to wait when no tag is due', type=float, default=30)
+    parser.add_argument('--once', help='exit once no tag is due instead of waiting for more', action='store_true')
+    parser.add_argument('--worker-id', help='lease owner name, defaults to host and pid',
+                        default=f"sync_worker-{socket.gethostname()}-{os.getpid()}")
+    parser.add_argument('--db', help='reports database shared with web_service.py', default=DB_PATH)
+    parser.add_argument('--fetch-url', help='acsnservice/fetch endpoint, e.g. of a local proxy')
+    parser.add_argument('--anisette-url', help='anisette server used when pyprovision is not installed')
+    parser.add_argument('--gazetteer', help='places file to reverse geocode new reports with, used when it exists',
+                        default=GAZETTEER_PATH)
+    parser.add_argument('-v', '--verbose', help='log every batch', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+    if args.anisette_url:
+        cores.pypush_gsa_icloud.ANISETTE_URL = args.anisette_url
+    pool = AccountPool.load(fetch_url=args.fetch_url) if args.fetch_url else account_pool
+    pool.get()
+
+    db = ConnectionPool(args.db)
+    if db.reader().execute("SELECT name FROM sqlite_master WHERE name = 'tags'").fetchone() is None:
+        print(f"No monitored tags in {args.db}, add some with web_service.py /KeyToMonitor/ first")
+        sys.exit(1)
+    with db.writer() as sq3:
+        create_tables(sq3, commit=False)
+        create_schedule_table(sq3, commit=False)
+        create_queue_table(sq3)
+        create_geofence_tables(sq3)
+        create_heat_tables(sq3)
+
+    try:
+        run(db, pool, args.worker_id, args.batch_size, args.lease, args.hours, args.idle, args.once,
+            load_geocoder(args.gazetteer))
+    except KeyboardInterrupt:
+        # Leases still held simply expire and go to the other workers
+        pass
@@ -0,0 +1,33 @@
+import base64
+import os
+import sqlite3
+import sys
+
+import pytest
+
+# The scripts import cores.* relative to AirTagGeneration, whichever directory pytest runs from
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from cores.db_pool import ConnectionPool  # noqa: E402
+from cores.report_db import create_tables  # noqa: E402
+
+
+def report_id(n):
+    # A base64 hashed advertisement key, 32 bytes like the real ones
+    return base64.b64encode(bytes([n]) * 32).decode("ascii")
+
+
+@pytest.fixture
+def sq3():
+    cursor = sqlite3.connect(":memory:").cursor()
+    create_tables(cursor)
+    yield cursor
+    cursor.connection.close()
+
+
+@pytest.fixture
+def db(tmp_path):
+    pool = ConnectionPool(str(tmp_path / "reports.db"))
+    with pool.writer() as cursor:
+        create_tables(cursor, commit=False)
+    return pool
@@ -0,0 +1,38 @@
+import base64
+
+from conftest import report_id
+from cores.dedup import dedupe_reports
+from cores.report_crypto import APPLE_EPOCH
+from cores.report_db import insert_report
+
+
+def report(n, timestamp, extra=b""):
+    data = (timestamp - APPLE_EPOCH).to_bytes(4, "big") + extra + bytes(84)
+    return {"id": report_id(n), "payload": base64.b64encode(data).decode("ascii"),
+            "datePublished": timestamp * 1000, "statusCode": 0}
+
+
+def test_repeats_are_dropped():
+    reports = [report(1, APPLE_EPOCH + 100), report(1, APPLE_EPOCH + 100), report(2, APPLE_EPOCH + 100)]
+    fresh, stored, counts = dedupe_reports(reports)
+    assert fresh == [reports[0], reports[2]] and stored == []
+    assert counts == {"duplicate": 1, "stored": 0}
+
+
+def test_seen_carries_over_calls():
+    seen = set()
+    dedupe_reports([report(1, APPLE_EPOCH + 100)], seen=seen)
+    fresh, _, counts = dedupe_reports([report(1, APPLE_EPOCH + 100)], seen=seen)
+    assert fresh == [] and counts["duplicate"] == 1
+
+
+def test_stored_reports_are_read_back(sq3):
+    timestamp = APPLE_EPOCH + 100
+    known = report(1, timestamp)
+    insert_report(sq3, "tag1", timestamp, known["datePublished"], known["payload"], known["id"], 0, 52.5, 13.4, 50)
+    # Same timestamp with another payload is a different report
+    changed = report(1, timestamp, extra=b"\x01")
+    new, stored, counts = dedupe_reports([known, changed, report(2, timestamp)], sq3)
+    assert new == [changed, report(2, timestamp)]
+    assert [(item[0], item[1]["lat"]) for item in stored] == [(known, 52.5)]
+    assert counts == {"duplicate": 0, "stored": 1}
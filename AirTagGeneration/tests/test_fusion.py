@@ -0,0 +1,34 @@
+import pytest
+
+from cores.fusion import fuse_reports
+from cores.geocoder import Geocoder
+
+
+def tag(key, timestamp, lat, lon, conf):
+    return {"key": key, "timestamp": timestamp, "lat": lat, "lon": lon, "conf": conf, "goog": ""}
+
+
+def test_fuse_reports_weighs_by_confidence():
+    tags = [tag("a", 1000, 10.0, 20.0, 100), tag("a", 1010, 10.3, 20.0, 50), tag("a", 1200, 11.0, 21.0, 10),
+            tag("b", 1005, 0.0, 0.0, 10)]
+    fused = fuse_reports(tags)
+    assert [(item["key"], item["fused"]) for item in fused] == [("a", 2), ("b", 1), ("a", 1)]
+    assert fused[0]["lat"] == pytest.approx(10.1)
+    assert fused[0]["conf"] == 100
+    assert fused[0]["goog"].endswith(f"{fused[0]['lat']},{fused[0]['lon']}")
+    assert fuse_reports([]) == []
+
+
+def test_fuse_reports_smoothing_keeps_shape():
+    tags = [tag("a", 1000 + 120 * i, 10.0 + 0.001 * i, 20.0, 50) for i in range(10)]
+    smoothed = fuse_reports(tags, smooth=True)
+    assert len(smoothed) == 10
+    assert all(abs(item["lat"] - original["lat"]) < 0.001 for item, original in zip(smoothed, tags))
+
+
+def test_geocoder_nearest_place():
+    geocoder = Geocoder([52.52, 48.14], [13.40, 11.58], ["Berlin", "Munich"])
+    assert geocoder.lookup_many([52.5, 48.1, 0.0, 52.5], [13.4, 11.6, 0.0, 13.4]) == [
+        "Berlin", "Munich", None, "Berlin"]
+    assert geocoder.lookup(48.14, 11.58) == "Munich"
+    assert geocoder.lookup_many([], []) == []
@@ -0,0 +1,66 @@
+import pytest
+
+from conftest import report_id
+from cores.geofence import Fence, GeofenceIndex, add_fence, create_geofence_tables, delete_fence, evaluate, event_rows
+from cores.report_db import tag_id_for
+
+SQUARE = {"points": [[0.0, 0.0], [0.0, 1.0], [1.0, 1.0], [1.0, 0.0]]}
+
+
+def test_circle():
+    fence = Fence(1, "Home", "circle", {"lat": 52.5, "lon": 13.4, "radius": 500})
+    assert fence.contains(52.5, 13.4)
+    assert fence.contains(52.503, 13.4)
+    assert not fence.contains(52.51, 13.4)
+
+
+def test_polygon():
+    fence = Fence(1, "Square", "polygon", SQUARE)
+    assert fence.contains(0.5, 0.5)
+    assert not fence.contains(1.5, 0.5)
+    concave = Fence(2, "L", "polygon", {"points": [[0, 0], [0, 2], [1, 2], [1, 1], [2, 1], [2, 0]]})
+    assert concave.contains(1.5, 0.5)
+    assert not concave.contains(1.5, 1.5)
+
+
+def test_invalid_fences():
+    with pytest.raises(ValueError):
+        Fence(1, "Line", "polygon", {"points": [[0, 0], [1, 1]]})
+    with pytest.raises(ValueError):
+        Fence(1, "Box", "box", {})
+
+
+def test_index_matches_brute_force():
+    fences = [Fence(1, "Square", "polygon", SQUARE),
+              Fence(2, "Home", "circle", {"lat": 0.5, "lon": 0.5, "radius": 1000}),
+              Fence(3, "Far", "circle", {"lat": 40.0, "lon": -3.7, "radius": 2000}),
+              # Too many cells for the grid, tested by bounding box
+              Fence(4, "Europe", "polygon", {"points": [[35, -10], [35, 40], [70, 40], [70, -10]]})]
+    index = GeofenceIndex(fences)
+    assert index.large == [fences[3]]
+    for lat, lon in [(0.5, 0.5), (0.2, 0.9), (40.0, -3.7), (40.1, -3.7), (52.5, 13.4), (-5, -5)]:
+        assert index.containing(lat, lon) == {fence.fence_id for fence in fences if fence.contains(lat, lon)}
+
+
+def test_evaluate_enter_and_exit(sq3):
+    create_geofence_tables(sq3)
+    fence_id = add_fence(sq3, "Square", "polygon", SQUARE)
+    tag_id_for(sq3, report_id(1))
+    positions = [{"timestamp": 300, "lat": 2.0, "lon": 2.0}, {"timestamp": 200, "lat": 0.5, "lon": 0.5},
+                 {"timestamp": 100, "lat": 2.0, "lon": 2.0}]
+    assert evaluate(sq3, {report_id(1): positions}) == 2
+    # Reports older than the newest evaluated one are not replayed
+    assert evaluate(sq3, {report_id(1): [{"timestamp": 250, "lat": 0.5, "lon": 0.5}]}) == 0
+    assert [(event["fence_id"], event["event"], event["timestamp"]) for event in event_rows(sq3)] == [
+        (fence_id, "enter", 200),
+        (fence_id, "exit", 300),
+    ]
+
+    delete_fence(sq3, fence_id)
+    assert event_rows(sq3) == []
+
+
+def test_evaluate_skips_unknown_tags(sq3):
+    create_geofence_tables(sq3)
+    add_fence(sq3, "Square", "polygon", SQUARE)
+    assert evaluate(sq3, {report_id(1): [{"timestamp": 100, "lat": 0.5, "lon": 0.5}]}) == 0
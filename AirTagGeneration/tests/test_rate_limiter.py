@@ -0,0 +1,34 @@
+import threading
+import time
+
+from cores.rate_limiter import RateLimiter
+
+
+def test_burst_then_rate():
+    limiter = RateLimiter(rate=20, burst=3)
+    waits = [limiter.acquire() for _ in range(5)]
+    assert all(wait < 0.01 for wait in waits[:3])
+    assert sum(waits[3:]) >= 0.09
+
+
+def test_throttling_halves_the_rate_and_recovers():
+    limiter = RateLimiter(rate=10, burst=1)
+    limiter.record(429, retry_after=0)
+    assert limiter.rate == 5 and limiter.backoff == 1
+    limiter.record(200)
+    assert limiter.rate == 6 and limiter.backoff == 0
+
+
+def test_pause_does_not_use_up_slots():
+    limiter = RateLimiter(rate=10, burst=1)
+    start = time.monotonic()
+    threads = [threading.Thread(target=limiter.acquire) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    # Callers asleep on their slot wait for the pause as well, but keep the slot they reserved
+    limiter.record(429, retry_after=0.3)
+    for thread in threads:
+        thread.join()
+    assert time.monotonic() - start >= 0.3
+    assert limiter._tat - start < 0.5
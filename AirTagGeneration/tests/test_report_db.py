@@ -0,0 +1,120 @@
+import base64
+import sqlite3
+
+from conftest import report_id
+from cores.geofence import add_fence, create_geofence_tables, evaluate, event_rows
+from cores.report_db import (
+    create_tables,
+    delete_tag,
+    insert_report,
+    latest_positions,
+    stored_reports,
+    tag_id_for,
+    tag_id_of,
+)
+from cores.work_queue import create_queue_table, enqueue_tags
+
+# reports as request_reports.py created it before tag_ids existed
+create_text_reports_query = """CREATE TABLE reports (
+id_short TEXT, timestamp INTEGER, datePublished INTEGER, payload TEXT,
+id TEXT, statusCode INTEGER, lat TEXT, lon TEXT, conf INTEGER, PRIMARY KEY(id_short,timestamp));"""
+
+
+def payload(timestamp):
+    return base64.b64encode(timestamp.to_bytes(4, "big") + bytes(84)).decode("ascii")
+
+
+def store(sq3, n, timestamp, lat=52.5, lon=13.4):
+    insert_report(sq3, f"tag{n}", timestamp, timestamp * 1000, payload(timestamp), report_id(n), 0, lat, lon, 50)
+
+
+def test_migrate_text_tables():
+    sq3 = sqlite3.connect(":memory:").cursor()
+    sq3.execute(create_text_reports_query)
+    rows = [("tag1", 100, 100000, payload(100), report_id(1), 0, "52.5", "13.4", 50),
+            ("tag1", 200, 200000, payload(200), report_id(1), 0, "52.6", "13.5", 60),
+            ("tag2", 150, 150000, payload(150), report_id(2), 0, "48.1", "11.6", 70)]
+    sq3.executemany("INSERT INTO reports VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    sq3.connection.commit()
+
+    create_tables(sq3)
+
+    assert "id" not in [column[1] for column in sq3.execute("PRAGMA table_info(reports)")]
+    assert sq3.execute("SELECT typeof(id), id_short FROM tag_ids WHERE id = ?",
+                       (base64.b64decode(report_id(1)),)).fetchone() == ("blob", "tag1")
+    stored = stored_reports(sq3, [report_id(1), report_id(2)], 0, 1000)
+    assert sorted(stored) == [(report_id(1), 100), (report_id(1), 200), (report_id(2), 150)]
+    assert stored[(report_id(1), 200)]["payload"] == base64.b64decode(payload(200))
+    assert stored[(report_id(1), 200)]["lat"] == 52.6
+    # latest_position is backfilled from the migrated reports
+    latest = latest_positions(sq3)
+    assert (latest[report_id(1)]["timestamp"], latest[report_id(2)]["timestamp"]) == (200, 150)
+    assert sq3.execute("SELECT name FROM sqlite_master WHERE name LIKE '%_text'").fetchall() == []
+
+
+def test_migrate_text_tables_is_idempotent(sq3):
+    store(sq3, 1, 100)
+    create_tables(sq3)
+    assert list(stored_reports(sq3, [report_id(1)], 0, 1000)) == [(report_id(1), 100)]
+
+
+def test_tag_ids_without_autoincrement_keep_their_ids():
+    sq3 = sqlite3.connect(":memory:").cursor()
+    sq3.execute("CREATE TABLE tag_ids (tag_id INTEGER PRIMARY KEY, id BLOB UNIQUE NOT NULL, id_short TEXT)")
+    sq3.execute("INSERT INTO tag_ids VALUES (7, ?, 'tag1')", (base64.b64decode(report_id(1)),))
+    create_tables(sq3)
+
+    assert tag_id_of(sq3, report_id(1)) == 7
+    assert tag_id_for(sq3, report_id(2)) == 8
+    delete_tag(sq3, report_id(2))
+    assert tag_id_for(sq3, report_id(3)) == 9
+
+
+def test_insert_report_keeps_latest_position(sq3):
+    store(sq3, 1, 200, lat=1.0)
+    store(sq3, 1, 100, lat=2.0)
+    assert latest_positions(sq3)[report_id(1)]["lat"] == 1.0
+    store(sq3, 1, 300, lat=3.0)
+    assert latest_positions(sq3)[report_id(1)]["lat"] == 3.0
+
+
+def test_delete_tag(sq3):
+    create_queue_table(sq3)
+    store(sq3, 1, 100)
+    store(sq3, 2, 100)
+    enqueue_tags(sq3, [report_id(1), report_id(2)])
+
+    delete_tag(sq3, report_id(1))
+
+    assert tag_id_of(sq3, report_id(1)) is None
+    assert list(latest_positions(sq3)) == [report_id(2)]
+    assert list(stored_reports(sq3, [report_id(1), report_id(2)], 0, 1000)) == [(report_id(2), 100)]
+    assert sq3.execute("SELECT count(*) FROM sync_jobs").fetchone() == (1,)
+    # Unknown tags are ignored
+    delete_tag(sq3, report_id(3))
+
+
+def test_delete_then_add_starts_clean(sq3):
+    create_geofence_tables(sq3)
+    add_fence(sq3, "Home", "circle", {"lat": 52.5, "lon": 13.4, "radius": 500})
+    store(sq3, 1, 5000)
+    old_tag_id = tag_id_of(sq3, report_id(1))
+    assert evaluate(sq3, {report_id(1): [{"timestamp": 5000, "lat": 52.5, "lon": 13.4}]}) == 1
+
+    delete_tag(sq3, report_id(1))
+    for table in ("geofence_state", "geofence_tags", "geofence_events"):
+        assert sq3.execute(f"SELECT count(*) FROM {table}").fetchone() == (0,)
+
+    # A new tag never gets the removed tag's id, nor its place in fences or the newest evaluated timestamp
+    assert tag_id_for(sq3, report_id(2)) != old_tag_id
+    positions = [{"timestamp": 4000, "lat": 52.5, "lon": 13.4}, {"timestamp": 6000, "lat": 50.0, "lon": 10.0}]
+    assert evaluate(sq3, {report_id(2): positions}) == 2
+    assert [(event["id"], event["event"], event["timestamp"]) for event in event_rows(sq3)] == [
+        (report_id(2), "enter", 4000),
+        (report_id(2), "exit", 6000),
+    ]
+
+    # Adding the removed tag back starts it over too
+    store(sq3, 1, 7000)
+    assert tag_id_of(sq3, report_id(1)) not in (old_tag_id, tag_id_of(sq3, report_id(2)))
+    assert list(stored_reports(sq3, [report_id(1)], 0, 10000)) == [(report_id(1), 7000)]
@@ -0,0 +1,99 @@
+import pytest
+
+from conftest import report_id
+from cores.report_db import tag_id_for
+from cores.scheduler import create_schedule_table
+from cores.work_queue import (
+    LEASE_SECONDS,
+    RETRY_DELAY,
+    claim_jobs,
+    complete_jobs,
+    create_queue_table,
+    enqueue_tags,
+    fail_jobs,
+    heartbeat,
+    queue_stats,
+)
+
+NOW = 1_000_000
+IDS = [report_id(n) for n in range(1, 4)]
+
+
+@pytest.fixture
+def queue(db):
+    with db.writer() as sq3:
+        create_schedule_table(sq3, commit=False)
+        create_queue_table(sq3)
+        enqueue_tags(sq3, IDS)
+    return db
+
+
+def claim(db, owner, limit=10, now=NOW):
+    with db.writer() as sq3:
+        return claim_jobs(sq3, owner, limit, now=now)
+
+
+def test_claim_hands_out_each_tag_once(queue):
+    first, reclaimed = claim(queue, "a", limit=2)
+    assert len(first) == 2 and reclaimed == 0
+    second, _ = claim(queue, "b")
+    assert second == [report_id for report_id in IDS if report_id not in first]
+    assert claim(queue, "c") == ([], 0)
+    assert queue_stats(queue.reader(), now=NOW)["leased"] == 3
+
+
+def test_claim_skips_tags_not_due(queue):
+    with queue.writer() as sq3:
+        sq3.execute("INSERT INTO tag_schedule (tag_id, next_poll) VALUES (?, ?)", (tag_id_for(sq3, IDS[0]), NOW + 60))
+    claimed, _ = claim(queue, "a")
+    assert sorted(claimed) == sorted(IDS[1:])
+
+
+def test_expired_lease_is_reclaimed(queue):
+    claimed, _ = claim(queue, "a")
+    assert claim(queue, "b", now=NOW + LEASE_SECONDS - 1) == ([], 0)
+    assert queue_stats(queue.reader(), now=NOW + LEASE_SECONDS + 1)["expired"] == 3
+
+    reclaimed_ids, reclaimed = claim(queue, "b", now=NOW + LEASE_SECONDS + 1)
+    assert sorted(reclaimed_ids) == sorted(claimed) and reclaimed == 3
+    # The first owner lost its leases and can neither renew nor complete them
+    with queue.writer() as sq3:
+        assert heartbeat(sq3, "a", claimed, now=NOW + LEASE_SECONDS + 2) == 0
+        complete_jobs(sq3, "a", claimed)
+    assert queue_stats(queue.reader(), now=NOW + LEASE_SECONDS + 2)["leased"] == 3
+
+
+def test_heartbeat_keeps_the_lease(queue):
+    claimed, _ = claim(queue, "a")
+    with queue.writer() as sq3:
+        assert heartbeat(sq3, "a", claimed, now=NOW + LEASE_SECONDS - 1) == 3
+    assert claim(queue, "b", now=NOW + LEASE_SECONDS + 1) == ([], 0)
+    assert len(claim(queue, "b", now=NOW + 2 * LEASE_SECONDS)[0]) == 3
+
+
+def test_completed_jobs_are_due_again(queue):
+    claimed, _ = claim(queue, "a")
+    with queue.writer() as sq3:
+        complete_jobs(sq3, "a", claimed)
+    assert claim(queue, "b", now=NOW + 1) == (claimed, 0)
+
+
+def test_failed_jobs_back_off(queue):
+    claimed, _ = claim(queue, "a", limit=1)
+    with queue.writer() as sq3:
+        fail_jobs(sq3, "a", claimed, now=NOW)
+    assert claimed[0] not in claim(queue, "b", now=NOW + RETRY_DELAY - 1)[0]
+    retry = NOW + RETRY_DELAY + 1
+    assert claim(queue, "c", now=retry) == (claimed, 0)
+    with queue.writer() as sq3:
+        fail_jobs(sq3, "c", claimed, now=retry)
+    # Held back for twice as long after a second failure
+    assert claim(queue, "d", now=retry + 2 * RETRY_DELAY - 1) == ([], 0)
+    assert claim(queue, "d", now=retry + 2 * RETRY_DELAY + 1) == (claimed, 0)
+    assert queue_stats(queue.reader(), now=NOW)["failing"] == 1
+
+
+def test_enqueue_drops_tags_no_longer_monitored(queue):
+    with queue.writer() as sq3:
+        enqueue_tags(sq3, IDS[:1])
+    assert queue_stats(queue.reader())["jobs"] == 1
@@ -3,7 +3,7 @@
 ################################################################################
 ## Form generated from reading UI file 'MainWindow.ui'
 ##
-## Created by: Qt User Interface Compiler version 6.8.1
+## Created by: Qt User Interface Compiler version 6.12.0
 ##
 ## WARNING! All changes made in this file will be lost when recompiling UI file!
 ################################################################################
@@ -17,8 +17,9 @@ from PySide6.QtGui import (QAction, QBrush, QColor, QConicalGradient,
     QPainter, QPalette, QPixmap, QRadialGradient,
     QTransform)
 from PySide6.QtWidgets import (QApplication, QFrame, QHBoxLayout, QMainWindow,
-    QMenu, QMenuBar, QPushButton, QSizePolicy,
-    QSpacerItem, QStatusBar, QVBoxLayout, QWidget)
+    QMenu, QMenuBar, QProgressBar, QPushButton,
+    QSizePolicy, QSpacerItem, QStatusBar, QVBoxLayout,
+    QWidget)
 import MainWindow_rc
 
 class Ui_MainWindow(object):
@@ -31,6 +32,9 @@ class Ui_MainWindow(object):
         MainWindow.setWindowIcon(icon)
         self.actionSelect_Anisette_server = QAction(MainWindow)
         self.actionSelect_Anisette_server.setObjectName(u"actionSelect_Anisette_server")
+        self.actionAuto_refresh = QAction(MainWindow)
+        self.actionAuto_refresh.setObjectName(u"actionAuto_refresh")
+        self.actionAuto_refresh.setCheckable(True)
         self.centralwidget = QWidget(MainWindow)
         self.centralwidget.setObjectName(u"centralwidget")
         self.horizontalLayout_2 = QHBoxLayout(self.centralwidget)
@@ -65,6 +69,22 @@ class Ui_MainWindow(object):
 
         self.verticalLayout.addWidget(self.updateReports_pushButton)
 
+        self.cancel_pushButton = QPushButton(self.centralwidget)
+        self.cancel_pushButton.setObjectName(u"cancel_pushButton")
+        self.cancel_pushButton.setEnabled(False)
+        sizePolicy1.setHeightForWidth(self.cancel_pushButton.sizePolicy().hasHeightForWidth())
+        self.cancel_pushButton.setSizePolicy(sizePolicy1)
+        self.cancel_pushButton.setMinimumSize(QSize(120, 30))
+
+        self.verticalLayout.addWidget(self.cancel_pushButton)
+
+        self.progressBar = QProgressBar(self.centralwidget)
+        self.progressBar.setObjectName(u"progressBar")
+        self.progressBar.setMaximum(3)
+        self.progressBar.setValue(0)
+
+        self.verticalLayout.addWidget(self.progressBar)
+
 
         self.horizontalLayout_2.addLayout(self.verticalLayout)
 
@@ -81,6 +101,7 @@ class Ui_MainWindow(object):
 
         self.menubar.addAction(self.menuOptions.menuAction())
         self.menuOptions.addAction(self.actionSelect_Anisette_server)
+        self.menuOptions.addAction(self.actionAuto_refresh)
 
         self.retranslateUi(MainWindow)
 
@@ -93,7 +114,10 @@ class Ui_MainWindow(object):
     def retranslateUi(self, MainWindow):
         MainWindow.setWindowTitle(QCoreApplication.translate("MainWindow", u"FindMyFlipper", None))
         self.actionSelect_Anisette_server.setText(QCoreApplication.translate("MainWindow", u"Select Anisette server", None))
+        self.actionAuto_refresh.setText(QCoreApplication.translate("MainWindow", u"Auto refresh", None))
         self.updateReports_pushButton.setText(QCoreApplication.translate("MainWindow", u"Update Reports", None))
+        self.cancel_pushButton.setText(QCoreApplication.translate("MainWindow", u"Cancel", None))
+        self.progressBar.setFormat(QCoreApplication.translate("MainWindow", u"%v/%m", None))
         self.menuOptions.setTitle(QCoreApplication.translate("MainWindow", u"Options", None))
     # retranslateUi
 
@@ -1,31 +1,42 @@
 #!/usr/bin/env python3
+import asyncio
+import binascii
 import datetime
 import hashlib
 import json
 import os
 import re
-import sqlite3
-import struct
+import socket
 from typing import Annotated
 
 from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from fastapi import FastAPI, UploadFile, Header, Body
+from fastapi import FastAPI, UploadFile, Header, Body, Request
 
-import requests
 from fastapi.params import Query, File
-from fastapi.responses import JSONResponse
-
-from request_reports import getAuth
-from cores.pypush_gsa_icloud import icloud_login_mobileme, generate_anisette_headers
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+from cores.account_pool import account_pool, getAuth
+from cores.broadcast import DROPPED, BroadcastHub
+from cores.db_pool import ConnectionPool
+from cores.geocoder import load_geocoder
+from cores.geofence import add_fence, create_geofence_tables, delete_fence, event_rows
+from cores.heatmap import CELL_DEGREES, METERS_PER_DEGREE, aggregate, cell_rows, create_heat_tables
+from cores.metrics import (DECRYPT_SECONDS, HTTP_REQUEST_SECONDS, SCHEDULED_TAGS, STREAM_EVENTS, SYNC_LEASES,
+                           SYNC_SECONDS)
+from cores.report_crypto import decrypt_report, private_key_int
+from cores.report_db import create_tables, delete_tag, latest_positions, tag_id_of
+from cores.scheduler import create_schedule_table
+from cores.sinks import create_outbox_table, deliver, enqueue, load_sinks
+from cores.sync import sync_claimed
+from cores.trajectory import MIN_CONF, analyze_many
+from cores.work_queue import claim_jobs, create_queue_table, enqueue_tags
 from cryptography.hazmat.primitives.asymmetric import ec
 
 import base64
 import logging
 import uvicorn
 import time
-import paho.mqtt.publish as publish
-import certifi
 
 logging.basicConfig(level=logging.ERROR)
 
@@ -37,25 +48,23 @@ app = FastAPI(
                 "\n**Public Key / Advertisement Key:** Derive from the private key, used for broadcasting.  "
                 "\n**Hashed Advertisement Key:** SHA256 hashed public key, used for querying reports.  "
 )
-app.last_publish_time = 0
-
-CONFIG_PATH = os.path.dirname(os.path.realpath(__file__)) + "/keys/auth.json"
-if os.path.exists(CONFIG_PATH):
-    with open(CONFIG_PATH, "r") as f:
-        j = json.load(f)
-else:
-    mobileme = icloud_login_mobileme(second_factor='sms')
-    j = {'dsid': mobileme['dsid'],
-         'searchPartyToken': mobileme['delegates']['com.apple.mobileme']['service-data']['tokens'][
-             'searchPartyToken']}
-    with open(CONFIG_PATH, "w") as f:
-        json.dump(j, f)
-
-dsid = j['dsid']
-searchPartyToken = j['searchPartyToken']
-
-sq3db = sqlite3.connect(os.path.dirname(os.path.realpath(__file__)) + '/keys/reports.db')
-_sq3 = sq3db.cursor()
+
+
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    # Label by route template rather than raw path to keep the label set bounded
+    route = request.scope.get("route")
+    HTTP_REQUEST_SECONDS.labels(method=request.method, endpoint=route.path if route else "unmatched",
+                                status=str(response.status_code)).observe(time.perf_counter() - start)
+    return response
+
+# Log in at startup rather than on the first request, the tokens are then cached by account_pool
+account_pool.get()
+
+# Thread local readers and one serialized writer, safe under the threadpool and with uvicorn --workers N
+db = ConnectionPool(os.path.dirname(os.path.realpath(__file__)) + '/keys/reports.db')
 
 # SQL query to create a table named 'report' if it does not exist
 create_table_query = '''CREATE TABLE IF NOT EXISTS tags (
@@ -63,16 +72,108 @@ create_table_query = '''CREATE TABLE IF NOT EXISTS tags (
         mqtt_publish_encryption_key TEXT, mqtt_username TEXT, mqtt_userpass TEXT, mqtt_topic TEXT,
         PRIMARY KEY(private_key,mqtt_server));'''
 
-# Execute the SQL query
-_sq3.execute(create_table_query)
+# Publish throttling is shared by every worker process through this table
+create_service_state_query = '''CREATE TABLE IF NOT EXISTS service_state (name TEXT PRIMARY KEY, value REAL);'''
+
+with db.writer() as sq3:
+    # Execute the SQL query
+    sq3.execute(create_table_query)
+    sq3.execute(create_service_state_query)
+
+    # reports, tag_ids and latest_position, migrating databases that still store base64 TEXT
+    create_tables(sq3, commit=False)
+    # Per tag poll intervals, sync only fetches the tags that are due
+    create_schedule_table(sq3, commit=False)
+    # Leases shared with sync_worker.py
+    create_queue_table(sq3)
+    # Events waiting for delivery to output sinks
+    create_outbox_table(sq3)
+    # Fences, the fences each tag is in and the enter and exit events the sync records
+    create_geofence_tables(sq3)
+    # Reports per tag and grid cell, updated by every sync
+    create_heat_tables(sq3)
+
+# Lease owner of this process on the sync queue
+WORKER_ID = f"web_service-{socket.gethostname()}-{os.getpid()}"
+
+HISTORY_MAX_LIMIT = 1000
+# A comment line is sent when nothing happened for this long, so proxies keep idle streams open
+STREAM_KEEPALIVE_SECONDS = 15
+
+# Every /Stream/ client of this process is fed from here
+hub = BroadcastHub()
+
+
+# Nearest place names from keys/gazetteer.txt, positions stay unnamed without it
+geocoder = load_geocoder()
+
+
+def name_places(positions):
+    # Rows stored before a gazetteer was installed are named on the way out
+    if geocoder is None:
+        return positions
+    unnamed = [position for position in positions if position.get("place") is None]
+    for position, place in zip(unnamed, geocoder.lookup_many([position["lat"] for position in unnamed],
+                                                             [position["lon"] for position in unnamed])):
+        position["place"] = place
+    return positions
+
+
+# MQTT to the brokers of the tags table plus whatever keys/sinks.json lists
+sinks = load_sinks(db)
+# How often failed sink deliveries are retried
+SINK_RETRY_SECONDS = 30
+
+
+async def retry_sinks():
+    while True:
+        await asyncio.sleep(SINK_RETRY_SECONDS)
+        await deliver(db, sinks)
+
+
+# Geofence events are recorded by whichever process ran the sync, every service process picks them up from here
+GEOFENCE_RELAY_SECONDS = 5
+# Last geofence event sent to this process' stream clients
+geofence_cursor = 0
+
+
+def relay_geofence_events():
+    """Queue geofence events no process has published yet for the sinks, and stream those this process has not."""
+    global geofence_cursor
+    with db.writer() as sq3:
+        names = dict(sq3.execute("SELECT hash_adv_key, friendly_name FROM tags").fetchall())
+        pending = [dict(event, name=names.get(event["id"], event["id"][:7]))
+                   for event in event_rows(sq3, "WHERE published = 0")]
+        enqueue(sq3, sinks, pending)
+        sq3.executemany("UPDATE geofence_events SET published = 1 WHERE event_id = ?",
+                        [(event["event_id"],) for event in pending])
+
+    for event in event_rows(db.reader(), "WHERE event_id > ?", (geofence_cursor,)):
+        geofence_cursor = event["event_id"]
+        event["isodatetime"] = datetime.datetime.fromtimestamp(event["timestamp"]).isoformat()
+        hub.publish(event["id"], event, kind="geofence")
+    return len(pending)
+
+
+async def relay_geofences():
+    while True:
+        try:
+            if await asyncio.to_thread(relay_geofence_events):
+                await deliver(db, sinks)
+        except Exception as e:
+            logging.error(f"Geofence Event Relay Failed: {e}", exc_info=True)
+        await asyncio.sleep(GEOFENCE_RELAY_SECONDS)
 
-# SQL query to create a table named 'report' if it does not exist
-create_table_query = '''CREATE TABLE IF NOT EXISTS reports (
-id_short TEXT, timestamp INTEGER, datePublished INTEGER, payload TEXT, 
-id TEXT, statusCode INTEGER, lat TEXT, lon TEXT, conf INTEGER, PRIMARY KEY(id,payload));'''
 
-# Execute the SQL query
-_sq3.execute(create_table_query)
+@app.on_event("startup")
+async def start_background_tasks():
+    global geofence_cursor
+    # Positions stored by sync_worker.py or another uvicorn worker reach the stream through latest_position
+    app.state.stream_poller = asyncio.create_task(hub.poll(db.reader))
+    app.state.sink_retries = asyncio.create_task(retry_sinks())
+    # Stream clients only get the geofence events recorded after the service started
+    geofence_cursor = db.reader().execute("SELECT coalesce(max(event_id), 0) FROM geofence_events").fetchone()[0]
+    app.state.geofence_relay = asyncio.create_task(relay_geofences())
 
 
 def private_key_from_json(private_keys: str) -> set():
@@ -107,46 +208,43 @@ def private_to_hashed_key(private_key_b64: str) -> str:
     return s256_b64
 
 
-def sha256(data):
-    digest = hashlib.new("sha256")
-    digest.update(data)
-    return digest.digest()
-
-
-def decrypt(enc_data, algorithm_dkey, mode):
-    decryptor = Cipher(algorithm_dkey, mode, default_backend()).decryptor()
-    return decryptor.update(enc_data) + decryptor.finalize()
+@DECRYPT_SECONDS.time()
+def decrypt_payload(report: str, private_key: str) -> {}:
+    tag = decrypt_report(base64.b64decode(report), private_key_int(private_key))
 
+    result = {}
+    result['timestamp'] = tag['timestamp']
+    result['isodatetime'] = tag['isodatetime']
+    result['lat'] = tag['lat']
+    result['lon'] = tag['lon']
+    result['confidence'] = tag['conf']
+    result['status'] = tag['status']
 
-def decrypt_payload(report: str, private_key: str) -> {}:
-    data = base64.b64decode(report)
-    priv = int.from_bytes(base64.b64decode(private_key), byteorder="big")
+    return result
 
-    timestamp = int.from_bytes(data[0:4], byteorder="big") + 978307200
-    eph_key = ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP224R1(), data[5:62])
-    shared_key = ec.derive_private_key(priv, ec.SECP224R1(), default_backend()).exchange(ec.ECDH(), eph_key)
-    symmetric_key = sha256(shared_key + b'\x00\x00\x00\x01' + data[5:62])
-    iv = symmetric_key[16:]
-    decryption_key = symmetric_key[:16]
-    ciper_txt = data[62:72]
-    auth_tag = data[72:]
 
-    clear_text = decrypt(ciper_txt, algorithms.AES(decryption_key), modes.GCM(iv, auth_tag))
+def split_hashed_keys(advertisement_keys: str) -> (list, set):
+    # Comma separated Hashed Advertisement Base64 Keys of the local endpoints, split into valid and invalid ones
+    re_exp = r"^[-A-Za-z0-9+/]*={0,3}$"
+    valid, invalid = [], set()
+    for key in advertisement_keys.strip().replace(" ", "").split(','):
+        if key == "":
+            continue
+        try:
+            if len(key) != 44 or not re.match(re_exp, key):
+                raise ValueError
+            base64.b64decode(key, validate=True)
+        except (ValueError, binascii.Error):
+            invalid.add(key)
+        else:
+            valid.append(key)
+    return valid, invalid
 
-    result = {}
-    latitude = struct.unpack(">i", clear_text[0:4])[0] / 10000000.0
-    longitude = struct.unpack(">i", clear_text[4:8])[0] / 10000000.0
-    confidence = int.from_bytes(clear_text[8:9], byteorder="big")
-    status = int.from_bytes(clear_text[9:10], byteorder="big")
-
-    result['timestamp'] = timestamp
-    result['isodatetime'] = datetime.datetime.fromtimestamp(timestamp).isoformat()
-    result['lat'] = latitude
-    result['lon'] = longitude
-    result['confidence'] = confidence
-    result['status'] = status
 
-    return result
+def invalid_keys_response(invalid: set) -> JSONResponse:
+    return JSONResponse(
+        content={"error": f"Invalid Hashed Advertisement Base64 Key(s): {invalid}"},
+        status_code=400)
 
 
 def get_report_from_upstream(advertisement_keys: str, hours: int) -> {}:
@@ -175,16 +273,14 @@ def get_report_from_upstream(advertisement_keys: str, hours: int) -> {}:
     start_date = unix_epoch - (60 * 60 * hours)
     data = {"search": [{"startDate": start_date * 1000, "endDate": unix_epoch * 1000, "ids": advertisement_keys_list}]}
 
-    r = requests.post("https://gateway.icloud.com/acsnservice/fetch",
-                      auth=(dsid, searchPartyToken),
-                      headers=generate_anisette_headers(),
-                      json=data)
+    r = account_pool.fetch(data)
 
     return json.loads(r.content.decode(encoding='utf-8'))
 
 
+# Plain def endpoints run in the threadpool, so waiting for the rate limiter does not stall the event loop
 @app.post("/SingleDeviceEncryptedReports/", summary="Retrieve reports for one device at a time.")
-async def single_device_encrypted_reports(
+def single_device_encrypted_reports(
         advertisement_key: str = Query(
             description="Hashed Advertisement Base64 Key.",
             min_length=44, max_length=44, regex=r"^[-A-Za-z0-9+/]*={0,3}$"),
@@ -198,16 +294,13 @@ async def single_device_encrypted_reports(
     data = {"search": [{"startDate": start_date * 1000, "endDate": unix_epoch * 1000,
                         "ids": [advertisement_key.strip().replace(" ", "")]}]}
 
-    r = requests.post("https://gateway.icloud.com/acsnservice/fetch",
-                      auth=(dsid, searchPartyToken),
-                      headers=generate_anisette_headers(),
-                      json=data)
+    r = account_pool.fetch(data)
 
     return json.loads(r.content.decode(encoding='utf-8'))
 
 
 @app.post("/MultipleDeviceEncryptedReports/", summary="Retrieve reports for multiple devices at a time.")
-async def multiple_device_encrypted_reports(
+def multiple_device_encrypted_reports(
         advertisement_keys: Annotated[str, Body(
             description="Hashed Advertisement Base64 Key. Separate each key by a comma.",
             media_type="text/plain")],
@@ -303,7 +396,7 @@ async def report_decryption(
 
 
 @app.post("/KeyToMonitor/", summary="Add a key to monitor db.")
-async def key_to_monitor(
+def key_to_monitor(
         private_key: Annotated[str | None, Body(
             description="**Private Key is a secret and shall not be provided to any untrusted website!**")] = None,
         friendly_name: Annotated[str, Body(description="Friendly name for the key")] = "HayTag",
@@ -350,49 +443,76 @@ async def key_to_monitor(
                   f"mqtt_port: {mqtt_port}, mqtt_publish_encryption_key length: {len(mqtt_publish_encryption_key)}, \n"
                   f"mqtt_username: {mqtt_username}, mqtt_userpass length: {len(mqtt_userpass)}, mqtt_over_tls: {mqtt_over_tls}")
 
-    for key in valid_private_keys:
-        query = "INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
-        parameters = (private_to_hashed_key(key), key, friendly_name, mqtt_server, mqtt_port, mqtt_over_tls,
-                      mqtt_publish_encryption_key, mqtt_username, mqtt_userpass, mqtt_topic)
-        _sq3.execute(query, parameters)
+    with db.writer() as sq3:
+        for key in valid_private_keys:
+            query = "INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+            parameters = (private_to_hashed_key(key), key, friendly_name, mqtt_server, mqtt_port, mqtt_over_tls,
+                          mqtt_publish_encryption_key, mqtt_username, mqtt_userpass, mqtt_topic)
+            sq3.execute(query, parameters)
 
-    sq3db.commit()
     return JSONResponse(
         content={"success": f"Private key added to monitor db"},
         status_code=200)
 
 
 # Get the reports from the upstream and decrypt them, save the result to the reports table
+@SYNC_SECONDS.time()
 def sync_latest_decrypted_reports():
-    hash_adv_keys = _sq3.execute("SELECT hash_adv_key FROM tags")
-    hash_adv_keys = set([item[0] for item in hash_adv_keys])
+    private_keys = dict(db.reader().execute("SELECT hash_adv_key, private_key FROM tags").fetchall())
 
-    logging.debug(f"hash_adv_keys: {hash_adv_keys}")
-    if len(hash_adv_keys) == 0:
+    logging.debug(f"hash_adv_keys: {set(private_keys)}")
+    if len(private_keys) == 0:
         logging.error(f"No Report available, or Upstream informed an error.", exc_info=True)
         return
 
-    reports = get_report_from_upstream(",".join(hash_adv_keys), 1)
-
-    if "results" in reports:
-        for report in reports["results"]:
-            if report["id"] in hash_adv_keys:
-                clear_text = decrypt_payload(report['payload'], _sq3.execute(
-                    "SELECT private_key FROM tags WHERE hash_adv_key = ?", (report["id"],)).fetchone()[0])
-
-                # id_short TEXT, timestamp INTEGER, datePublished INTEGER, payload TEXT,
-                # id TEXT, statusCode INTEGER, lat TEXT, lon TEXT, conf INTEGER
-
-                logging.debug(report)
-                logging.debug(clear_text)
-                query = "INSERT OR REPLACE INTO reports VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
-                parameters = (report["id"][:7], clear_text['timestamp'], report['datePublished'], report['payload'],
-                              report['id'], clear_text['status'], clear_text['lat'], clear_text['lon'],
-                              clear_text['confidence'])
-                _sq3.execute(query, parameters)
-        sq3db.commit()
-    else:
-        logging.error(f"Upstream informed an error. {reports['statusCode']}", exc_info=True)
+    # Due tags are leased from the sync queue, so sync_worker.py processes next to the service never fetch them twice
+    with db.writer() as sq3:
+        enqueue_tags(sq3, list(private_keys))
+        due, reclaimed = claim_jobs(sq3, WORKER_ID, len(private_keys))
+    SYNC_LEASES.labels(outcome="claimed").inc(len(due))
+    SYNC_LEASES.labels(outcome="reclaimed").inc(reclaimed)
+    SCHEDULED_TAGS.labels(state="due").set(len(due))
+    SCHEDULED_TAGS.labels(state="waiting").set(len(private_keys) - len(due))
+    if len(due) == 0:
+        logging.debug("No tag is due for polling yet")
+        return
+
+    # Fetching and decrypting only read, the write lock is taken for the final batch insert alone
+    sync_claimed(db, WORKER_ID, private_keys, due, on_report=stream_report, geocoder=geocoder)
+
+
+def stream_report(report, tag):
+    # Same fields as /LatestPosition/
+    hub.publish(report["id"], {"id_short": report["id"][:7], "timestamp": tag["timestamp"],
+                               "datePublished": report["datePublished"], "status": tag["status"],
+                               "lat": tag["lat"], "lon": tag["lon"], "conf": tag["conf"],
+                               "place": tag.get("place"), "isodatetime": tag["isodatetime"]})
+
+
+def claim_publish(now):
+    # Claimed in the database so that N uvicorn workers still publish at most once a minute together
+    with db.writer() as sq3:
+        last_publish_time = (sq3.execute("SELECT value FROM service_state WHERE name = 'last_publish_time'")
+                             .fetchone() or (0,))[0]
+        if now - last_publish_time >= 60:
+            sq3.execute("INSERT OR REPLACE INTO service_state VALUES ('last_publish_time', ?)", (now,))
+    return last_publish_time
+
+
+def queue_latest_positions():
+    # The latest position of every monitored tag, queued for every sink
+    positions = latest_positions(db.reader())
+    names = dict(db.reader().execute("SELECT hash_adv_key, friendly_name FROM tags").fetchall())
+    events = sorted(({"id": key, "name": name, "timestamp": positions[key]["timestamp"], "lat": positions[key]["lat"],
+                      "lon": positions[key]["lon"], "conf": positions[key]["conf"], "status": positions[key]["status"],
+                      "place": positions[key]["place"]}
+                     for key, name in names.items() if key in positions), key=lambda event: event["timestamp"])
+    logging.debug(f"events to send. {events}")
+    if events:
+        # Queued first, so a sink that is down gets the events on a later retry round
+        with db.writer() as sq3:
+            enqueue(sq3, sinks, events)
+    return events
 
 
 @app.post("/Publish_MQTT/", summary="Trigger a publish action to MQTT Servers")
@@ -401,92 +521,43 @@ async def publish_mqtt():
     When this api is triggered, it will read all the private keys have been register by using the api "KeyToMonitor",
     query the latest reports from Apple, save the reports to database,
     then and publish it to the MQTT server which previously declared and saved in the database.
+    The same positions go to the sinks listed in keys/sinks.json (webhook, OwnTracks HTTP, NDJSON file),
+    deliveries that fail are retried in the background. Geofence enter and exit events are published along,
+    as OwnTracks transitions on the device's /event topic.
     """
 
-    if time.time() - app.last_publish_time < 60:
+    # Database work runs in threads, the write lock may be held by a sync for a while
+    now = time.time()
+    last_publish_time = await asyncio.to_thread(claim_publish, now)
+    if now - last_publish_time < 60:
         return JSONResponse(
             content={
                 "error": f"Publish MQTT too often, please wait for "
-                         f"{int(60 - (time.time() - app.last_publish_time))} seconds"},
+                         f"{int(60 - (now - last_publish_time))} seconds"},
             status_code=400)
-    else:
-        app.last_publish_time = time.time()
-
-    ca_path = certifi.where()
-    # hash_adv_key TEXT, private_key TEXT, friendly_name TEXT, mqtt_server TEXT, mqtt_port INTEGER, mqtt_over_tls BOOLEAN,
-    # mqtt_publish_encryption_key TEXT, mqtt_username TEXT, mqtt_userpass TEXT, mqtt_topic TEXT
-
-    sync_latest_decrypted_reports()
 
-    tags = _sq3.execute(
-        "SELECT hash_adv_key, friendly_name, mqtt_server, mqtt_port, lat, lon, max(timestamp), mqtt_over_tls,"
-        "mqtt_publish_encryption_key, mqtt_username, mqtt_userpass, mqtt_topic, max(conf) "
-        "FROM tags, reports "
-        "WHERE reports.id = tags.hash_adv_key AND lat IS NOT NULL AND lon IS NOT NULL "
-        "GROUP BY hash_adv_key, mqtt_server "
-        "ORDER BY timestamp ;").fetchall()
+    # Syncing blocks on Apple and SQLite, keep the event loop free for /Stream/ clients meanwhile
+    await asyncio.to_thread(sync_latest_decrypted_reports)
+    # Geofence transitions of this sync go out with the positions
+    await asyncio.to_thread(relay_geofence_events)
 
-    logging.debug(f"tags to send. {tags}")
-
-    if len(tags) == 0:
+    events = await asyncio.to_thread(queue_latest_positions)
+    if len(events) == 0:
         return JSONResponse(
             content={"error": f"No valid report found"},
             status_code=400)
-    try:
-        for tag in tags:
-            logging.debug(f"\n"
-                          f"tag[0]: {tag[0]} \n"
-                          f"tag[1]: {tag[1]} \n"
-                          f"tag[2]: {tag[2]} \n"
-                          f"tag[3]: {tag[3]} \n"
-                          f"tag[4]: {tag[4]} \n"
-                          f"tag[5]: {tag[5]} \n"
-                          f"tag[6]: {tag[6]} \n"
-                          f"tag[7]: {tag[7]} \n"
-                          f"tag[8]: {tag[8]} \n"
-                          f"tag[9]: {tag[9]} \n"
-                          f"tag[10]: {tag[10]} \n"
-                          f"tag[11]: {tag[11]}")
-
-            # https://owntracks.org/booklet/tech/json/#_typelocation
-            report = {"_type": "location",
-                      "lat": tag[4],
-                      "lon": tag[5],
-                      "timestamp": tag[6],
-                      "tag": tag[1]
-                      }
-            escape_keyname = tag[0].replace("/", "_")
-
-            if tag[7]:
-                logging.info(f"Publishing MQTT for {tag[0]} to {tag[2]}")
-                publish.single(
-                    topic=f"owntracks/{tag[9]}/{tag[1]}_{escape_keyname[:4]}",
-                    payload=json.dumps(report, separators=(',', ':')),
-                    qos=1, retain=True, hostname=tag[2], client_id=tag[9],
-                    port=int(tag[3]), keepalive=60, will=None, tls={"ca_certs": ca_path},
-                    auth={'username': tag[9], 'password': tag[10]},
-                    transport="tcp")
 
-            else:
-                logging.info(f"Publishing MQTT for {tag[0]} to {tag[2]}")
-                publish.single(
-                    topic=f"owntracks/{tag[9]}/{tag[1]}_{escape_keyname[:4]}",
-                    payload=json.dumps(report, separators=(',', ':')),
-                    qos=1, retain=True, hostname=tag[2], client_id=tag[9],
-                    port=int(tag[3]), keepalive=60, will=None, tls=None,
-                    auth={'username': tag[9], 'password': tag[10]},
-                    transport="tcp")
+    counts = await deliver(db, sinks)
 
-        return JSONResponse(
-            content={"success": f"Published MQTT"},
-            status_code=200)
-    except Exception as e:
-        logging.error(f"Publish MQTT Failed: {e}", exc_info=True)
-        pass
+    return JSONResponse(
+        content={"success": f"Published MQTT",
+                 "sinks": {name: {"delivered": delivered, "failed": failed}
+                           for name, (delivered, failed) in counts.items()}},
+        status_code=200)
 
 
 @app.post("/Tag_Removal/", summary="Remove everything from Database with given hashed, advertisement, or private key.")
-async def tag_removal(
+def tag_removal(
         keys: Annotated[str, Query(
             description="Key in Base64 format. Separate each key by a comma.")]):
     re_exp = r"^[-A-Za-z0-9+/]*={0,3}$"
@@ -501,16 +572,334 @@ async def tag_removal(
             content={"error": f"No valid Base64 Key(s) found"},
             status_code=400)
 
-    for key in keys_set:
-        _sq3.execute("DELETE FROM tags WHERE hash_adv_key = ? OR private_key = ?", (key, key))
-        _sq3.execute("DELETE FROM reports WHERE id = ?", (key,))
+    with db.writer() as sq3:
+        for key in keys_set:
+            sq3.execute("DELETE FROM tags WHERE hash_adv_key = ? OR private_key = ?", (key, key))
+            if len(key) == 44:
+                delete_tag(sq3, key)
 
-    sq3db.commit()
     return JSONResponse(
         content={"success": f"Key(s) removed from database"},
         status_code=200)
 
 
+@app.get("/Stream/", summary="Server-Sent Events stream of new decrypted positions.")
+async def stream(
+        request: Request,
+        advertisement_keys: str | None = Query(
+            None, description="Hashed Advertisement Base64 Key(s) to follow, separate each key by a comma. "
+                              "Defaults to every device.")):
+    """
+    Keeps the connection open and sends a "position" event, with the fields of /LatestPosition/ and the key as id,
+    whenever the sync stores a new report, and a "geofence" event, as listed by /GeofenceEvents/, whenever a device
+    enters or exits a geofence. <br>
+    A client that reads too slowly is sent a "dropped" event and disconnected, reconnect to resume. <br>
+    """
+    report_ids = None
+    if advertisement_keys is not None:
+        keys, invalid = split_hashed_keys(advertisement_keys)
+        if invalid:
+            # Before subscribing, a mistyped key would otherwise leave the client following nothing
+            return invalid_keys_response(invalid)
+        report_ids = set(keys)
+
+    subscription = hub.subscribe(report_ids)
+
+    async def events():
+        try:
+            yield ": connected\n\n"
+            while True:
+                try:
+                    item = await asyncio.wait_for(subscription.get(), STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keepalive\n\n"
+                    continue
+                if item is DROPPED:
+                    yield f"event: dropped\ndata: {json.dumps({'error': 'Client too slow, events were dropped'})}\n\n"
+                    break
+                kind, report_id, data = item
+                yield f"event: {kind}\nid: {report_id}\ndata: {json.dumps(dict(data, id=report_id))}\n\n"
+                STREAM_EVENTS.labels(outcome="sent").inc()
+        finally:
+            hub.unsubscribe(subscription)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get("/metrics", summary="Prometheus metrics.", include_in_schema=False)
+async def metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/LatestPosition/", summary="Read the latest stored position of monitored devices.")
+def latest_position(
+        advertisement_keys: str | None = Query(
+            None, description="Hashed Advertisement Base64 Key(s), separate each key by a comma. "
+                              "Defaults to every device with a stored report.")):
+    """
+    Served from the local database only, Apple is not queried. <br>
+    place is the nearest entry of keys/gazetteer.txt, null when no gazetteer is installed. <br>
+    """
+    report_ids = None
+    if advertisement_keys is not None:
+        report_ids, invalid = split_hashed_keys(advertisement_keys)
+        if invalid:
+            return invalid_keys_response(invalid)
+
+    positions = latest_positions(db.reader(), set(report_ids) if report_ids is not None else None)
+    for position in positions.values():
+        position['isodatetime'] = datetime.datetime.fromtimestamp(position['timestamp']).isoformat()
+    name_places(positions.values())
+    return positions
+
+
+@app.get("/History/", summary="Read stored decrypted reports of one device within a time range.")
+def history(
+        advertisement_key: str = Query(
+            description="Hashed Advertisement Base64 Key.",
+            min_length=44, max_length=44, regex=r"^[-A-Za-z0-9+/]*={0,3}$"),
+        start: int = Query(0, description="Unix timestamp (seconds) to start from, inclusive", ge=0),
+        end: int | None = Query(None, description="Unix timestamp (seconds) to end at, inclusive. Defaults to now"),
+        limit: int = Query(500, description="Maximum number of points per page", ge=1, le=HISTORY_MAX_LIMIT),
+        cursor: int | None = Query(None, description="Value of next_cursor from the previous page", ge=0),
+        bucket_minutes: int = Query(0, description="Downsample to one confidence-weighted point per N minutes, "
+                                                   "0 to disable",
+                                    ge=0, le=60 * 24 * 31)):
+    """
+    Served from the local database only, Apple is not queried. <br>
+    Pages are ordered by time. Pass the returned next_cursor to fetch the next page,
+    it is null once the range is exhausted. <br>
+    """
+    if end is None:
+        end = int(datetime.datetime.now().timestamp())
+
+    sq3 = db.reader()
+    tag_id = tag_id_of(sq3, advertisement_key)
+    if tag_id is None:
+        return {"id": advertisement_key, "results": [], "next_cursor": None}
+
+    if bucket_minutes > 0:
+        bucket = bucket_minutes * 60
+        if cursor is not None:
+            start = max(start, cursor)
+
+        rows = sq3.execute(
+            "SELECT timestamp / :bucket * :bucket AS bucket_start, sum(lat * max(conf, 1)) / sum(max(conf, 1)), "
+            "sum(lon * max(conf, 1)) / sum(max(conf, 1)), max(conf), count(*) "
+            "FROM reports WHERE tag_id = :tag_id AND timestamp >= :start AND timestamp <= :end "
+            "AND lat IS NOT NULL AND lon IS NOT NULL "
+            "GROUP BY bucket_start ORDER BY bucket_start LIMIT :limit",
+            {"bucket": bucket, "tag_id": tag_id, "start": start, "end": end, "limit": limit + 1}).fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1][0] + bucket
+
+        results = [{"timestamp": row[0],
+                    "isodatetime": datetime.datetime.fromtimestamp(row[0]).isoformat(),
+                    "lat": row[1], "lon": row[2], "conf": row[3], "count": row[4]} for row in rows]
+    else:
+        # (tag_id, timestamp) is the primary key, so the last timestamp is a unique cursor
+        if cursor is not None:
+            start = max(start, cursor + 1)
+
+        rows = sq3.execute(
+            "SELECT timestamp, datePublished, statusCode, lat, lon, conf, place "
+            "FROM reports WHERE tag_id = :tag_id AND timestamp >= :start AND timestamp <= :end "
+            "ORDER BY timestamp LIMIT :limit",
+            {"tag_id": tag_id, "start": start, "end": end, "limit": limit + 1}).fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1][0]
+
+        results = [{"timestamp": row[0],
+                    "isodatetime": datetime.datetime.fromtimestamp(row[0]).isoformat(),
+                    "datePublished": row[1], "status": row[2], "lat": row[3], "lon": row[4],
+                    "conf": row[5], "place": row[6]} for row in rows]
+
+    # Buckets are named after their averaged position
+    name_places([result for result in results if result["lat"] is not None])
+    return {"id": advertisement_key, "results": results, "next_cursor": next_cursor}
+
+
+@app.get("/Analytics/", summary="Distance, speeds, stops and trips of monitored devices within a time range.")
+def analytics(
+        advertisement_keys: str | None = Query(
+            None, description="Hashed Advertisement Base64 Key(s), separate each key by a comma. "
+                              "Defaults to every device with a stored report."),
+        start: int = Query(0, description="Unix timestamp (seconds) to start from, inclusive", ge=0),
+        end: int | None = Query(None, description="Unix timestamp (seconds) to end at, inclusive. Defaults to now"),
+        min_conf: int = Query(MIN_CONF, description="Leave out reports with a lower confidence", ge=0, le=255),
+        details: bool = Query(True, description="List every stop and trip, not only the totals")):
+    """
+    Served from the local database only, Apple is not queried. <br>
+    Speeds are in m/s, distances in meters. Stops are places a device stayed at for 10 minutes or more,
+    trips are the moves between them. <br>
+    """
+    if end is None:
+        end = int(datetime.datetime.now().timestamp())
+
+    # Labelled by tag_id, NumPy would strip trailing zero bytes off the raw ids
+    query = ("SELECT tag_id, timestamp, lat, lon, conf FROM reports JOIN tag_ids USING (tag_id) "
+             "WHERE timestamp >= ? AND timestamp <= ? AND lat IS NOT NULL AND lon IS NOT NULL")
+    parameters = [start, end]
+    if advertisement_keys is not None:
+        keys, invalid = split_hashed_keys(advertisement_keys)
+        if invalid:
+            return invalid_keys_response(invalid)
+        report_ids = [base64.b64decode(key) for key in keys]
+        query += f" AND tag_ids.id IN ({','.join('?' * len(report_ids))})"
+        parameters += report_ids
+
+    sq3 = db.reader()
+    rows = sq3.execute(query, parameters).fetchall()
+    tag_ids, timestamps, lats, lons, confs = zip(*rows) if rows else ((), (), (), (), ())
+    summaries = analyze_many(tag_ids, timestamps, lats, lons, confs, min_conf=min_conf)
+    report_ids = dict(sq3.execute("SELECT tag_id, id FROM tag_ids").fetchall())
+
+    results = {}
+    for tag_id, summary in summaries.items():
+        if not details:
+            summary["stops"], summary["trips"] = len(summary["stops"]), len(summary["trips"])
+        results[base64.b64encode(report_ids[tag_id]).decode("ascii")] = summary
+    return results
+
+
+@app.get("/Heatmap/", summary="Report counts and dwell time per grid cell of monitored devices.")
+def heatmap(
+        advertisement_keys: str | None = Query(
+            None, description="Hashed Advertisement Base64 Key(s), separate each key by a comma. "
+                              "Defaults to every device with a stored report."),
+        cell_meters: int = Query(round(CELL_DEGREES * METERS_PER_DEGREE), description="Cell edge north-south",
+                                 ge=round(CELL_DEGREES * METERS_PER_DEGREE), le=100000),
+        start: int | None = Query(None, description="Unix timestamp (seconds) to start from, inclusive", ge=0),
+        end: int | None = Query(None, description="Unix timestamp (seconds) to end at, inclusive")):
+    """
+    Served from the local database only, Apple is not queried. <br>
+    Without start and end the cells come from a cache the sync keeps up to date, which also covers reports
+    already removed by compact_reports.py. A time range is aggregated from the stored reports instead. <br>
+    dwell_seconds is the time until a device's next report, at most an hour per report. <br>
+    """
+    sq3 = db.reader()
+    tag_ids = None
+    if advertisement_keys is not None:
+        keys, invalid = split_hashed_keys(advertisement_keys)
+        if invalid:
+            return invalid_keys_response(invalid)
+        tag_ids = [tag_id for tag_id in (tag_id_of(sq3, key) for key in keys) if tag_id is not None]
+
+    if start is None and end is None:
+        cells = cell_rows(sq3, tag_ids, cell_meters)
+    else:
+        query = ("SELECT tag_id, timestamp, lat, lon FROM reports WHERE timestamp >= ? AND timestamp <= ? "
+                 "AND lat IS NOT NULL AND lon IS NOT NULL")
+        parameters = [start or 0, end if end is not None else int(datetime.datetime.now().timestamp())]
+        if tag_ids is not None:
+            query += f" AND tag_id IN ({','.join('?' * len(tag_ids))})"
+            parameters += tag_ids
+        rows = sq3.execute(query, parameters).fetchall()
+        cell = cell_meters / METERS_PER_DEGREE
+        cells = aggregate(*(zip(*rows) if rows else ((), (), (), ())), cell=cell)
+        cells["lats"], cells["lons"] = (cells["cell_lats"] + 0.5) * cell, (cells["cell_lons"] + 0.5) * cell
+
+    report_ids = dict(sq3.execute("SELECT tag_id, id FROM tag_ids").fetchall())
+    results = {}
+    for tag_id, lat, lon, count, dwell, first, last in zip(
+            *(cells[column].tolist() for column in ("tags", "lats", "lons", "counts", "dwell_seconds",
+                                                    "first_timestamps", "last_timestamps"))):
+        results.setdefault(base64.b64encode(report_ids[tag_id]).decode("ascii"), []).append(
+            {"lat": round(lat, 7), "lon": round(lon, 7), "count": count, "dwell_seconds": dwell,
+             "first_timestamp": first, "last_timestamp": last})
+    return {"cell_meters": cell_meters, "results": results}
+
+
+@app.get("/Geofences/", summary="List the geofences checked on every sync.")
+def geofences():
+    rows = db.reader().execute("SELECT fence_id, name, kind, geometry FROM geofences ORDER BY fence_id").fetchall()
+    return [{"fence_id": row[0], "name": row[1], "kind": row[2], "geometry": json.loads(row[3])} for row in rows]
+
+
+@app.post("/Geofences/", summary="Add a circle or polygon geofence.")
+def add_geofence(
+        name: Annotated[str, Body(description="Name of the geofence, sent along with its events")],
+        kind: Annotated[str, Body(description="circle or polygon")] = "circle",
+        lat: Annotated[float | None, Body(description="Circle center latitude")] = None,
+        lon: Annotated[float | None, Body(description="Circle center longitude")] = None,
+        radius: Annotated[float | None, Body(description="Circle radius in meters", gt=0)] = None,
+        points: Annotated[list[list[float]] | None, Body(description="Polygon corners as [lat, lon] pairs")] = None,
+):
+    """
+    Every new position of a monitored device is checked against the geofences by the sync,
+    entering or exiting one records an event, see /GeofenceEvents/ and /Stream/. <br>
+
+    Example,\n
+    ```JSON
+    {"name": "Home", "kind": "circle", "lat": 52.52, "lon": 13.405, "radius": 150}
+    {"name": "Office", "kind": "polygon", "points": [[52.51, 13.38], [52.51, 13.39], [52.52, 13.39]]}
+    ```
+    """
+    if kind == "circle":
+        geometry = {"lat": lat, "lon": lon, "radius": radius}
+    elif kind == "polygon":
+        geometry = {"points": points}
+    else:
+        geometry = None
+
+    try:
+        with db.writer() as sq3:
+            fence_id = add_fence(sq3, name, kind, geometry)
+    except (KeyError, TypeError, ValueError) as e:
+        logging.error(f"Invalid Geofence: {e!r}")
+        return JSONResponse(
+            content={"error": f"Invalid geofence, a circle needs lat, lon and radius, a polygon at least 3 points"},
+            status_code=400)
+
+    return JSONResponse(
+        content={"success": f"Geofence added", "fence_id": fence_id},
+        status_code=200)
+
+
+@app.post("/Geofence_Removal/", summary="Remove a geofence and its events.")
+def geofence_removal(fence_id: int = Query(description="fence_id from /Geofences/")):
+    with db.writer() as sq3:
+        delete_fence(sq3, fence_id)
+
+    return JSONResponse(
+        content={"success": f"Geofence removed"},
+        status_code=200)
+
+
+@app.get("/GeofenceEvents/", summary="Read the geofence enter and exit events of monitored devices.")
+def geofence_events(
+        advertisement_keys: str | None = Query(
+            None, description="Hashed Advertisement Base64 Key(s), separate each key by a comma. "
+                              "Defaults to every device."),
+        since: int = Query(0, description="Only events with a larger event_id, e.g. the last one already read", ge=0),
+        limit: int = Query(500, description="Maximum number of events", ge=1, le=HISTORY_MAX_LIMIT)):
+    """
+    Served from the local database only, Apple is not queried. Events are ordered by event_id. <br>
+    """
+    where, parameters = "WHERE event_id > ?", [since]
+    if advertisement_keys is not None:
+        keys, invalid = split_hashed_keys(advertisement_keys)
+        if invalid:
+            return invalid_keys_response(invalid)
+        report_ids = [base64.b64decode(key) for key in keys]
+        where += f" AND tag_ids.id IN ({','.join('?' * len(report_ids))})"
+        parameters += report_ids
+
+    events = event_rows(db.reader(), where, parameters, limit)
+    for event in events:
+        event['isodatetime'] = datetime.datetime.fromtimestamp(event['timestamp']).isoformat()
+    return events
+
+
 if __name__ == "__main__":
     getAuth()
     uvicorn.run("web_service:app", host="127.0.0.1", port=8000, log_level="error")